@@ -0,0 +1,198 @@
+"""Benchmark suite of the inverted index
+
+run: time load_documents, build_inverted_index, dump, load and queries for
+every storage policy on synthetic corpora of several sizes and on the
+Wikipedia sample when it is present, and save the results as JSON.
+compare: flag metrics of a run which are worse than in a baseline run.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from itertools import accumulate
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict, List, Tuple
+
+import task_Ishmametyev_Nikolay_inverted_index as lib
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_QUERIES_PATH = os.path.join(REPO_DIR, 'wikipedia_search_queries.txt')
+DEFAULT_WIKIPEDIA_PATH = os.path.join(REPO_DIR, 'wikipedia_sample.txt')
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.1
+DOCUMENT_LENGTH = 50
+MIN_QUERIES = 1000
+
+
+def generate_corpus(filepath: str, n_docs: int, extra_words: List[str], seed: int = 0) -> None:
+    """Write documents of words with a Zipf distribution, extra words are the most frequent ones"""
+    rng = random.Random(seed)
+    vocabulary = list(dict.fromkeys(extra_words)) + [f'w{rank}' for rank in range(max(n_docs // 2, 1000))]
+    cum_weights = list(accumulate(1.0 / rank for rank in range(1, len(vocabulary) + 1)))
+    with open(filepath, 'w', encoding='utf-8') as fio:
+        for doc_id in range(1, n_docs + 1):
+            words = rng.choices(vocabulary, cum_weights=cum_weights, k=DOCUMENT_LENGTH)
+            fio.write(f'{doc_id}\t{" ".join(words)}\n')
+
+
+def load_queries(filepath: str) -> List[List[str]]:
+    if not os.path.exists(filepath):
+        return [['w0'], ['w0', 'w1'], ['w2', 'w3', 'w5']]
+    with open(filepath, encoding='utf-8') as fio:
+        return [lib.parse_query_line(line) for line in fio if line.strip()]
+
+
+def best_time(function: Callable, repeat: int) -> Tuple[float, object]:
+    """Smallest wall time of repeat calls and the result of the last call"""
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_queries(inverted_index, queries: List[List[str]]) -> int:
+    n_queries = 0
+    while n_queries < MIN_QUERIES:
+        for words in queries:
+            inverted_index.query(words)
+        n_queries += len(queries)
+    return n_queries
+
+
+def benchmark_corpus(name: str, dataset: str, queries: List[List[str]], policies: List[str],
+                     repeat: int, tmp_dir: str) -> Dict[str, dict]:
+    """Metrics of one corpus as {metric name: {"value", "unit", "better"}}"""
+    results = {}
+
+    def record(metric: str, value: float, unit: str = 's', better: str = 'lower') -> None:
+        results[f'{name}/{metric}'] = {'value': value, 'unit': unit, 'better': better}
+
+    seconds, documents = best_time(lambda: lib.load_documents(dataset), repeat)
+    record('load_documents', seconds)
+    seconds, inverted_index = best_time(lambda: lib.build_inverted_index(documents), repeat)
+    record('build_inverted_index', seconds)
+    for policy in policies:
+        filepath = os.path.join(tmp_dir, f'{name}.{policy}.index')
+        inverted_index.storage_policy = policy
+        seconds, _ = best_time(lambda: inverted_index.dump(filepath), repeat)
+        record(f'{policy}/dump', seconds)
+        record(f'{policy}/file_size', os.path.getsize(filepath), unit='bytes')
+        seconds, loaded_index = best_time(lambda: lib.InvertedIndex.load(filepath, policy), repeat)
+        record(f'{policy}/load', seconds)
+        seconds, n_queries = best_time(lambda: run_queries(loaded_index, queries), repeat)
+        record(f'{policy}/queries_per_second', n_queries / seconds, unit='1/s', better='higher')
+    return results
+
+
+def run_benchmark(sizes: List[int], policies: List[str], queries_path: str, wikipedia_path: str,
+                  repeat: int = DEFAULT_REPEAT, seed: int = 0) -> dict:
+    queries = load_queries(queries_path)
+    query_words = [word for words in queries for word in words]
+    results = {}
+    with TemporaryDirectory() as tmp_dir:
+        corpora = []
+        for size in sizes:
+            dataset = os.path.join(tmp_dir, f'synthetic_{size}.txt')
+            generate_corpus(dataset, size, query_words, seed)
+            corpora.append((f'synthetic_{size}', dataset))
+        if wikipedia_path and os.path.exists(wikipedia_path):
+            corpora.append(('wikipedia', wikipedia_path))
+        for name, dataset in corpora:
+            print(f'Benchmarking {name}', file=sys.stderr)
+            results.update(benchmark_corpus(name, dataset, queries, policies, repeat, tmp_dir))
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeat': repeat,
+            'seed': seed,
+        },
+        'results': results,
+    }
+
+
+def compare_results(baseline: dict, current: dict, threshold: float = DEFAULT_THRESHOLD) -> List[dict]:
+    """Metrics present in both runs which got worse by more than threshold"""
+    regressions = []
+    for metric, result in current['results'].items():
+        if metric not in baseline['results']:
+            continue
+        old, new = baseline['results'][metric]['value'], result['value']
+        if not old:
+            continue
+        change = (new - old) / old
+        if result['better'] == 'higher':
+            change = -change
+        if change > threshold:
+            regressions.append({'metric': metric, 'baseline': old, 'current': new, 'change': change})
+    return regressions
+
+
+def callback_run(arguments):
+    results = run_benchmark(arguments.sizes, arguments.policies, arguments.queries, arguments.wikipedia,
+                            repeat=arguments.repeat, seed=arguments.seed)
+    with open(arguments.output, 'w') as fio:
+        json.dump(results, fio, indent=2)
+
+
+def callback_compare(arguments):
+    with open(arguments.baseline) as fio:
+        baseline = json.load(fio)
+    with open(arguments.current) as fio:
+        current = json.load(fio)
+    regressions = compare_results(baseline, current, arguments.threshold)
+    for regression in regressions:
+        print(f'REGRESSION {regression["metric"]}: {regression["baseline"]:.6g} -> '
+              f'{regression["current"]:.6g} ({regression["change"]:+.1%} worse)')
+    if regressions:
+        sys.exit(1)
+    print('No regressions')
+
+
+def setup_parser(parser: ArgumentParser):
+    subparsers = parser.add_subparsers(help='Choose command')
+
+    parser_run = subparsers.add_parser('run', help='Run benchmarks and save results as JSON',
+                                       formatter_class=ArgumentDefaultsHelpFormatter)
+    parser_run.add_argument('-o', '--output', required=True, help='Path to JSON results')
+    parser_run.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES,
+                            help='Numbers of documents in synthetic corpora')
+    parser_run.add_argument('--policies', nargs='+', default=sorted(lib.STORAGE_POLICIES),
+                            choices=sorted(lib.STORAGE_POLICIES))
+    parser_run.add_argument('--queries', default=DEFAULT_QUERIES_PATH, help='File with a query per line')
+    parser_run.add_argument('--wikipedia', default=DEFAULT_WIKIPEDIA_PATH,
+                            help='Wikipedia sample, skipped if it does not exist')
+    parser_run.add_argument('--repeat', default=DEFAULT_REPEAT, type=int,
+                            help='Best time of this number of runs is reported')
+    parser_run.add_argument('--seed', default=0, type=int, help='Seed of synthetic corpora')
+    parser_run.set_defaults(callback=callback_run)
+
+    parser_compare = subparsers.add_parser('compare', help='Flag regressions of a run against a baseline run',
+                                           formatter_class=ArgumentDefaultsHelpFormatter)
+    parser_compare.add_argument('baseline')
+    parser_compare.add_argument('current')
+    parser_compare.add_argument('--threshold', default=DEFAULT_THRESHOLD, type=float,
+                                help='Relative change of a metric reported as a regression')
+    parser_compare.set_defaults(callback=callback_compare)
+
+
+def main():
+    parser = ArgumentParser(prog='Inverted Index benchmark',
+                            description='Benchmark build, dump, load and queries of Inverted Index')
+    setup_parser(parser)
+    arguments = parser.parse_args()
+    arguments.callback(arguments)
+
+
+if __name__ == "__main__":
+    main()
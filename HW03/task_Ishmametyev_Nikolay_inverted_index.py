@@ -1,13 +1,58 @@
 from __future__ import annotations
 
+import os
 import re
+import asyncio
+import bz2
+import gzip
+import heapq
 import json
+import locale
+import lzma
+import math
+import mmap
+import shutil
 import sys
-from io import TextIOWrapper
+import threading
+import time
+import zlib
+from contextlib import ExitStack, closing, contextmanager
+from functools import partial
+from tempfile import SpooledTemporaryFile, TemporaryDirectory
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO, TextIOWrapper
+from array import array
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, FileType, ArgumentTypeError
-from collections import defaultdict
-from struct import pack, unpack, calcsize
-from typing import Dict, List
+from collections import Counter, OrderedDict, defaultdict
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping
+from itertools import accumulate, chain, combinations, islice
+from struct import pack, unpack, unpack_from, calcsize
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SPOOL_MAX_SIZE = 64 * 2 ** 20
+BM25_K1 = 1.2
+BM25_B = 0.75
+WILDCARD_MAX_EXPANSIONS = 1000
+WILDCARD_MAX_SCANNED = 100000
+QUERY_BATCH_SIZE = 4096
+PAIRS_MEMORY_BUDGET = 16
+READ_BUFFER_SIZE = 2 ** 20
+COMPRESSED_DATASET_OPENERS = {
+    b'\x1f\x8b': lambda fio: gzip.GzipFile(fileobj=fio, mode='rb'),
+    b'BZh': bz2.BZ2File,
+    b'\xfd7zXZ\x00': lzma.LZMAFile,
+}
 
 
 class EncodedFileType(FileType):
@@ -33,14 +78,38 @@ class EncodedFileType(FileType):
             raise ArgumentTypeError(message % (string, e))
 
 
+def compact_postings(doc_ids: Iterable[int]) -> array:
+    """Posting list as an array of unboxed 32-bit doc ids, 64-bit if they do not fit"""
+    doc_ids = doc_ids if isinstance(doc_ids, (list, tuple)) else list(doc_ids)
+    try:
+        return array('I', doc_ids)
+    except OverflowError:
+        return array('Q', doc_ids)
+
+
+def unpack_postings(buffer, offset: int, n_docs: int) -> array:
+    """Big-endian 32-bit doc ids of the buffer as an array, copied without boxing"""
+    doc_ids = array('I')
+    doc_ids.frombytes(buffer[offset:offset + n_docs * doc_ids.itemsize])
+    if sys.byteorder == 'little':
+        doc_ids.byteswap()
+    return doc_ids
+
+
 class StoragePolicy:
     byte_order = '>'
     header_len_fmt_str = f'{byte_order} I'
     header_fmt_str = '{byte_order} {header_length}s'
     docs_fmt_str = '{byte_order} {docs_length}H'
 
+    @classmethod
+    def dump(cls, word_to_docs_mapping: Dict, filepath: str) -> None:
+        """Save Inverted Index in the filepath"""
+        cls.dump_items(word_to_docs_mapping.items(), filepath)
+
     @staticmethod
-    def dump(word_to_docs_mapping: Dict, filepath: str) -> None:
+    def dump_items(items: Iterable[Tuple[str, List[int]]], filepath: str) -> None:
+        """Save (word, doc ids) pairs in the filepath reading them only once"""
         pass
 
     @staticmethod
@@ -48,48 +117,206 @@ class StoragePolicy:
         pass
 
 
+def write_with_header(filepath: str, header_len_fmt_str: str, header: bytes, body) -> None:
+    """Write length of header, header and the content of spooled body file"""
+    with open(filepath, 'wb') as fio:
+        fio.write(pack(header_len_fmt_str, len(header)))
+        fio.write(header)
+        body.seek(0)
+        shutil.copyfileobj(body, fio)
+
+
 class JSONStoragePolicy(StoragePolicy):
     @staticmethod
-    def dump(word_to_docs_mapping: Dict, filepath: str) -> None:
-        """Save Inverted Index in the filepath"""
+    def dump_items(items: Iterable[Tuple[str, List[int]]], filepath: str) -> None:
+        """Save (word, doc ids) pairs in the filepath as a JSON object"""
         with open(filepath, 'w') as fio:
-            json.dump(word_to_docs_mapping, fio)
+            fio.write('{')
+            for position, (word, doc_ids) in enumerate(items):
+                if position:
+                    fio.write(', ')
+                fio.write(f'{json.dumps(word)}: {json.dumps(sorted(doc_ids))}')
+            fio.write('}')
 
     @classmethod
     def load(cls, filepath: str) -> InvertedIndex:
         """Load Inverted Index from filepath"""
         with open(filepath, 'r') as fio:
             index = json.load(fio)
+        for word, doc_ids in index.items():
+            doc_ids.sort()
+            index[word] = compact_postings(doc_ids)
         return InvertedIndex(index)
 
 
+class StructTermDictionary(Mapping):
+    """Read-only word -> doc ids mapping over a struct index file
+
+    Words are sorted and front coded in blocks of block_size words, only
+    the first word of every block is kept in memory. A lookup is a binary
+    search over the first words plus the decoding of one block, posting
+    lists are decoded from the mapped file on access.
+    """
+    def __init__(self, buffer, n_words: int, block_size: int, postings_offset: int, dictionary_offset: int,
+                 first_words: List[bytes], block_offsets: List[int]):
+        self.buffer = buffer
+        self.n_words = n_words
+        self.block_size = block_size
+        self.postings_offset = postings_offset
+        self.dictionary_offset = dictionary_offset
+        self.first_words = first_words
+        self.block_offsets = block_offsets
+
+    def _iter_block(self, block: int) -> Iterator[Tuple[bytes, int, int]]:
+        """Decode (word, offset, n_docs) entries of the block"""
+        position = self.dictionary_offset + self.block_offsets[block]
+        word = b''
+        for _ in range(min(self.block_size, self.n_words - block * self.block_size)):
+            n_shared, position = read_varbyte(self.buffer, position)
+            n_suffix, position = read_varbyte(self.buffer, position)
+            word = word[:n_shared] + self.buffer[position:position + n_suffix]
+            position += n_suffix
+            offset, position = read_varbyte(self.buffer, position)
+            n_docs, position = read_varbyte(self.buffer, position)
+            yield word, offset, n_docs
+
+    def lookup(self, word: str):
+        """(offset, n_docs) of the word or None"""
+        key = word.encode('utf-8')
+        block = bisect_right(self.first_words, key) - 1
+        if block < 0:
+            return None
+        for block_word, offset, n_docs in self._iter_block(block):
+            if block_word == key:
+                return offset, n_docs
+            if block_word > key:
+                break
+        return None
+
+    def document_frequency(self, word: str) -> int:
+        entry = self.lookup(word)
+        return entry[1] if entry is not None else 0
+
+    def iter_prefix(self, prefix: str) -> Iterator[str]:
+        """Words starting with the prefix in sorted order"""
+        key = prefix.encode('utf-8')
+        for block in range(max(bisect_left(self.first_words, key) - 1, 0), len(self.block_offsets)):
+            for word, _, _ in self._iter_block(block):
+                if word.startswith(key):
+                    yield word.decode('utf-8')
+                elif word > key:
+                    return
+
+    def _decode(self, offset: int, n_docs: int) -> array:
+        return unpack_postings(self.buffer, self.postings_offset + offset, n_docs)
+
+    def __getitem__(self, word: str) -> array:
+        entry = self.lookup(word)
+        if entry is None:
+            raise KeyError(word)
+        return self._decode(*entry)
+
+    def __contains__(self, word) -> bool:
+        return isinstance(word, str) and self.lookup(word) is not None
+
+    def __iter__(self):
+        for block in range(len(self.block_offsets)):
+            for word, _, _ in self._iter_block(block):
+                yield word.decode('utf-8')
+
+    def __len__(self) -> int:
+        return self.n_words
+
+    def items(self):
+        for block in range(len(self.block_offsets)):
+            for word, offset, n_docs in self._iter_block(block):
+                yield word.decode('utf-8'), self._decode(offset, n_docs)
+
+
 class StructStoragePolicy(StoragePolicy):
+    """Binary layout with a front coded term dictionary
+
+    Layout (version 2): fixed header with magic, version, number of words,
+    block size, offsets of sections and CRC32 of the dictionary; posting
+    lists as 32-bit doc ids; dictionary blocks of sorted front coded words
+    with (offset, n_docs) of their posting lists; sparse block index with
+    the first word and the offset of every block. Files of version 1 with
+    a JSON header are still loaded.
+    """
     byte_order = '>'
     header_len_fmt_str = f'{byte_order} I'
     header_fmt_str = '{byte_order} {header_length}I'
-    docs_fmt_str = '{byte_order} {docs_length}H'
+    docs_fmt_str = '{byte_order} {docs_length}I'
+    legacy_docs_fmt_str = '{byte_order} {docs_length}H'
+    magic = b'IIDX'
+    version = 2
+    file_header_fmt_str = f'{byte_order} 4s H I H Q Q Q I'
+    block_size = 16
 
-    @staticmethod
-    def dump(word_to_docs_mapping: Dict, filepath: str) -> None:
-        """Save Inverted Index in the filepath"""
+    @classmethod
+    def dump_items(cls, items: Iterable[Tuple[str, List[int]]], filepath: str) -> None:
+        """Save (word, doc ids) pairs in the filepath"""
+        entries = []
         with open(filepath, 'wb') as fio:
-            pairs, all_docs_ids = [], []
-            for word, doc_ids in word_to_docs_mapping.items():
-                pairs.append((word, len(doc_ids)))
-                all_docs_ids.extend(doc_ids)
-            header = json.dumps(pairs).encode('utf-8')
-            fio.write(pack(StoragePolicy.header_len_fmt_str, len(header)))
-            fio.write(pack(StoragePolicy.header_fmt_str.format(byte_order=StoragePolicy.byte_order,
-                                                               header_length=len(header)), header))
-            fio.write(pack(StoragePolicy.docs_fmt_str.format(byte_order=StoragePolicy.byte_order,
-                                                             docs_length=len(all_docs_ids)), *all_docs_ids))
+            fio.write(bytes(calcsize(cls.file_header_fmt_str)))
+            postings_offset = fio.tell()
+            for word, doc_ids in items:
+                entries.append((word.encode('utf-8'), fio.tell() - postings_offset, len(doc_ids)))
+                fio.write(pack(cls.docs_fmt_str.format(byte_order=cls.byte_order,
+                                                       docs_length=len(doc_ids)), *sorted(doc_ids)))
+            entries.sort()
+
+            dictionary, block_index = bytearray(), bytearray()
+            previous = b''
+            for position, (word, offset, n_docs) in enumerate(entries):
+                if position % cls.block_size == 0:
+                    block_index += encode_varbyte([len(word)]) + word + encode_varbyte([len(dictionary)])
+                    previous = b''
+                n_shared = len(os.path.commonprefix([previous, word]))
+                dictionary += encode_varbyte([n_shared, len(word) - n_shared])
+                dictionary += word[n_shared:]
+                dictionary += encode_varbyte([offset, n_docs])
+                previous = word
+            dictionary_offset = fio.tell()
+            fio.write(dictionary)
+            block_index_offset = fio.tell()
+            fio.write(block_index)
+
+            checksum = zlib.crc32(block_index, zlib.crc32(dictionary))
+            fio.seek(0)
+            fio.write(pack(cls.file_header_fmt_str, cls.magic, cls.version, len(entries), cls.block_size,
+                           postings_offset, dictionary_offset, block_index_offset, checksum))
 
     @classmethod
     def load(cls, filepath: str) -> InvertedIndex:
-        """Load Inverted Index from filepath"""
+        """Map Inverted Index from filepath, posting lists are decoded on demand"""
         with open(filepath, 'rb') as fio:
-            bytes = fio.read()
+            if fio.read(len(cls.magic)) != cls.magic:
+                fio.seek(0)
+                return cls.load_legacy(fio.read())
+            buffer = mmap.mmap(fio.fileno(), 0, access=mmap.ACCESS_READ)
+
+        _, version, n_words, block_size, postings_offset, dictionary_offset, block_index_offset, checksum = \
+            unpack_from(cls.file_header_fmt_str, buffer)
+        if version != cls.version:
+            raise ValueError(f'Unsupported struct index version: {version}')
+        if zlib.crc32(buffer[dictionary_offset:]) != checksum:
+            raise ValueError(f'Corrupted struct index: {filepath}')
+
+        first_words, block_offsets = [], []
+        position = block_index_offset
+        while position < len(buffer):
+            word_length, position = read_varbyte(buffer, position)
+            first_words.append(buffer[position:position + word_length])
+            block_offset, position = read_varbyte(buffer, position + word_length)
+            block_offsets.append(block_offset)
+        postings = StructTermDictionary(buffer, n_words, block_size, postings_offset, dictionary_offset,
+                                        first_words, block_offsets)
+        return InvertedIndex(postings, storage_policy='struct')
 
+    @classmethod
+    def load_legacy(cls, bytes) -> InvertedIndex:
+        """Load Inverted Index in the version 1 layout with JSON header"""
         # Load size of header
         meta_bytes_length = calcsize(StoragePolicy.header_len_fmt_str)
         header_length, = unpack(StoragePolicy.header_len_fmt_str, bytes[:meta_bytes_length])
@@ -106,150 +333,2826 @@ class StructStoragePolicy(StoragePolicy):
         index = {}
         start_pos = meta_bytes_length + header_bytes_length
         for word, n_docs in pairs:
-            docs_fmt = StoragePolicy.docs_fmt_str.format(byte_order=StoragePolicy.byte_order,
-                                                         docs_length=n_docs)
+            docs_fmt = cls.legacy_docs_fmt_str.format(byte_order=cls.byte_order,
+                                                     docs_length=n_docs)
             docs_bytes_length = calcsize(docs_fmt)
-            index[word] = list(unpack(docs_fmt, bytes[start_pos:start_pos + docs_bytes_length]))
+            index[word] = compact_postings(sorted(unpack(docs_fmt, bytes[start_pos:start_pos + docs_bytes_length])))
             start_pos += docs_bytes_length
         return InvertedIndex(index)
 
 
-class InvertedIndex:
-    def __init__(self, index: Dict[str, List[int]], storage_policy='json'):
-        self.index = index
-        self.storage_policy = storage_policy.lower()
+class MmapPostings(Mapping):
+    """Read-only word -> doc ids mapping backed by a memory-mapped index file
+
+    Only the term directory is kept in memory, posting lists are decoded
+    from the mapped file on every access.
+    """
+    def __init__(self, buffer, directory: Dict[str, Tuple[int, int]], data_offset: int):
+        self.buffer = buffer
+        self.directory = directory
+        self.data_offset = data_offset
+
+    def __getitem__(self, word: str) -> array:
+        offset, n_docs = self.directory[word]
+        return unpack_postings(self.buffer, self.data_offset + offset, n_docs)
+
+    def __contains__(self, word) -> bool:
+        return word in self.directory
+
+    def document_frequency(self, word: str) -> int:
+        return self.directory[word][1] if word in self.directory else 0
+
+    def __iter__(self):
+        return iter(self.directory)
+
+    def __len__(self) -> int:
+        return len(self.directory)
+
+
+class MmapStoragePolicy(StoragePolicy):
+    """Binary layout with a term directory for lazy loading
+
+    Layout: directory length, JSON directory of (word, offset, n_docs) and
+    the posting lists as 32-bit doc ids, offsets are relative to the
+    beginning of the posting lists.
+    """
+    byte_order = '>'
+    header_len_fmt_str = f'{byte_order} I'
+    docs_fmt_str = '{byte_order} {docs_length}I'
+
+    @classmethod
+    def dump_items(cls, items: Iterable[Tuple[str, List[int]]], filepath: str) -> None:
+        """Save (word, doc ids) pairs in the filepath"""
+        directory = []
+        with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as body:
+            for word, doc_ids in items:
+                directory.append((word, body.tell(), len(doc_ids)))
+                body.write(pack(cls.docs_fmt_str.format(byte_order=cls.byte_order,
+                                                        docs_length=len(doc_ids)), *sorted(doc_ids)))
+            header = json.dumps(directory).encode('utf-8')
+            write_with_header(filepath, cls.header_len_fmt_str, header, body)
+
+    @classmethod
+    def load(cls, filepath: str) -> InvertedIndex:
+        """Map Inverted Index from filepath, posting lists are decoded on demand"""
+        with open(filepath, 'rb') as fio:
+            buffer = mmap.mmap(fio.fileno(), 0, access=mmap.ACCESS_READ)
+
+        meta_bytes_length = calcsize(cls.header_len_fmt_str)
+        header_length, = unpack_from(cls.header_len_fmt_str, buffer)
+        header = buffer[meta_bytes_length:meta_bytes_length + header_length]
+        directory = {word: (offset, n_docs) for word, offset, n_docs in json.loads(header.decode('utf-8'))}
+        postings = MmapPostings(buffer, directory, meta_bytes_length + header_length)
+        return InvertedIndex(postings, storage_policy='mmap')
+
+
+_BYTE_BITS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+
+
+class BitmapPostings:
+    """Dense posting list as a bitmap, bit i is set if doc id i is in the list
+
+    Iteration yields doc ids in sorted order, membership is a bit test and
+    AND, OR and AND NOT of two bitmaps run as bitwise operations on ints.
+    """
+    __slots__ = ('bits', 'n_docs')
+
+    def __init__(self, bits: bytes, n_docs: int):
+        self.bits = bits
+        self.n_docs = n_docs
+
+    @classmethod
+    def from_doc_ids(cls, doc_ids: Iterable[int]) -> BitmapPostings:
+        doc_ids = list(doc_ids)
+        bits = bytearray(max(doc_ids) // 8 + 1 if doc_ids else 0)
+        for doc_id in doc_ids:
+            bits[doc_id >> 3] |= 1 << (doc_id & 7)
+        return cls(bytes(bits), len(set(doc_ids)))
+
+    @classmethod
+    def from_int(cls, value: int) -> BitmapPostings:
+        return cls(value.to_bytes((value.bit_length() + 7) // 8, 'little'), bin(value).count('1'))
+
+    def to_int(self) -> int:
+        return int.from_bytes(self.bits, 'little')
+
+    def to_array(self) -> array:
+        return compact_postings(iter(self))
+
+    def __len__(self) -> int:
+        return self.n_docs
+
+    def __contains__(self, doc_id: int) -> bool:
+        return doc_id >> 3 < len(self.bits) and bool(self.bits[doc_id >> 3] >> (doc_id & 7) & 1)
+
+    def __iter__(self) -> Iterator[int]:
+        for position, byte in enumerate(self.bits):
+            if byte:
+                base = position << 3
+                for bit in _BYTE_BITS[byte]:
+                    yield base + bit
+
+    def __and__(self, other: BitmapPostings) -> BitmapPostings:
+        return BitmapPostings.from_int(self.to_int() & other.to_int())
+
+    def __or__(self, other: BitmapPostings) -> BitmapPostings:
+        return BitmapPostings.from_int(self.to_int() | other.to_int())
+
+    def __sub__(self, other: BitmapPostings) -> BitmapPostings:
+        return BitmapPostings.from_int(self.to_int() & ~other.to_int())
 
     def __eq__(self, other):
-        if set(self.index.keys()) != set(other.index.keys()):
-            return False
-        for key, value in self.index.items():
-            if sorted(value) != sorted(other.index[key]):
-                return False
-        return True
+        return list(self) == list(other)
 
-    def query(self, words: List[str]) -> List[int]:
-        """Return the list of relevant documents for the given query"""
-        if not words:
-            return []
-        words_dict = {}
-        for word in words:
-            if word in self.index:
-                words_dict[word] = self.index[word]
-            else:
-                return []
+    def __repr__(self) -> str:
+        return f'BitmapPostings({list(self)})'
 
-        possible = set(words_dict[words[0]])
-        for word in words[1:]:
-            possible = possible.intersection(set(words_dict[word]))
-        return list(possible)
+
+def sorted_sequence(doc_ids):
+    """Posting list which supports indexing, bitmaps are converted to arrays"""
+    return doc_ids.to_array() if isinstance(doc_ids, BitmapPostings) else doc_ids
+
+
+def intersect_sorted(left: List[int], right: List[int]) -> List[int]:
+    """Intersect two sorted posting lists
+
+    Every doc id of the shorter list is searched in the longer one with
+    galloping (exponential) search starting from the previous match, so
+    the cost is proportional to the shorter list. Two bitmaps are
+    intersected bitwise, a list and a bitmap by bit tests.
+    """
+    if isinstance(left, BitmapPostings) and isinstance(right, BitmapPostings):
+        return left & right
+    if isinstance(left, BitmapPostings):
+        left, right = right, left
+    if isinstance(right, BitmapPostings):
+        return [doc_id for doc_id in left if doc_id in right]
+    if len(left) > len(right):
+        left, right = right, left
+    result = []
+    position, size = 0, len(right)
+    for doc_id in left:
+        upper, step = position, 1
+        while upper < size and right[upper] < doc_id:
+            position = upper + 1
+            upper += step
+            step <<= 1
+        position = bisect_left(right, doc_id, position, min(upper, size))
+        if position == size:
+            break
+        if right[position] == doc_id:
+            result.append(doc_id)
+            position += 1
+    return result
+
+
+def difference_sorted(left: List[int], right: List[int]) -> List[int]:
+    """Doc ids of the sorted list left which are not in the sorted list right
+
+    Uses galloping search in right, so the cost is proportional to left.
+    """
+    if isinstance(right, BitmapPostings):
+        if isinstance(left, BitmapPostings):
+            return left - right
+        return [doc_id for doc_id in left if doc_id not in right]
+    if isinstance(left, BitmapPostings):
+        return left - BitmapPostings.from_doc_ids(right) if right else left
+    result = []
+    position, size = 0, len(right)
+    for doc_id in left:
+        upper, step = position, 1
+        while upper < size and right[upper] < doc_id:
+            position = upper + 1
+            upper += step
+            step <<= 1
+        position = bisect_left(right, doc_id, position, min(upper, size))
+        if position == size or right[position] != doc_id:
+            result.append(doc_id)
+    return result
+
+
+def union_sorted(postings: List[List[int]]) -> List[int]:
+    """Union of sorted posting lists, bitmaps only are united bitwise"""
+    if postings and all(isinstance(doc_ids, BitmapPostings) for doc_ids in postings):
+        value = 0
+        for doc_ids in postings:
+            value |= doc_ids.to_int()
+        return BitmapPostings.from_int(value)
+    if len(postings) == 1:
+        return list(postings[0])
+    result = []
+    for doc_id in heapq.merge(*postings):
+        if not result or result[-1] != doc_id:
+            result.append(doc_id)
+    return result
+
+
+def light_stem(word: str) -> str:
+    """S-stemmer: reduce English plural forms to the singular ones"""
+    if len(word) > 3 and word.endswith('ies') and not word.endswith(('eies', 'aies')):
+        return word[:-3] + 'y'
+    if len(word) > 3 and word.endswith('es') and not word.endswith(('aes', 'ees', 'oes')):
+        return word[:-1]
+    if len(word) > 2 and word.endswith('s') and not word.endswith(('us', 'ss')):
+        return word[:-1]
+    return word
+
+
+class Analyzer:
+    """Chain of token filters shared by indexing and querying
+
+    Text is split into words by one precompiled regex, words are
+    lowercased, stop words are dropped and plural forms are optionally
+    stemmed. Positions of words count the dropped stop words, so phrases
+    keep their gaps. Query words may also contain "*" wildcards, which
+    are not stemmed.
+    """
+    token_re = re.compile(r"\w+")
+    query_token_re = re.compile(r"[\w*]+")
+
+    def __init__(self, lowercase=True, stop_words: Iterable[str] = (), stem=False):
+        self.lowercase = lowercase
+        self.stop_words = frozenset(word.lower() if lowercase else word for word in stop_words)
+        self.stem = stem
+
+    def config(self) -> dict:
+        return {'lowercase': self.lowercase, 'stop_words': sorted(self.stop_words), 'stem': self.stem}
+
+    def __eq__(self, other):
+        return isinstance(other, Analyzer) and self.config() == other.config()
+
+    def term(self, token: str):
+        """Indexed form of the token or None for a stop word"""
+        if self.lowercase:
+            token = token.lower()
+        if token in self.stop_words:
+            return None
+        if self.stem and '*' not in token:
+            token = light_stem(token)
+        return token
+
+    def analyze_positions(self, text: str, query=False) -> List[Tuple[int, str]]:
+        """(position, term) pairs of the text"""
+        token_re = self.query_token_re if query else self.token_re
+        pairs = []
+        for position, token in enumerate(token_re.findall(text)):
+            term = self.term(token)
+            if term is not None:
+                pairs.append((position, term))
+        return pairs
+
+    def analyze(self, text: str) -> List[str]:
+        return [term for _, term in self.analyze_positions(text)]
+
+    def analyze_query(self, words: Iterable[str]) -> List[str]:
+        return [term for word in words for _, term in self.analyze_positions(word, query=True)]
 
     def dump(self, filepath: str) -> None:
-        if self.storage_policy == 'json':
-            JSONStoragePolicy.dump(self.index, filepath)
-        elif self.storage_policy == 'struct':
-            StructStoragePolicy.dump(self.index, filepath)
+        with open(filepath, 'w') as fio:
+            json.dump(self.config(), fio)
+
+    @classmethod
+    def load(cls, filepath: str) -> Analyzer:
+        with open(filepath) as fio:
+            return cls(**json.load(fio))
+
+
+def load_stop_words(filepath: str) -> List[str]:
+    """Stop words listed one per line"""
+    with open(filepath, encoding='utf-8') as fio:
+        return [line.strip() for line in fio if line.strip()]
+
+
+class TermNode:
+    def __init__(self, word: str):
+        self.word = word
+
+
+class NotNode:
+    def __init__(self, child):
+        self.child = child
+
+
+class AndNode:
+    def __init__(self, children: List):
+        self.children = children
+
+
+class OrNode:
+    def __init__(self, children: List):
+        self.children = children
+
+
+class PhraseNode:
+    """Words standing at the given offsets from each other in the given order"""
+    def __init__(self, words: List[str], offsets: List[int] = None):
+        self.words = words
+        self.offsets = offsets if offsets is not None else list(range(len(words)))
+
+
+class NearNode:
+    """Two words at most distance words apart in any order"""
+    def __init__(self, words: List[str], distance: int):
+        self.words = words
+        self.distance = distance
+
+
+class BooleanQueryParser:
+    """Parser of queries with AND, OR, NOT, parentheses and phrases
+
+    "quoted words" is a phrase and word NEAR/k word matches words at most
+    k words apart. NEAR binds tighter than NOT, NOT binds tighter than
+    AND, AND binds tighter than OR, and words without an operator between
+    them are joined with AND. Words are passed through the analyzer, stop
+    words are left out of the query.
+    """
+    token_re = re.compile(r'\(|\)|"[^"]*"|NEAR/\d+|[\w*]+')
+    near_re = re.compile(r'NEAR/(\d+)')
+    operators = {'AND', 'OR', 'NOT'}
+
+    def __init__(self, expression: str, analyzer: Analyzer = None):
+        self.tokens = self.token_re.findall(expression)
+        self.position = 0
+        self.analyzer = analyzer or Analyzer()
+
+    def parse(self):
+        """Root node of the query, None if it consists of stop words only"""
+        if not self.tokens:
+            raise ValueError('Empty boolean query')
+        node = self._parse_or()
+        if self._peek() is not None:
+            raise ValueError(f'Unexpected token in boolean query: {self._peek()}')
+        return node
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def _next(self) -> str:
+        token = self._peek()
+        if token is None:
+            raise ValueError('Unexpected end of boolean query')
+        self.position += 1
+        return token
+
+    def _parse_or(self):
+        children = [self._parse_and()]
+        while self._peek() == 'OR':
+            self._next()
+            children.append(self._parse_and())
+        children = [child for child in children if child is not None]
+        if len(children) <= 1:
+            return children[0] if children else None
+        return OrNode(children)
+
+    def _parse_and(self):
+        children = [self._parse_not()]
+        while self._peek() not in (None, ')', 'OR'):
+            if self._peek() == 'AND':
+                self._next()
+            children.append(self._parse_not())
+        children = [child for child in children if child is not None]
+        if len(children) <= 1:
+            return children[0] if children else None
+        return AndNode(children)
+
+    def _parse_not(self):
+        if self._peek() == 'NOT':
+            self._next()
+            child = self._parse_not()
+            if child is None:
+                return None
+            return child.child if isinstance(child, NotNode) else NotNode(child)
+        return self._parse_near()
+
+    def _parse_near(self):
+        node = self._parse_atom()
+        match = self.near_re.fullmatch(self._peek() or '')
+        if match is None:
+            return node
+        self._next()
+        right = self._parse_atom()
+        if not isinstance(node, TermNode) or not isinstance(right, TermNode):
+            raise ValueError('NEAR operands must be single words which are not stop words')
+        if '*' in node.word or '*' in right.word:
+            raise ValueError('Wildcards are not supported in NEAR operands')
+        return NearNode([node.word, right.word], int(match.group(1)))
+
+    def _parse_atom(self):
+        token = self._next()
+        if token == '(':
+            node = self._parse_or()
+            if self._next() != ')':
+                raise ValueError('Missing closing parenthesis in boolean query')
+            return node
+        if token.startswith('"'):
+            if '*' in token:
+                raise ValueError('Wildcards are not supported in phrases')
+            if not self.analyzer.token_re.search(token):
+                raise ValueError('Empty phrase in boolean query')
+            pairs = self.analyzer.analyze_positions(token)
+            if len(pairs) <= 1:
+                return TermNode(pairs[0][1]) if pairs else None
+            start = pairs[0][0]
+            return PhraseNode([term for _, term in pairs], [position - start for position, _ in pairs])
+        if token == ')' or token in self.operators or self.near_re.fullmatch(token):
+            raise ValueError(f'Unexpected token in boolean query: {token}')
+        term = self.analyzer.term(token)
+        return TermNode(term) if term is not None else None
+
+
+def encode_varbyte(numbers: Iterable[int]) -> bytes:
+    """Encode non-negative integers with 7 bits per byte, high bit marks the last byte"""
+    encoded = bytearray()
+    for number in numbers:
+        while number >= 0x80:
+            encoded.append(number & 0x7F)
+            number >>= 7
+        encoded.append(number | 0x80)
+    return bytes(encoded)
+
+
+_VARBYTE_CLEAR_STOP_BIT = bytes(byte & 0x7F for byte in range(256))
+
+
+def decode_varbyte(buffer: bytes, count: int = None) -> List[int]:
+    """Decode integers encoded with encode_varbyte
+
+    If count equals the buffer length every number takes one byte and
+    the buffer is decoded without a Python level loop.
+    """
+    if count == len(buffer):
+        return list(buffer.translate(_VARBYTE_CLEAR_STOP_BIT))
+    numbers = []
+    number, shift = 0, 0
+    for byte in buffer:
+        if byte & 0x80:
+            numbers.append(number | (byte & 0x7F) << shift)
+            number, shift = 0, 0
         else:
-            raise ValueError(f'Unknown storage policy: {self.storage_policy}')
+            number |= byte << shift
+            shift += 7
+    return numbers
+
+
+def read_varbyte(buffer, position: int) -> Tuple[int, int]:
+    """Decode one integer encoded with encode_varbyte, return it and the next position"""
+    number, shift = 0, 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        if byte & 0x80:
+            return number | (byte & 0x7F) << shift, position
+        number |= byte << shift
+        shift += 7
+
+
+class VarByteStoragePolicy(StoragePolicy):
+    """Binary layout with sorted posting lists compressed as variable-byte d-gaps
+
+    Layout: header length, JSON header of (word, n_docs, n_bytes) and the encoded
+    posting lists. Doc ids are not limited in size.
+    """
+    byte_order = '>'
+    header_len_fmt_str = f'{byte_order} I'
 
     @classmethod
-    def load(cls, filepath: str, storage_policy) -> InvertedIndex:
+    def dump_items(cls, items: Iterable[Tuple[str, List[int]]], filepath: str) -> None:
+        """Save (word, doc ids) pairs in the filepath"""
+        pairs = []
+        with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as body:
+            for word, doc_ids in items:
+                doc_ids = sorted(doc_ids)
+                gaps = [doc_id - previous for previous, doc_id in zip([0] + doc_ids, doc_ids)]
+                chunk = encode_varbyte(gaps)
+                pairs.append((word, len(doc_ids), len(chunk)))
+                body.write(chunk)
+            header = json.dumps(pairs).encode('utf-8')
+            write_with_header(filepath, cls.header_len_fmt_str, header, body)
+
+    @classmethod
+    def load(cls, filepath: str) -> InvertedIndex:
         """Load Inverted Index from filepath"""
-        storage_policy = storage_policy.lower()
-        if storage_policy == 'json':
-            return JSONStoragePolicy.load(filepath)
-        elif storage_policy == 'struct':
-            return StructStoragePolicy.load(filepath)
-        else:
-            raise ValueError(f'Unknown storage policy: {storage_policy}')
+        with open(filepath, 'rb') as fio:
+            bytes = fio.read()
 
+        meta_bytes_length = calcsize(cls.header_len_fmt_str)
+        header_length, = unpack_from(cls.header_len_fmt_str, bytes)
+        start_pos = meta_bytes_length + header_length
+        pairs = json.loads(bytes[meta_bytes_length:start_pos].decode('utf-8'))
 
-def load_documents(filepath: str) -> Dict[int, str]:
-    documents = {}
-    with open(filepath) as fio:
-        lines = fio.readlines()
-        for line in lines:
-            doc_id, content = line.lower().split("\t", 1)
-            documents[int(doc_id)] = content.strip()
-    return documents
+        index = {}
+        for word, n_docs, n_bytes in pairs:
+            gaps = decode_varbyte(bytes[start_pos:start_pos + n_bytes], n_docs)
+            index[word] = compact_postings(accumulate(gaps))
+            start_pos += n_bytes
+        return InvertedIndex(index, storage_policy='varbyte')
 
 
-def build_inverted_index(documents: Dict[int, str], storage_policy='json') -> InvertedIndex:
-    index = defaultdict(list)
-    for key, content in documents.items():
-        words = re.split(r"\W+", content)
-        for word in set(words):
-            if word not in index or key not in index[word]:
-                index[word].append(key)
-    return InvertedIndex(index, storage_policy)
+class HybridPostings(Mapping):
+    """Read-only word -> postings mapping over a memory-mapped hybrid index file
 
+    Posting lists are decoded on access into an array or a bitmap, as
+    chosen when the index was saved.
+    """
+    def __init__(self, buffer, directory: Dict[str, Tuple[str, int, int, int]], data_offset: int):
+        self.buffer = buffer
+        self.directory = directory
+        self.data_offset = data_offset
 
-def callback_build(arguments):
-    documents = load_documents(arguments.dataset)
-    inverted_index = build_inverted_index(documents, storage_policy=arguments.strategy)
-    inverted_index.dump(arguments.output)
+    def __getitem__(self, word: str):
+        container, offset, n_docs, n_bytes = self.directory[word]
+        start = self.data_offset + offset
+        if container == 'bitmap':
+            return BitmapPostings(self.buffer[start:start + n_bytes], n_docs)
+        doc_ids = array(container)
+        doc_ids.frombytes(self.buffer[start:start + n_bytes])
+        if sys.byteorder == 'big':
+            doc_ids.byteswap()
+        return doc_ids
 
+    def __contains__(self, word) -> bool:
+        return word in self.directory
 
-def callback_query(arguments):
-    inverted_index = InvertedIndex.load(filepath=arguments.index,
-                                        storage_policy=arguments.strategy)
-    if arguments.query is not None:
-        process_query_from_cli(arguments.query, inverted_index)
-    elif hasattr(arguments, 'query_file'):
-        process_query_from_file(arguments.query_file, inverted_index)
+    def document_frequency(self, word: str) -> int:
+        return self.directory[word][2] if word in self.directory else 0
 
+    def __iter__(self):
+        return iter(self.directory)
 
-def process_query_from_cli(queries, inverted_index):
-    for words in queries:
-        res = make_result_of_query_in_one_line(inverted_index.query(words))
-        print(res, file=sys.stdout)
+    def __len__(self) -> int:
+        return len(self.directory)
 
 
-def process_query_from_file(query_file, inverted_index):
-    for query in query_file:
-        query = re.split(r"\W+", query.strip())
-        res = make_result_of_query_in_one_line(inverted_index.query(query))
-        print(res, file=sys.stdout)
+class HybridStoragePolicy(StoragePolicy):
+    """Binary layout with an array or a bitmap container per posting list
 
+    Layout: directory length, JSON directory of (word, container, offset,
+    n_docs, n_bytes) and the containers. A posting list is saved as a
+    bitmap of doc ids if it is smaller than a little-endian array of 32-bit
+    (or 64-bit for large ids) doc ids, so frequent words take one bit per
+    document and are combined with bitwise operations.
+    """
+    byte_order = '>'
+    header_len_fmt_str = f'{byte_order} I'
 
-def make_result_of_query_in_one_line(arr: List):
-    return ','.join([str(el) for el in arr])
+    @staticmethod
+    def encode_container(doc_ids: Iterable[int]) -> Tuple[str, bytes]:
+        """Smallest of the bitmap and the array encoding of the doc ids"""
+        bitmap = None
+        if isinstance(doc_ids, BitmapPostings):
+            bitmap, doc_ids = doc_ids, doc_ids.to_array()
+        else:
+            doc_ids = compact_postings(sorted(doc_ids))
+        if doc_ids and doc_ids[-1] // 8 + 1 < len(doc_ids) * doc_ids.itemsize:
+            return 'bitmap', (bitmap if bitmap is not None else BitmapPostings.from_doc_ids(doc_ids)).bits
+        if sys.byteorder == 'big':
+            doc_ids.byteswap()
+        return doc_ids.typecode, doc_ids.tobytes()
 
+    @classmethod
+    def dump_items(cls, items: Iterable[Tuple[str, List[int]]], filepath: str) -> None:
+        """Save (word, doc ids) pairs in the filepath"""
+        directory = []
+        with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as body:
+            for word, doc_ids in items:
+                container, chunk = cls.encode_container(doc_ids)
+                directory.append((word, container, body.tell(), len(doc_ids), len(chunk)))
+                body.write(chunk)
+            header = json.dumps(directory).encode('utf-8')
+            write_with_header(filepath, cls.header_len_fmt_str, header, body)
 
-def setup_parser(parser: ArgumentParser):
-    """Parsing of CLI arguments
+    @classmethod
+    def load(cls, filepath: str) -> InvertedIndex:
+        """Map Inverted Index from filepath, containers are decoded on demand"""
+        with open(filepath, 'rb') as fio:
+            buffer = mmap.mmap(fio.fileno(), 0, access=mmap.ACCESS_READ)
 
-    A couple of branches to choose:
-    - build: build Inverted index
-    - query: load Inverted index and query it with words
+        meta_bytes_length = calcsize(cls.header_len_fmt_str)
+        header_length, = unpack_from(cls.header_len_fmt_str, buffer)
+        header = buffer[meta_bytes_length:meta_bytes_length + header_length]
+        directory = {word: tuple(entry) for word, *entry in json.loads(header.decode('utf-8'))}
+        postings = HybridPostings(buffer, directory, meta_bytes_length + header_length)
+        return InvertedIndex(postings, storage_policy='hybrid')
+
+
+STORAGE_POLICIES = {
+    'json': JSONStoragePolicy,
+    'struct': StructStoragePolicy,
+    'mmap': MmapStoragePolicy,
+    'varbyte': VarByteStoragePolicy,
+    'hybrid': HybridStoragePolicy,
+}
+
+
+class PositionsFile(Mapping):
+    """Read-only word -> positions mapping over a memory-mapped positions file
+
+    Positions of a word are a list of sorted token positions for every
+    document of its sorted posting list, decoded on access. Positions of
+    a word start with a table of offsets of every skip_interval-th
+    document, so positions of a single document are decoded after
+    skipping at most skip_interval - 1 documents.
     """
-    subparsers = parser.add_subparsers(help='Choose command')
+    header_len_fmt_str = '> I'
+    skip_fmt_str = '> I'
+    skip_interval = 64
 
-    parser_build = subparsers.add_parser('build', help='Build inverted index with documents',
-                                         formatter_class=ArgumentDefaultsHelpFormatter)
+    def __init__(self, buffer, directory: Dict[str, Tuple[int, int, int]], data_offset: int):
+        self.buffer = buffer
+        self.directory = directory
+        self.data_offset = data_offset
 
-    parser_build.add_argument('-d', '--dataset', required=True)
-    parser_build.add_argument('-o', '--output', required=True)
-    parser_build.add_argument('-s', '--strategy', default='struct', choices=['json', 'struct'])
-    parser_build.set_defaults(callback=callback_build)
+    def _skip_table_end(self, word: str) -> Tuple[int, int]:
+        """Start of the skip table and of the positions of the word in the buffer"""
+        offset, _, n_docs = self.directory[word]
+        start = self.data_offset + offset
+        n_skips = -(-n_docs // self.skip_interval)
+        return start, start + n_skips * calcsize(self.skip_fmt_str)
 
-    parser_query = subparsers.add_parser('query', help='Query inverted index with words',
-                                         formatter_class=ArgumentDefaultsHelpFormatter)
-    parser_query.add_argument('--index', required=True, help='Path to inverted index')
-    parser_query.add_argument('-s', '--strategy', default='struct', choices=['json', 'struct'])
+    def __getitem__(self, word: str) -> List[List[int]]:
+        offset, n_bytes, _ = self.directory[word]
+        _, positions_start = self._skip_table_end(word)
+        return split_positions(decode_varbyte(self.buffer[positions_start:self.data_offset + offset + n_bytes]))
 
-    query_group = parser_query.add_mutually_exclusive_group(required=True)
-    query_group.add_argument('--query', nargs='+', action='append', metavar='WORD',
-                             help='Query with words from CLI')
-    query_group.add_argument('--query-file-utf8', dest='query_file',
-                             type=EncodedFileType('r', encoding='utf-8'),
-                             default=TextIOWrapper(sys.stdin.buffer, encoding='utf-8'),
-                             help='Load queries from file with utf-8 encoding')
-    query_group.add_argument('--query-file-cp1251', dest='query_file',
-                             type=EncodedFileType('r', encoding='cp1251'),
-                             default=TextIOWrapper(sys.stdin.buffer, encoding='cp1251'),
-                             help='Load queries from file with cp-1251 encoding')
+    def document_positions(self, word: str, rank: int) -> List[int]:
+        """Positions of the word in the rank-th document of its posting list"""
+        start, positions_start = self._skip_table_end(word)
+        skip, rest = divmod(rank, self.skip_interval)
+        position = positions_start + unpack_from(self.skip_fmt_str, self.buffer,
+                                                 start + skip * calcsize(self.skip_fmt_str))[0]
+        buffer = self.buffer
+        for _ in range(rest):
+            count, position = read_varbyte(buffer, position)
+            for _ in range(count):
+                while not buffer[position] & 0x80:
+                    position += 1
+                position += 1
+        count, position = read_varbyte(buffer, position)
+        gaps = []
+        for _ in range(count):
+            gap, position = read_varbyte(buffer, position)
+            gaps.append(gap)
+        return list(accumulate(gaps))
 
-    parser_query.set_defaults(callback=callback_query)
+    def __contains__(self, word) -> bool:
+        return word in self.directory
+
+    def __iter__(self):
+        return iter(self.directory)
+
+    def __len__(self) -> int:
+        return len(self.directory)
+
+    @classmethod
+    def dump(cls, positions: Mapping, filepath: str) -> None:
+        """Save positions as variable-byte number of positions and position gaps per document"""
+        directory = {}
+        with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as body:
+            for word, doc_positions in positions.items():
+                skips, chunks, n_bytes = [], [], 0
+                for rank, word_positions in enumerate(doc_positions):
+                    if rank % cls.skip_interval == 0:
+                        skips.append(pack(cls.skip_fmt_str, n_bytes))
+                    chunk = encode_varbyte(chain((len(word_positions),), (
+                        position - previous for previous, position in zip([0] + word_positions, word_positions))))
+                    chunks.append(chunk)
+                    n_bytes += len(chunk)
+                chunk = b''.join(chain(skips, chunks))
+                directory[word] = (body.tell(), len(chunk), len(doc_positions))
+                body.write(chunk)
+            header = json.dumps(directory).encode('utf-8')
+            write_with_header(filepath, cls.header_len_fmt_str, header, body)
+
+    @classmethod
+    def load(cls, filepath: str) -> PositionsFile:
+        with open(filepath, 'rb') as fio:
+            buffer = mmap.mmap(fio.fileno(), 0, access=mmap.ACCESS_READ)
+        meta_bytes_length = calcsize(cls.header_len_fmt_str)
+        header_length, = unpack_from(cls.header_len_fmt_str, buffer)
+        header = buffer[meta_bytes_length:meta_bytes_length + header_length]
+        directory = {word: tuple(entry) for word, entry in json.loads(header.decode('utf-8')).items()}
+        return cls(buffer, directory, meta_bytes_length + header_length)
+
+
+def split_positions(numbers: List[int]) -> List[List[int]]:
+    """Split decoded (count, gaps...) groups into lists of positions"""
+    doc_positions = []
+    position = 0
+    while position < len(numbers):
+        count = numbers[position]
+        doc_positions.append(list(accumulate(numbers[position + 1:position + 1 + count])))
+        position += 1 + count
+    return doc_positions
+
+
+def phrase_match(word_positions: List[List[int]], offsets: List[int] = None) -> bool:
+    """Whether the i-th word occurs at some position p + offsets[i] for all words"""
+    if offsets is None:
+        offsets = range(len(word_positions))
+    starts = set(word_positions[0])
+    for offset, positions in zip(offsets[1:], word_positions[1:]):
+        starts &= {position - offset for position in positions}
+        if not starts:
+            return False
+    return True
+
+
+def near_match(left: List[int], right: List[int], distance: int) -> bool:
+    """Whether positions from two sorted lists are at most distance apart"""
+    left_position, right_position = 0, 0
+    while left_position < len(left) and right_position < len(right):
+        if abs(left[left_position] - right[right_position]) <= distance:
+            return True
+        if left[left_position] < right[right_position]:
+            left_position += 1
+        else:
+            right_position += 1
+    return False
+
+
+def sidecar_path(filepath: str, suffix: str) -> str:
+    """Path of a file stored next to the index file"""
+    return f'{filepath}.{suffix}'
+
+
+SIDECAR_SUFFIXES = ('scores', 'ngrams', 'positions', 'analyzer', 'pairs')
+
+
+def remove_stale_sidecars(filepath: str, keep: Iterable[str] = ()) -> None:
+    """Remove files left next to the index by a previous build except the kept ones"""
+    for suffix in SIDECAR_SUFFIXES:
+        if suffix not in keep and os.path.exists(sidecar_path(filepath, suffix)):
+            os.remove(sidecar_path(filepath, suffix))
+
+
+def index_fingerprint(filepath: str) -> List[int]:
+    """Size and modification time of the index file telling a rebuilt index from the original one"""
+    stat = os.stat(filepath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class PostingCursor:
+    """Position in a sorted posting list with term frequencies for top-k evaluation"""
+    def __init__(self, doc_ids: List[int], term_freqs: List[int], idf: float, max_score: float):
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.idf = idf
+        self.max_score = max_score
+        self.position = 0
+
+    @property
+    def doc_id(self):
+        """Current doc id or None if the cursor is exhausted"""
+        if self.position < len(self.doc_ids):
+            return self.doc_ids[self.position]
+        return None
+
+    @property
+    def term_freq(self) -> int:
+        return self.term_freqs[self.position]
+
+    def advance_to(self, doc_id: int) -> None:
+        """Move to the first posting not less than doc_id"""
+        self.position = bisect_left(self.doc_ids, doc_id, self.position)
+
+
+class QueryCache:
+    """Bounded LRU cache of query results
+
+    Both the number of cached queries and the total number of cached doc
+    ids are limited, the least recently used results are evicted first.
+    """
+    def __init__(self, max_entries: int, max_postings: int = None):
+        self.max_entries = max_entries
+        self.max_postings = max_postings
+        self.results = OrderedDict()
+        self.n_postings = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.results)
+
+    def get(self, key: Tuple[str, ...]):
+        """Cached result or None"""
+        result = self.results.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.results.move_to_end(key)
+        return result
+
+    def put(self, key: Tuple[str, ...], result: Tuple[int, ...]) -> None:
+        if self.max_postings is not None and len(result) > self.max_postings:
+            return
+        if key in self.results:
+            self.n_postings -= len(self.results.pop(key))
+        self.results[key] = result
+        self.n_postings += len(result)
+        while len(self.results) > self.max_entries or (
+                self.max_postings is not None and self.n_postings > self.max_postings):
+            _, evicted = self.results.popitem(last=False)
+            self.n_postings -= len(evicted)
+
+    def clear(self) -> None:
+        self.results.clear()
+        self.n_postings = 0
+
+    def info(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.results),
+                'postings': self.n_postings}
+
+
+class SortedVocabulary:
+    """Sorted words of an index for prefix lookups by binary search"""
+    def __init__(self, words: Iterable[str]):
+        self.words = sorted(words)
+
+    def iter_prefix(self, prefix: str) -> Iterator[str]:
+        """Words starting with the prefix in sorted order"""
+        for position in range(bisect_left(self.words, prefix), len(self.words)):
+            if not self.words[position].startswith(prefix):
+                return
+            yield self.words[position]
+
+
+def wildcard_to_regex(pattern: str):
+    """Compile pattern where "*" matches any sequence of characters"""
+    return re.compile('.*'.join(re.escape(part) for part in pattern.split('*')), re.DOTALL)
+
+
+def bounded_levenshtein(left: str, right: str, max_distance: int):
+    """Edit distance between the words or None if it is greater than max_distance
+
+    Only the diagonal band of width 2 * max_distance + 1 of the dynamic
+    programming table is computed, the computation stops as soon as the
+    whole row exceeds max_distance.
+    """
+    if abs(len(left) - len(right)) > max_distance:
+        return None
+    too_far = max_distance + 1
+    previous = [column if column <= max_distance else too_far for column in range(len(right) + 1)]
+    for row in range(1, len(left) + 1):
+        current = [too_far] * (len(right) + 1)
+        current[0] = row if row <= max_distance else too_far
+        for column in range(max(1, row - max_distance), min(len(right), row + max_distance) + 1):
+            cost = 0 if left[row - 1] == right[column - 1] else 1
+            current[column] = min(previous[column] + 1, current[column - 1] + 1,
+                                  previous[column - 1] + cost, too_far)
+        if min(current) > max_distance:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= max_distance else None
+
+
+class NgramIndex:
+    """Character trigram index over the vocabulary for typo-tolerant lookups
+
+    Words are padded with "$", so a word of length L has at most L
+    distinct trigrams and one edit destroys at most 3 of them. A word
+    within edit distance k of the query therefore shares at least
+    n_trigrams(query) - 3k trigrams with it, only words passing this
+    filter are checked with bounded Levenshtein distance. When the bound
+    is not positive a match may share no trigram, then every word whose
+    length differs from the query by at most k is checked instead.
+    """
+    n = 3
+
+    def __init__(self, words: Iterable[str], grams: Dict[str, List[int]] = None):
+        self.words = sorted(words)
+        if grams is None:
+            grams = defaultdict(list)
+            for word_id, word in enumerate(self.words):
+                for gram in self.ngrams(word):
+                    grams[gram].append(word_id)
+            grams = dict(grams)
+        self.grams = grams
+        self.lengths = defaultdict(list)
+        for word_id, word in enumerate(self.words):
+            self.lengths[len(word)].append(word_id)
+
+    @classmethod
+    def ngrams(cls, word: str) -> set:
+        padded = f'${word}$'
+        return {padded[position:position + cls.n] for position in range(len(padded) - cls.n + 1)}
+
+    def similar(self, word: str, max_distance: int) -> List[str]:
+        """Words at the smallest edit distance from the word not greater than max_distance"""
+        grams = self.ngrams(word)
+        min_shared = len(grams) - self.n * max_distance
+        if min_shared > 0:
+            n_shared = Counter()
+            for gram in grams:
+                n_shared.update(self.grams.get(gram, ()))
+            candidates = [word_id for word_id, count in n_shared.items() if count >= min_shared]
+        else:
+            candidates = [word_id for length in range(len(word) - max_distance, len(word) + max_distance + 1)
+                          for word_id in self.lengths.get(length, ())]
+
+        best_distance, best_words = max_distance + 1, []
+        for word_id in candidates:
+            distance = bounded_levenshtein(word, self.words[word_id], min(max_distance, best_distance))
+            if distance is None or distance > best_distance:
+                continue
+            if distance < best_distance:
+                best_distance, best_words = distance, []
+            best_words.append(self.words[word_id])
+        return sorted(best_words)
+
+    def dump(self, filepath: str) -> None:
+        with open(filepath, 'w') as fio:
+            json.dump({'words': self.words, 'grams': self.grams}, fio)
+
+    @classmethod
+    def load(cls, filepath: str) -> NgramIndex:
+        with open(filepath) as fio:
+            data = json.load(fio)
+        return cls(data['words'], data['grams'])
+
+
+class PairCache:
+    """Precomputed intersections of word pairs frequent in a query log
+
+    Pairs are keyed by the sorted tuple of two analyzed words, a query
+    containing both words of a cached pair starts from its intersection.
+    On disk intersections are stored as variable-byte doc id gaps along
+    with the fingerprint of the index file they were computed from.
+    """
+    header_len_fmt_str = '> I'
+
+    def __init__(self, pairs: Dict[Tuple[str, str], List[int]] = None, fingerprint: List[int] = None):
+        self.pairs = pairs if pairs is not None else {}
+        self.fingerprint = fingerprint
+
+    def __len__(self) -> int:
+        return len(self.pairs)
+
+    def __contains__(self, pair) -> bool:
+        return pair in self.pairs
+
+    def get(self, pair: Tuple[str, str]):
+        return self.pairs.get(pair)
+
+    def n_bytes(self) -> int:
+        """Memory taken by doc ids of all the intersections"""
+        return sum(doc_ids.itemsize * len(doc_ids) for doc_ids in self.pairs.values())
+
+    def best_pair(self, words: Tuple[str, ...]):
+        """Cached pair of the query words with the shortest intersection or None"""
+        best = None
+        for pair in combinations(words, 2):
+            doc_ids = self.pairs.get(pair)
+            if doc_ids is not None and (best is None or len(doc_ids) < len(self.pairs[best])):
+                best = pair
+        return best
+
+    @classmethod
+    def build(cls, inverted_index: InvertedIndex, pair_counts: Counter, memory_budget: int,
+              min_count: int = 2) -> PairCache:
+        """Cache intersections of the most frequent pairs fitting into memory_budget bytes
+
+        Pairs are taken in order of decreasing frequency, a pair which does
+        not fit is skipped in favour of less frequent pairs with shorter
+        intersections.
+        """
+        pairs, n_bytes = {}, 0
+        for (first, second), count in pair_counts.most_common():
+            if count < min_count:
+                break
+            if first not in inverted_index.index or second not in inverted_index.index:
+                continue
+            doc_ids = compact_postings(sorted_sequence(
+                intersect_sorted(inverted_index.index[first], inverted_index.index[second])))
+            size = doc_ids.itemsize * len(doc_ids)
+            if n_bytes + size > memory_budget:
+                continue
+            pairs[first, second] = doc_ids
+            n_bytes += size
+        return cls(pairs)
+
+    def dump(self, filepath: str, fingerprint: List[int]) -> None:
+        directory = []
+        with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as body:
+            for (first, second), doc_ids in self.pairs.items():
+                chunk = encode_varbyte(doc_id - previous for previous, doc_id
+                                       in zip(chain((0,), doc_ids), doc_ids))
+                directory.append([first, second, len(doc_ids), len(chunk)])
+                body.write(chunk)
+            header = json.dumps({'index': fingerprint, 'pairs': directory}).encode('utf-8')
+            write_with_header(filepath, self.header_len_fmt_str, header, body)
+
+    @classmethod
+    def load(cls, filepath: str) -> PairCache:
+        with open(filepath, 'rb') as fio:
+            buffer = fio.read()
+        position = calcsize(cls.header_len_fmt_str)
+        header_length, = unpack_from(cls.header_len_fmt_str, buffer)
+        header = json.loads(buffer[position:position + header_length].decode('utf-8'))
+        position += header_length
+        pairs = {}
+        for first, second, n_docs, n_bytes in header['pairs']:
+            gaps = decode_varbyte(buffer[position:position + n_bytes], n_docs)
+            pairs[first, second] = compact_postings(accumulate(gaps))
+            position += n_bytes
+        return cls(pairs, header['index'])
+
+
+def mine_term_pairs(queries: Iterable[Iterable[str]], analyzer: Analyzer = None) -> Counter:
+    """Count queries containing every pair of distinct analyzed words, wildcards are left out"""
+    pair_counts = Counter()
+    for words in queries:
+        words = [word for word in normalize_query(words, analyzer) if '*' not in word]
+        pair_counts.update(combinations(words, 2))
+    return pair_counts
+
+
+def normalize_query(words: Iterable[str], analyzer: Analyzer = None) -> Tuple[str, ...]:
+    """Order insensitive key of the query: sorted unique analyzed words"""
+    return tuple(sorted(set((analyzer or Analyzer()).analyze_query(words))))
+
+
+class InvertedIndex:
+    def __init__(self, index: Dict[str, List[int]], storage_policy='json',
+                 term_freqs: Dict[str, List[int]] = None, doc_lengths: Dict[int, int] = None):
+        self.cache = None
+        self.pair_cache = None
+        self.vocabulary = None
+        self.max_expansions = WILDCARD_MAX_EXPANSIONS
+        self.ngram_index = None
+        self.fuzzy_distance = 0
+        self.positions = None
+        self.analyzer = Analyzer()
+        self.index = index
+        self.storage_policy = storage_policy.lower()
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.max_scores = {}
+        self.scores_path = None
+        self.collection = None
+
+    @property
+    def index(self):
+        return self._index
+
+    @index.setter
+    def index(self, index):
+        """Replacing postings drops the cached query results and pair intersections"""
+        self._index = index
+        self.pair_cache = None
+        self.invalidate_cache()
+
+    def expand_wildcard(self, pattern: str) -> List[str]:
+        """Words matching the pattern with "*" wildcards
+
+        Candidates are the words starting with the part of the pattern
+        before the first "*", found by binary search in the sorted
+        vocabulary. At most max_expansions words are returned and at most
+        WILDCARD_MAX_SCANNED candidates are checked.
+        """
+        prefix = pattern.split('*', 1)[0]
+        if hasattr(self.index, 'iter_prefix'):
+            candidates = self.index.iter_prefix(prefix)
+        else:
+            if self.vocabulary is None:
+                self.vocabulary = SortedVocabulary(self.index)
+            candidates = self.vocabulary.iter_prefix(prefix)
+        regex = wildcard_to_regex(pattern)
+        expansions = []
+        for word in islice(candidates, WILDCARD_MAX_SCANNED):
+            if regex.fullmatch(word):
+                expansions.append(word)
+                if len(expansions) == self.max_expansions:
+                    break
+        return expansions
+
+    def enable_fuzzy(self, max_distance: int) -> None:
+        """Replace unknown query words by the closest words within max_distance edits"""
+        if self.ngram_index is None:
+            self.ngram_index = NgramIndex(self.index)
+        self.fuzzy_distance = max_distance
+        self.invalidate_cache()
+
+    def postings(self, word: str) -> List[int]:
+        """Sorted doc ids of the word
+
+        Wildcard expansions of a word with "*" are united, in fuzzy mode
+        so are the closest words to an unknown word.
+        """
+        if '*' in word:
+            return union_sorted([self.index[expansion] for expansion in self.expand_wildcard(word)])
+        if word in self.index:
+            return self.index[word]
+        return union_sorted([self.index[similar] for similar in self.matching_words(word)])
+
+    def matching_words(self, word: str) -> List[str]:
+        """Indexed words matching a word without wildcards, in fuzzy mode the closest ones to an unknown word"""
+        if word in self.index:
+            return [word]
+        if self.fuzzy_distance:
+            return [similar for similar in self.ngram_index.similar(word, self.fuzzy_distance)
+                    if similar in self.index]
+        return []
+
+    def enable_cache(self, max_entries: int, max_postings: int = None) -> QueryCache:
+        """Cache results of query in a bounded LRU cache"""
+        self.cache = QueryCache(max_entries, max_postings)
+        return self.cache
+
+    def invalidate_cache(self) -> None:
+        """Drop cached query results, must be called after the postings are changed in place"""
+        self.vocabulary = None
+        if self.cache is not None:
+            self.cache.clear()
+
+    def __eq__(self, other):
+        if set(self.index.keys()) != set(other.index.keys()):
+            return False
+        for key, value in self.index.items():
+            if sorted(value) != sorted(other.index[key]):
+                return False
+        return True
+
+    def query(self, words: List[str]) -> List[int]:
+        """Return the sorted list of relevant documents for the given query
+
+        Posting lists are intersected from the rarest word to the most
+        frequent one and the intersection stops as soon as it is empty.
+        A cached intersection of a pair of the words replaces their lists.
+        Words are analyzed like the indexed documents, a word with "*"
+        matches any of its wildcard expansions.
+        """
+        words = normalize_query(words, self.analyzer)
+        if not words:
+            return []
+        if self.cache is None:
+            return self._intersect_words(words)
+        result = self.cache.get(words)
+        if result is None:
+            result = tuple(self._intersect_words(words))
+            self.cache.put(words, result)
+        return list(result)
+
+    def _intersect_words(self, words: Tuple[str, ...]) -> List[int]:
+        postings = []
+        pair = self.pair_cache.best_pair(words) if self.pair_cache is not None else None
+        if pair is not None:
+            postings.append(self.pair_cache.get(pair))
+            words = [word for word in words if word not in pair]
+        for word in words:
+            doc_ids = self.postings(word)
+            if not doc_ids:
+                return []
+            postings.append(doc_ids)
+
+        postings.sort(key=len)
+        possible = postings[0]
+        for doc_ids in postings[1:]:
+            if not possible:
+                break
+            possible = intersect_sorted(possible, doc_ids)
+        return list(possible)
+
+    def document_frequency(self, word: str) -> int:
+        """Number of documents containing the word, without decoding lazy postings"""
+        if '*' in word:
+            return sum(self.document_frequency(expansion) for expansion in self.expand_wildcard(word))
+        if self.fuzzy_distance and word not in self.index:
+            return len(self.postings(word))
+        if hasattr(self.index, 'document_frequency'):
+            return self.index.document_frequency(word)
+        if word not in self.index:
+            return 0
+        return len(self.index[word])
+
+    def query_boolean(self, expression: str) -> List[int]:
+        """Return the sorted list of documents matching the boolean expression
+
+        Operands of AND are evaluated from the most selective one, NOT
+        operands are subtracted from the intersection, and evaluation
+        stops as soon as a partial result is empty.
+        """
+        node = BooleanQueryParser(expression, self.analyzer).parse()
+        return list(self._evaluate(node)) if node is not None else []
+
+    def _estimate(self, node) -> int:
+        """Upper bound of the number of documents matching the node"""
+        if isinstance(node, TermNode):
+            return self.document_frequency(node.word)
+        if isinstance(node, AndNode):
+            positive = [child for child in node.children if not isinstance(child, NotNode)]
+            if not positive:
+                raise ValueError('NOT must be combined with a positive operand by AND')
+            return min(self._estimate(child) for child in positive)
+        if isinstance(node, OrNode):
+            return sum(self._estimate(child) for child in node.children)
+        if isinstance(node, (PhraseNode, NearNode)):
+            return min(self.document_frequency(word) for word in node.words)
+        raise ValueError('NOT must be combined with a positive operand by AND')
+
+    def _evaluate_positional(self, node) -> List[int]:
+        """Documents with all the words, verified against word positions
+
+        Posting lists are intersected first and only positions of the
+        candidate documents are decoded, unless the candidates are a large
+        part of the documents of a word. In fuzzy mode an unknown word is at the positions of any of the
+        closest words.
+        """
+        if self.positions is None:
+            raise ValueError('Index was built without positions, rebuild it with --positions')
+        words = list(dict.fromkeys(node.words))
+        candidates = self._intersect_words(tuple(words))
+        if not candidates:
+            return []
+        matching_words = {word: self.matching_words(word) for word in words}
+        indexed_words = {indexed_word for indexed_words in matching_words.values() for indexed_word in indexed_words}
+        postings = {word: sorted_sequence(self.index[word]) for word in indexed_words}
+        # positions of a word are decoded at once if a large part of its documents are candidates
+        decoded = {word: self.positions[word] for word in indexed_words
+                   if not isinstance(self.positions, PositionsFile)
+                   or len(candidates) * PositionsFile.skip_interval >= len(postings[word])}
+        result = []
+        for doc_id in candidates:
+            doc_positions = {}
+            for word in words:
+                word_positions = []
+                for indexed_word in matching_words[word]:
+                    rank = bisect_left(postings[indexed_word], doc_id)
+                    if rank < len(postings[indexed_word]) and postings[indexed_word][rank] == doc_id:
+                        word_positions.extend(decoded[indexed_word][rank] if indexed_word in decoded else
+                                              self.positions.document_positions(indexed_word, rank))
+                doc_positions[word] = sorted(word_positions) if len(matching_words[word]) > 1 else word_positions
+            if isinstance(node, PhraseNode):
+                matched = phrase_match([doc_positions[word] for word in node.words], node.offsets)
+            else:
+                matched = near_match(doc_positions[node.words[0]], doc_positions[node.words[1]], node.distance)
+            if matched:
+                result.append(doc_id)
+        return result
+
+    def _evaluate(self, node) -> List[int]:
+        if isinstance(node, TermNode):
+            return self.postings(node.word)
+        if isinstance(node, OrNode):
+            postings = [self._evaluate(child) for child in node.children]
+            return union_sorted([doc_ids for doc_ids in postings if doc_ids])
+        if isinstance(node, NotNode):
+            raise ValueError('NOT must be combined with a positive operand by AND')
+        if isinstance(node, (PhraseNode, NearNode)):
+            return self._evaluate_positional(node)
+
+        positive = [child for child in node.children if not isinstance(child, NotNode)]
+        negative = [child.child for child in node.children if isinstance(child, NotNode)]
+        if not positive:
+            raise ValueError('NOT must be combined with a positive operand by AND')
+        estimates = [(self._estimate(child), position) for position, child in enumerate(positive)]
+        estimates.sort()
+        if estimates[0][0] == 0:
+            return []
+        result = self._evaluate(positive[estimates[0][1]])
+        for _, position in estimates[1:]:
+            if not result:
+                return []
+            result = intersect_sorted(result, self._evaluate(positive[position]))
+        for child in sorted(negative, key=self._estimate, reverse=True):
+            if not result:
+                return []
+            result = difference_sorted(result, self._evaluate(child))
+        return list(result)
+
+    def load_scores(self) -> None:
+        """Read term frequencies and document lengths of a loaded index, done on first use"""
+        if self.scores_path is None:
+            return
+        with open(self.scores_path) as fio:
+            scores = json.load(fio)
+        self.scores_path = None
+        self.term_freqs = scores['term_freqs']
+        self.doc_lengths = dict(scores['doc_lengths'])
+        self.max_scores = scores['max_scores']
+        self.collection = scores.get('collection')
+
+    @property
+    def has_scores(self) -> bool:
+        return self.term_freqs is not None and self.doc_lengths is not None
+
+    def _bm25_params(self) -> Tuple[int, float]:
+        """Number of documents and average document length, of the whole collection if it is set"""
+        if self.collection is not None:
+            return self.collection['n_docs'], self.collection['avg_length']
+        n_docs = len(self.doc_lengths)
+        avg_length = sum(self.doc_lengths.values()) / n_docs if n_docs else 0.0
+        return n_docs, avg_length or 1.0
+
+    @staticmethod
+    def _bm25(term_freq: int, doc_length: int, avg_length: float) -> float:
+        """BM25 term frequency saturation without IDF"""
+        norm = BM25_K1 * (1.0 - BM25_B + BM25_B * doc_length / avg_length)
+        return term_freq * (BM25_K1 + 1.0) / (term_freq + norm)
+
+    def compute_max_scores(self) -> None:
+        """Precompute the upper bound of the BM25 term weight of every word"""
+        _, avg_length = self._bm25_params()
+        self.max_scores = {}
+        for word, doc_ids in self.index.items():
+            term_freqs = self.term_freqs[word]
+            self.max_scores[word] = max(
+                (self._bm25(term_freq, self.doc_lengths[doc_id], avg_length)
+                 for doc_id, term_freq in zip(doc_ids, term_freqs)),
+                default=0.0,
+            )
+
+    def search(self, words: List[str], top: int) -> List[Tuple[int, float]]:
+        """Return top documents containing any of the words ranked by BM25
+
+        Evaluation is document-at-a-time with WAND pruning: a document is
+        scored only if the sum of the score upper bounds of the words which
+        can still reach it beats the current top-th score.
+        """
+        self.load_scores()
+        if not self.has_scores:
+            raise ValueError('Index was built without term frequencies, rebuild it with --bm25')
+        n_docs, avg_length = self._bm25_params()
+        cursors = []
+        for word in dict.fromkeys(self.analyzer.analyze_query(words)):
+            if word not in self.index:
+                continue
+            doc_ids = sorted_sequence(self.index[word])
+            n_word_docs = len(doc_ids) if self.collection is None else self.collection['document_frequencies'][word]
+            idf = math.log(1.0 + (n_docs - n_word_docs + 0.5) / (n_word_docs + 0.5))
+            if word not in self.max_scores:
+                self.compute_max_scores()
+            cursors.append(PostingCursor(doc_ids, self.term_freqs[word], idf, idf * self.max_scores[word]))
+
+        top_scores = []
+        while top > 0:
+            cursors = [cursor for cursor in cursors if cursor.doc_id is not None]
+            cursors.sort(key=lambda cursor: cursor.doc_id)
+            threshold = top_scores[0][0] if len(top_scores) == top else 0.0
+            upper_bound, pivot = 0.0, None
+            for position, cursor in enumerate(cursors):
+                upper_bound += cursor.max_score
+                if upper_bound > threshold:
+                    pivot = position
+                    break
+            if pivot is None:
+                break
+
+            pivot_doc_id = cursors[pivot].doc_id
+            if cursors[0].doc_id != pivot_doc_id:
+                for cursor in cursors[:pivot]:
+                    cursor.advance_to(pivot_doc_id)
+                continue
+
+            score = 0.0
+            for cursor in cursors:
+                if cursor.doc_id != pivot_doc_id:
+                    break
+                score += cursor.idf * self._bm25(cursor.term_freq, self.doc_lengths[pivot_doc_id], avg_length)
+                cursor.position += 1
+            if len(top_scores) < top:
+                heapq.heappush(top_scores, (score, -pivot_doc_id))
+            elif score > threshold:
+                heapq.heapreplace(top_scores, (score, -pivot_doc_id))
+        return [(-negative_doc_id, score) for score, negative_doc_id in sorted(top_scores, reverse=True)]
+
+    def dump(self, filepath: str) -> None:
+        """Save the index and its sidecar files, sidecars of a previous index are removed"""
+        if self.storage_policy not in STORAGE_POLICIES:
+            raise ValueError(f'Unknown storage policy: {self.storage_policy}')
+        self.load_scores()
+        STORAGE_POLICIES[self.storage_policy].dump(self.index, filepath)
+        written = []
+        if self.has_scores:
+            written.append('scores')
+            if not self.max_scores:
+                self.compute_max_scores()
+            with open(sidecar_path(filepath, 'scores'), 'w') as fio:
+                json.dump({
+                    'term_freqs': self.term_freqs,
+                    'doc_lengths': list(self.doc_lengths.items()),
+                    'max_scores': self.max_scores,
+                    'collection': self.collection,
+                }, fio)
+        if self.ngram_index is not None:
+            written.append('ngrams')
+            self.ngram_index.dump(sidecar_path(filepath, 'ngrams'))
+        if self.positions is not None:
+            written.append('positions')
+            PositionsFile.dump(self.positions, sidecar_path(filepath, 'positions'))
+        if self.analyzer != Analyzer():
+            written.append('analyzer')
+            self.analyzer.dump(sidecar_path(filepath, 'analyzer'))
+        if self.pair_cache is not None:
+            written.append('pairs')
+            self.pair_cache.dump(sidecar_path(filepath, 'pairs'), index_fingerprint(filepath))
+        remove_stale_sidecars(filepath, keep=written)
+
+    @classmethod
+    def load(cls, filepath: str, storage_policy) -> InvertedIndex:
+        """Load Inverted Index from filepath"""
+        storage_policy = storage_policy.lower()
+        if storage_policy not in STORAGE_POLICIES:
+            raise ValueError(f'Unknown storage policy: {storage_policy}')
+        inverted_index = STORAGE_POLICIES[storage_policy].load(filepath)
+        if os.path.exists(sidecar_path(filepath, 'scores')):
+            inverted_index.scores_path = sidecar_path(filepath, 'scores')
+        if os.path.exists(sidecar_path(filepath, 'ngrams')):
+            inverted_index.ngram_index = NgramIndex.load(sidecar_path(filepath, 'ngrams'))
+        if os.path.exists(sidecar_path(filepath, 'positions')):
+            inverted_index.positions = PositionsFile.load(sidecar_path(filepath, 'positions'))
+        if os.path.exists(sidecar_path(filepath, 'analyzer')):
+            inverted_index.analyzer = Analyzer.load(sidecar_path(filepath, 'analyzer'))
+        if os.path.exists(sidecar_path(filepath, 'pairs')):
+            pair_cache = PairCache.load(sidecar_path(filepath, 'pairs'))
+            # intersections of a rebuilt index are stale and ignored
+            if pair_cache.fingerprint == index_fingerprint(filepath):
+                inverted_index.pair_cache = pair_cache
+        return inverted_index
+
+
+class NumpyBatchEngine:
+    """Batch query engine over posting lists viewed as NumPy arrays
+
+    Words of the whole batch are decoded once, array postings are viewed
+    without copying, and intersections are vectorized: every doc id of the
+    shorter list is looked up in the longer one with searchsorted.
+    Requires NumPy, which is an optional dependency.
+    """
+    def __init__(self, inverted_index: InvertedIndex):
+        if np is None:
+            raise ImportError('NumPy is required by the numpy query engine')
+        if not isinstance(inverted_index, InvertedIndex):
+            raise ValueError('numpy query engine supports only a single index file')
+        self.inverted_index = inverted_index
+
+    @staticmethod
+    def to_numpy(doc_ids) -> np.ndarray:
+        if isinstance(doc_ids, BitmapPostings):
+            bits = np.unpackbits(np.frombuffer(doc_ids.bits, dtype=np.uint8), bitorder='little')
+            return np.flatnonzero(bits).astype(np.uint32 if len(bits) <= 2 ** 32 else np.uint64)
+        if not isinstance(doc_ids, array):
+            doc_ids = compact_postings(doc_ids)
+        return np.frombuffer(doc_ids, dtype=np.uint32 if doc_ids.typecode == 'I' else np.uint64)
+
+    @staticmethod
+    def intersect(left: np.ndarray, right: np.ndarray) -> np.ndarray:
+        if len(left) > len(right):
+            left, right = right, left
+        if not len(left):
+            return left
+        positions = np.minimum(np.searchsorted(right, left), len(right) - 1)
+        return left[right[positions] == left]
+
+    def query_batch(self, queries: List[List[str]]) -> List[List[int]]:
+        """Answer every query of the batch like InvertedIndex.query"""
+        keys = [normalize_query(words, self.inverted_index.analyzer) for words in queries]
+        words = {word for key in keys for word in key}
+        postings = {word: self.to_numpy(self.inverted_index.postings(word)) for word in words}
+        results = {}
+        for key in dict.fromkeys(keys):
+            if not key:
+                results[key] = []
+                continue
+            candidates = sorted((postings[word] for word in key), key=len)
+            result = candidates[0]
+            for doc_ids in candidates[1:]:
+                if not len(result):
+                    break
+                result = self.intersect(result, doc_ids)
+            results[key] = result.tolist()
+        return [results[key] for key in keys]
+
+
+def write_doc_ids(filepath: str, doc_ids: List[int]) -> None:
+    """Save sorted doc ids as variable-byte d-gaps"""
+    with open(filepath, 'wb') as fio:
+        fio.write(encode_varbyte(doc_id - previous for previous, doc_id in zip([0] + doc_ids, doc_ids)))
+
+
+def read_doc_ids(filepath: str) -> List[int]:
+    with open(filepath, 'rb') as fio:
+        return list(accumulate(decode_varbyte(fio.read())))
+
+
+def write_json_atomically(data, filepath: str) -> None:
+    """Replace the file so that readers never see a partially written one"""
+    with open(f'{filepath}.tmp', 'w') as fio:
+        json.dump(data, fio)
+    os.replace(f'{filepath}.tmp', filepath)
+
+
+class Segment:
+    """Immutable inverted index of a batch of documents with a deletion bitmap
+
+    Bit i of the bitmap marks the i-th smallest doc id of the segment as
+    deleted, deleted documents are filtered out of query results.
+    """
+    def __init__(self, name: str, inverted_index: InvertedIndex, doc_ids: List[int], deleted: bytearray):
+        self.name = name
+        self.inverted_index = inverted_index
+        self.doc_ids = doc_ids
+        self.deleted = deleted
+
+    @property
+    def n_deleted(self) -> int:
+        return sum(bin(byte).count('1') for byte in self.deleted)
+
+    def _ordinal(self, doc_id: int):
+        ordinal = bisect_left(self.doc_ids, doc_id)
+        if ordinal < len(self.doc_ids) and self.doc_ids[ordinal] == doc_id:
+            return ordinal
+        return None
+
+    def is_deleted(self, doc_id: int) -> bool:
+        ordinal = self._ordinal(doc_id)
+        return ordinal is None or bool(self.deleted[ordinal >> 3] >> (ordinal & 7) & 1)
+
+    def delete(self, doc_ids: Iterable[int]) -> int:
+        """Mark documents of the segment as deleted, return number of newly deleted ones"""
+        n_deleted = 0
+        for doc_id in doc_ids:
+            ordinal = self._ordinal(doc_id)
+            if ordinal is not None and not self.deleted[ordinal >> 3] >> (ordinal & 7) & 1:
+                self.deleted[ordinal >> 3] |= 1 << (ordinal & 7)
+                n_deleted += 1
+        return n_deleted
+
+    def deleted_since(self, snapshot: bytearray) -> List[int]:
+        """Doc ids deleted after the snapshot of the deletion bitmap was taken"""
+        return [doc_id for ordinal, doc_id in enumerate(self.doc_ids)
+                if (self.deleted[ordinal >> 3] & ~snapshot[ordinal >> 3]) >> (ordinal & 7) & 1]
+
+    def live(self, doc_ids: Iterable[int]) -> List[int]:
+        if not any(self.deleted):
+            return list(doc_ids)
+        return [doc_id for doc_id in doc_ids if not self.is_deleted(doc_id)]
+
+
+class SegmentedIndex:
+    """Updatable inverted index stored as a directory of segments
+
+    Added documents are written as a new small segment, deleted or
+    replaced documents are marked in the deletion bitmaps of older
+    segments, and queries are answered by every segment. Segments are
+    compacted by merge, which can run in a background thread while the
+    index is queried and updated. Updates of the manifest and deletion
+    bitmaps hold a lock file, so they can run in several processes; the
+    state changed by other processes is re-read under the lock.
+    """
+    manifest_name = 'manifest.json'
+    lock_name = 'lock'
+    default_max_segments = 8
+    default_merge_factor = 4
+
+    def __init__(self, directory: str, storage_policy='struct', max_segments: int = None,
+                 merge_factor: int = None):
+        self.directory = str(directory)
+        self.storage_policy = storage_policy.lower()
+        self.max_segments = max_segments or self.default_max_segments
+        self.merge_factor = merge_factor or self.default_merge_factor
+        self.segments = []
+        self.next_segment = 1
+        self.lock = threading.RLock()
+        self.merge_lock = threading.Lock()
+        self._lock_file = None
+        self.cache_params = None
+        self._max_expansions = WILDCARD_MAX_EXPANSIONS
+        self.fuzzy_distance = 0
+        if os.path.exists(os.path.join(self.directory, self.manifest_name)):
+            self._load_manifest(max_segments, merge_factor)
+
+    @classmethod
+    def load(cls, directory: str) -> SegmentedIndex:
+        return cls(directory)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _load_manifest(self, max_segments: int = None, merge_factor: int = None) -> None:
+        """Load segments, merge policy given explicitly overrides the saved one"""
+        with open(self._path(self.manifest_name)) as fio:
+            manifest = json.load(fio)
+        self.storage_policy = manifest['storage_policy']
+        self.max_segments = max_segments or manifest['max_segments']
+        self.merge_factor = merge_factor or manifest['merge_factor']
+        self.next_segment = manifest['next_segment']
+        self.segments = [self._load_segment(name) for name in manifest['segments']]
+
+    def _load_segment(self, name: str) -> Segment:
+        inverted_index = self._configure(InvertedIndex.load(self._path(f'{name}.index'), self.storage_policy))
+        doc_ids = read_doc_ids(self._path(f'{name}.docs'))
+        return Segment(name, inverted_index, doc_ids, self._read_deletions(name))
+
+    def _configure(self, inverted_index: InvertedIndex) -> InvertedIndex:
+        """Apply query settings of the segmented index to the index of a segment"""
+        if self.cache_params is not None:
+            inverted_index.enable_cache(*self.cache_params)
+        inverted_index.max_expansions = self.max_expansions
+        if self.fuzzy_distance:
+            inverted_index.enable_fuzzy(self.fuzzy_distance)
+        return inverted_index
+
+    @property
+    def max_expansions(self) -> int:
+        return self._max_expansions
+
+    @max_expansions.setter
+    def max_expansions(self, max_expansions: int) -> None:
+        """Maximum number of words a wildcard is expanded to in every segment"""
+        self._max_expansions = max_expansions
+        for segment in self.segments:
+            segment.inverted_index.max_expansions = max_expansions
+
+    def _read_deletions(self, name: str) -> bytearray:
+        with open(self._path(f'{name}.deleted'), 'rb') as fio:
+            return bytearray(fio.read())
+
+    @contextmanager
+    def _locked(self):
+        """Hold the thread lock and the lock file of the directory shared with other processes
+
+        The state is re-read from the directory once the lock is taken.
+        """
+        with self.lock:
+            if self._lock_file is not None:
+                yield
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._path(self.lock_name), 'a') as self._lock_file:
+                try:
+                    if fcntl is not None:
+                        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+                    self._reload()
+                    yield
+                finally:
+                    self._lock_file = None
+
+    def _reload(self) -> None:
+        """Pick up segments, segment numbers and deletions written by other processes"""
+        if not os.path.exists(self._path(self.manifest_name)):
+            return
+        with open(self._path(self.manifest_name)) as fio:
+            manifest = json.load(fio)
+        self.next_segment = manifest['next_segment']
+        loaded = {segment.name: segment for segment in self.segments}
+        segments = []
+        for name in manifest['segments']:
+            segment = loaded.get(name)
+            if segment is None:
+                segment = self._load_segment(name)
+            else:
+                segment.deleted = self._read_deletions(name)
+            segments.append(segment)
+        self.segments = segments
+
+    def _write_segment(self, index: Dict[str, List[int]], doc_ids: List[int]) -> Segment:
+        with self._locked():
+            name = f'segment_{self.next_segment:06d}'
+            self.next_segment += 1
+            # the number is reserved before the segment is written outside of the lock
+            self._write_manifest()
+        inverted_index = InvertedIndex(index, self.storage_policy)
+        inverted_index.dump(self._path(f'{name}.index'))
+        self._configure(inverted_index)
+        write_doc_ids(self._path(f'{name}.docs'), doc_ids)
+        segment = Segment(name, inverted_index, doc_ids, bytearray((len(doc_ids) + 7) // 8))
+        self._write_deletions(segment)
+        return segment
+
+    def _write_deletions(self, segment: Segment) -> None:
+        filepath = self._path(f'{segment.name}.deleted')
+        with open(f'{filepath}.tmp', 'wb') as fio:
+            fio.write(segment.deleted)
+        os.replace(f'{filepath}.tmp', filepath)
+
+    def _write_manifest(self) -> None:
+        write_json_atomically({
+            'kind': 'segmented',
+            'storage_policy': self.storage_policy,
+            'next_segment': self.next_segment,
+            'max_segments': self.max_segments,
+            'merge_factor': self.merge_factor,
+            'segments': [segment.name for segment in self.segments],
+        }, self._path(self.manifest_name))
+
+    def add(self, documents: Dict[int, str]) -> None:
+        """Add documents as a new segment, documents with the same ids are replaced"""
+        os.makedirs(self.directory, exist_ok=True)
+        doc_ids = sorted(documents)
+        segment = self._write_segment(build_inverted_index(documents).index, doc_ids)
+        with self._locked():
+            for old_segment in self.segments:
+                if old_segment.delete(doc_ids):
+                    self._write_deletions(old_segment)
+            self.segments = self.segments + [segment]
+            self._write_manifest()
+
+    def delete(self, doc_ids: Iterable[int]) -> int:
+        """Mark documents as deleted, return number of deleted documents"""
+        doc_ids = sorted(set(doc_ids))
+        n_deleted = 0
+        with self._locked():
+            for segment in self.segments:
+                n_segment_deleted = segment.delete(doc_ids)
+                if n_segment_deleted:
+                    self._write_deletions(segment)
+                    n_deleted += n_segment_deleted
+        return n_deleted
+
+    def _fan_out(self, method: str, *args) -> List[int]:
+        segments = self.segments
+        results = [segment.live(getattr(segment.inverted_index, method)(*args)) for segment in segments]
+        return union_sorted([doc_ids for doc_ids in results if doc_ids])
+
+    def query(self, words: List[str]) -> List[int]:
+        """Return the sorted list of live documents containing all the words"""
+        return self._fan_out('query', words)
+
+    def query_boolean(self, expression: str) -> List[int]:
+        """Return the sorted list of live documents matching the boolean expression"""
+        return self._fan_out('query_boolean', expression)
+
+    def search(self, words: List[str], top: int) -> List[Tuple[int, float]]:
+        raise ValueError('Ranked queries are not supported by segmented index')
+
+    def enable_cache(self, max_entries: int, max_postings: int = None) -> None:
+        """Cache query results of every segment, deletions are applied after the cache"""
+        self.cache_params = (max_entries, max_postings)
+        for segment in self.segments:
+            segment.inverted_index.enable_cache(max_entries, max_postings)
+
+    def enable_fuzzy(self, max_distance: int) -> None:
+        """Replace unknown query words by the closest words of each segment"""
+        self.fuzzy_distance = max_distance
+        for segment in self.segments:
+            segment.inverted_index.enable_fuzzy(max_distance)
+
+    def select_segments_to_merge(self) -> List[Segment]:
+        """Merge policy: once there are too many segments merge the smallest ones"""
+        segments = self.segments
+        if len(segments) <= self.max_segments:
+            return []
+        by_size = sorted(segments, key=lambda segment: len(segment.doc_ids) - segment.n_deleted)
+        return by_size[:self.merge_factor]
+
+    def merge(self, segments: List[Segment] = None) -> None:
+        """Compact segments into one, dropping deleted documents
+
+        Postings are merged outside of the lock, deletions which hit the
+        merged segments meanwhile, in this or another process, are replayed
+        on the new segment. The merge is dropped if another process has
+        merged some of the segments first.
+        """
+        with self.merge_lock:
+            with self._locked():
+                names = {segment.name for segment in segments or self.segments}
+                # segments selected concurrently may have been merged already
+                segments = [segment for segment in self.segments if segment.name in names]
+                if not segments or len(segments) < 2 and not any(segment.n_deleted for segment in segments):
+                    return
+                deleted_snapshot = [bytearray(segment.deleted) for segment in segments]
+            index, doc_ids = defaultdict(list), []
+            for segment, deleted in zip(segments, deleted_snapshot):
+                snapshot = Segment(segment.name, segment.inverted_index, segment.doc_ids, deleted)
+                doc_ids.append(snapshot.live(segment.doc_ids))
+                for word, word_doc_ids in segment.inverted_index.index.items():
+                    word_doc_ids = snapshot.live(word_doc_ids)
+                    if word_doc_ids:
+                        index[word].append(word_doc_ids)
+            merged_index = {word: union_sorted(postings) for word, postings in index.items()}
+            merged_segment = self._write_segment(merged_index, union_sorted(doc_ids))
+
+            with self._locked():
+                merged_names = {segment.name for segment in segments}
+                if len(merged_names & {segment.name for segment in self.segments}) < len(merged_names):
+                    for suffix in ('index', 'docs', 'deleted'):
+                        os.remove(self._path(f'{merged_segment.name}.{suffix}'))
+                    return
+                for segment, deleted in zip(segments, deleted_snapshot):
+                    merged_segment.delete(segment.deleted_since(deleted))
+                self._write_deletions(merged_segment)
+                position = min(position for position, segment in enumerate(self.segments)
+                               if segment.name in merged_names)
+                remaining = [segment for segment in self.segments if segment.name not in merged_names]
+                remaining.insert(position, merged_segment)
+                self.segments = remaining
+                self._write_manifest()
+            for segment in segments:
+                for suffix in ('index', 'docs', 'deleted'):
+                    os.remove(self._path(f'{segment.name}.{suffix}'))
+
+    def maybe_merge(self) -> None:
+        """Apply merge policy until it selects nothing"""
+        segments = self.select_segments_to_merge()
+        while segments:
+            self.merge(segments)
+            segments = self.select_segments_to_merge()
+
+    def start_background_merge(self) -> threading.Thread:
+        thread = threading.Thread(target=self.maybe_merge, name='segment-merge', daemon=True)
+        thread.start()
+        return thread
+
+
+def shard_of(doc_id: int, n_shards: int) -> int:
+    """Stable shard number of the document, the same in every process and host"""
+    return zlib.crc32(str(doc_id).encode('ascii')) % n_shards
+
+
+def build_sharded_index(documents: Dict[int, str], directory: str, n_shards: int,
+                        storage_policy='struct', fuzzy=False, **build_options) -> None:
+    """Build an inverted index per shard of documents partitioned by doc id hash
+
+    With scores every shard keeps the number of documents, the average
+    document length and the document frequencies of its words in the
+    whole collection, so BM25 scores do not depend on the partitioning.
+    """
+    partitions = [{} for _ in range(n_shards)]
+    for doc_id, content in documents.items():
+        partitions[shard_of(doc_id, n_shards)][doc_id] = content
+    os.makedirs(directory, exist_ok=True)
+    shards = [build_inverted_index(shard_documents, storage_policy, **build_options)
+              for shard_documents in partitions]
+    if all(shard.has_scores for shard in shards):
+        set_collection_statistics(shards)
+    names = []
+    for number, inverted_index in enumerate(shards):
+        name = f'shard_{number:04d}'
+        if fuzzy:
+            inverted_index.ngram_index = NgramIndex(inverted_index.index)
+        inverted_index.dump(os.path.join(directory, f'{name}.index'))
+        names.append(name)
+    write_json_atomically({
+        'kind': 'sharded',
+        'storage_policy': storage_policy,
+        'shards': names,
+    }, os.path.join(directory, ShardedIndex.manifest_name))
+
+
+def set_collection_statistics(shards: List[InvertedIndex]) -> None:
+    """Make shards rank documents with BM25 statistics of all the shards together"""
+    n_docs = sum(len(shard.doc_lengths) for shard in shards)
+    total_length = sum(sum(shard.doc_lengths.values()) for shard in shards)
+    document_frequencies = Counter()
+    for shard in shards:
+        document_frequencies.update({word: len(doc_ids) for word, doc_ids in shard.index.items()})
+    for shard in shards:
+        shard.collection = {
+            'n_docs': n_docs,
+            'avg_length': total_length / n_docs if total_length else 1.0,
+            'document_frequencies': {word: document_frequencies[word] for word in shard.index},
+        }
+        shard.compute_max_scores()
+
+
+_shard_cache: Dict[tuple, InvertedIndex] = {}
+
+
+def load_shard(filepath: str, storage_policy: str, settings: tuple) -> InvertedIndex:
+    """Load the shard once per process and query settings"""
+    key = (filepath, settings)
+    inverted_index = _shard_cache.get(key)
+    if inverted_index is None:
+        cache_params, max_expansions, fuzzy_distance = settings
+        inverted_index = InvertedIndex.load(filepath, storage_policy)
+        if cache_params is not None:
+            inverted_index.enable_cache(*cache_params)
+        inverted_index.max_expansions = max_expansions
+        if fuzzy_distance:
+            inverted_index.enable_fuzzy(fuzzy_distance)
+        _shard_cache[key] = inverted_index
+    return inverted_index
+
+
+def query_shard(filepath: str, storage_policy: str, settings: tuple, method: str, *args):
+    return getattr(load_shard(filepath, storage_policy, settings), method)(*args)
+
+
+class ShardedIndex:
+    """Inverted index partitioned by doc id hash into shards of a directory
+
+    Queries are scattered to the shards in a process pool, every worker
+    process keeps the shards it has loaded, and the results are gathered
+    into one answer. Ranked queries use BM25 statistics of all the shards
+    saved in every shard at build time.
+    """
+    manifest_name = 'manifest.json'
+
+    def __init__(self, directory: str, workers: int = None):
+        self.directory = str(directory)
+        with open(os.path.join(self.directory, self.manifest_name)) as fio:
+            manifest = json.load(fio)
+        if manifest.get('kind') != 'sharded':
+            raise ValueError(f'Not a sharded index directory: {self.directory}')
+        self.storage_policy = manifest['storage_policy']
+        self.shards = [os.path.join(self.directory, f'{name}.index') for name in manifest['shards']]
+        self.workers = workers or min(len(self.shards), os.cpu_count() or 1)
+        self.executor = None
+        self.cache_params = None
+        self.max_expansions = WILDCARD_MAX_EXPANSIONS
+        self.fuzzy_distance = 0
+
+    @classmethod
+    def load(cls, directory: str, workers: int = None) -> ShardedIndex:
+        return cls(directory, workers)
+
+    def _scatter(self, method: str, *args) -> list:
+        settings = (self.cache_params, self.max_expansions, self.fuzzy_distance)
+        calls = [partial(query_shard, shard, self.storage_policy, settings, method, *args)
+                 for shard in self.shards]
+        if self.workers == 1:
+            return [call() for call in calls]
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        futures = [self.executor.submit(call) for call in calls]
+        return [future.result() for future in futures]
+
+    def query(self, words: List[str]) -> List[int]:
+        """Return the sorted list of documents containing all the words"""
+        return union_sorted([doc_ids for doc_ids in self._scatter('query', words) if doc_ids])
+
+    def query_boolean(self, expression: str) -> List[int]:
+        """Return the sorted list of documents matching the boolean expression"""
+        return union_sorted([doc_ids for doc_ids in self._scatter('query_boolean', expression) if doc_ids])
+
+    def search(self, words: List[str], top: int) -> List[Tuple[int, float]]:
+        """Return top documents of all the shards ranked by BM25"""
+        results = self._scatter('search', words, top)
+        return heapq.nlargest(top, (item for result in results for item in result),
+                              key=lambda item: (item[1], -item[0]))
+
+    def enable_cache(self, max_entries: int, max_postings: int = None) -> None:
+        """Cache query results of every shard in the worker processes"""
+        self.cache_params = (max_entries, max_postings)
+
+    def enable_fuzzy(self, max_distance: int) -> None:
+        self.fuzzy_distance = max_distance
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def load_index(filepath: str, storage_policy: str):
+    """Load inverted index file, segmented or sharded index directory"""
+    if os.path.isdir(filepath):
+        with open(os.path.join(filepath, SegmentedIndex.manifest_name)) as fio:
+            kind = json.load(fio).get('kind')
+        if kind == 'sharded':
+            return ShardedIndex.load(filepath)
+        return SegmentedIndex.load(filepath)
+    return InvertedIndex.load(filepath, storage_policy)
+
+
+def load_documents(filepath: str) -> Dict[int, str]:
+    """Documents of the dataset by doc id, a repeated doc id raises ValueError"""
+    return dict(unique_documents(iter_documents(filepath)))
+
+
+def dataset_opener(binary):
+    """Decompressor of the binary stream chosen by its magic bytes, None for plain text"""
+    magic = binary.peek(max(map(len, COMPRESSED_DATASET_OPENERS)))
+    for signature, opener in COMPRESSED_DATASET_OPENERS.items():
+        if magic.startswith(signature):
+            return opener
+    return None
+
+
+def is_plain_dataset_file(filepath: str) -> bool:
+    """Whether the dataset is an uncompressed file which can be split into byte ranges"""
+    if str(filepath) == '-' or not os.path.isfile(filepath):
+        return False
+    with open(filepath, 'rb') as fio:
+        return dataset_opener(fio) is None
+
+
+@contextmanager
+def open_dataset(filepath: str, encoding: str = None):
+    """Text stream of the dataset file or of stdin for "-"
+
+    gzip, bz2 and xz input is detected by magic bytes and decompressed on
+    the fly, so nothing is unpacked to disk and memory use is constant.
+    """
+    with ExitStack() as stack:
+        if str(filepath) == '-':
+            binary = sys.stdin.buffer
+        else:
+            binary = stack.enter_context(open(filepath, 'rb', buffering=READ_BUFFER_SIZE))
+        opener = dataset_opener(binary)
+        if opener is not None:
+            binary = stack.enter_context(opener(binary))
+        text = TextIOWrapper(binary, encoding=encoding or locale.getpreferredencoding(False))
+        try:
+            yield text
+        finally:
+            # stdin and the opened files are closed by their owners
+            text.detach()
+
+
+def parse_document(line: str) -> Tuple[int, str]:
+    """Parse "doc_id<TAB>content" line"""
+    doc_id, content = line.split("\t", 1)
+    return int(doc_id), content.strip()
+
+
+def parse_documents(lines: Iterable[str], documents: Dict[int, str]) -> None:
+    """Parse "doc_id<TAB>content" lines into documents"""
+    for line in lines:
+        doc_id, content = parse_document(line)
+        documents[doc_id] = content
+
+
+def iter_documents(filepath: str, encoding: str = None) -> Iterator[Tuple[int, str]]:
+    """Read documents one by one from the dataset file, compressed file or stdin"""
+    with open_dataset(filepath, encoding) as fio:
+        for line in fio:
+            yield parse_document(line)
+
+
+def unique_documents(documents: Iterable[Tuple[int, str]]) -> Iterator[Tuple[int, str]]:
+    """Pass a stream of documents through, a repeated doc id raises ValueError"""
+    seen = set()
+    for doc_id, content in documents:
+        if doc_id in seen:
+            raise ValueError(f'Duplicate doc id {doc_id} in the dataset')
+        seen.add(doc_id)
+        yield doc_id, content
+
+
+def iter_items(documents: Union[Dict[int, str], Iterable[Tuple[int, str]]]) -> Iterable[Tuple[int, str]]:
+    """(doc_id, content) pairs of a mapping or of a stream checked for repeated doc ids"""
+    return documents.items() if isinstance(documents, Mapping) else unique_documents(documents)
+
+
+def build_inverted_index(documents: Union[Dict[int, str], Iterable[Tuple[int, str]]], storage_policy='json',
+                         with_scores=False, with_positions=False, analyzer: Analyzer = None,
+                         stats: Stats = None) -> InvertedIndex:
+    """Build inverted index of the documents
+
+    Every document is visited once and its words are deduplicated before
+    indexing, so a posting is appended without scanning the posting list.
+    With with_scores term frequencies and document lengths for BM25 are
+    collected as well, with with_positions positions of words for phrase
+    queries. Documents are split into words by the analyzer, which is
+    saved with the index. With stats the tokenization is timed separately.
+    Documents are a mapping or a stream of (doc_id, content) pairs with
+    unique doc ids.
+    """
+    analyzer = analyzer or Analyzer()
+    if with_scores or with_positions:
+        return build_detailed_inverted_index(documents, storage_policy, with_scores, with_positions, analyzer)
+    analyze = analyzer.analyze if stats is None else stats.timed('tokenize', analyzer.analyze, counter='tokens')
+    index = defaultdict(list)
+    for key, content in iter_items(documents):
+        for word in dict.fromkeys(analyze(content)):
+            index[word].append(key)
+    inverted_index = InvertedIndex({word: compact_postings(sorted(doc_ids)) for word, doc_ids in index.items()},
+                                   storage_policy)
+    inverted_index.analyzer = analyzer
+    return inverted_index
+
+
+def build_detailed_inverted_index(documents: Union[Dict[int, str], Iterable[Tuple[int, str]]],
+                                  storage_policy='json', with_scores=True, with_positions=False,
+                                  analyzer: Analyzer = None) -> InvertedIndex:
+    """Build inverted index with term frequencies and document lengths or word positions
+
+    Documents are visited in doc id order, so the per-document data is
+    aligned with the sorted posting lists.
+    """
+    analyzer = analyzer or Analyzer()
+    index, positions, doc_lengths = defaultdict(list), defaultdict(list), {}
+    for key, content in sorted(iter_items(documents)):
+        pairs = analyzer.analyze_positions(content)
+        doc_lengths[key] = len(pairs)
+        word_positions = defaultdict(list)
+        for position, word in pairs:
+            word_positions[word].append(position)
+        for word, doc_positions in word_positions.items():
+            index[word].append(key)
+            positions[word].append(doc_positions)
+    inverted_index = InvertedIndex({word: compact_postings(doc_ids) for word, doc_ids in index.items()},
+                                   storage_policy)
+    inverted_index.analyzer = analyzer
+    if with_scores:
+        inverted_index.term_freqs = {
+            word: [len(doc_positions) for doc_positions in word_positions]
+            for word, word_positions in positions.items()
+        }
+        inverted_index.doc_lengths = doc_lengths
+        inverted_index.compute_max_scores()
+    if with_positions:
+        inverted_index.positions = dict(positions)
+    return inverted_index
+
+
+def split_file_by_lines(filepath: str, n_parts: int) -> List[Tuple[int, int]]:
+    """Split file into at most n_parts byte ranges which start at line beginnings"""
+    size = os.path.getsize(filepath)
+    boundaries = [0]
+    with open(filepath, 'rb') as fio:
+        for part in range(1, n_parts):
+            position = max(size * part // n_parts, boundaries[-1])
+            if position >= size:
+                break
+            # step back one byte so that a range starting at a line beginning is kept
+            fio.seek(max(position - 1, 0))
+            fio.readline()
+            if fio.tell() > boundaries[-1]:
+                boundaries.append(fio.tell())
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+
+def build_partial_index(filepath: str, start: int, end: int,
+                        analyzer: Analyzer = None) -> Tuple[array, Dict[str, List[int]]]:
+    """Build inverted index of the documents in the byte range of the file, return their doc ids too"""
+    with open(filepath, 'rb') as fio:
+        fio.seek(start)
+        chunk = fio.read(end - start)
+    lines = TextIOWrapper(BytesIO(chunk), encoding=locale.getpreferredencoding(False))
+    documents = list(unique_documents(parse_document(line) for line in lines))
+    doc_ids = compact_postings(doc_id for doc_id, _ in documents)
+    return doc_ids, dict(build_inverted_index(documents, analyzer=analyzer).index)
+
+
+def merge_partial_indexes(partial_indexes: Iterable[Dict[str, List[int]]]) -> Dict[str, List[int]]:
+    """Merge sorted posting lists of partial indexes keeping the first seen order of words"""
+    merged = {}
+    for partial_index in partial_indexes:
+        for word, doc_ids in partial_index.items():
+            merged.setdefault(word, []).append(doc_ids)
+    return {
+        word: postings[0] if len(postings) == 1 else compact_postings(heapq.merge(*postings))
+        for word, postings in merged.items()
+    }
+
+
+def build_inverted_index_parallel(filepath: str, workers: int, storage_policy='json',
+                                  analyzer: Analyzer = None) -> InvertedIndex:
+    """Build inverted index from the dataset file in a pool of processes
+
+    The file is split into byte ranges, every worker builds a partial index
+    of its range and the partial indexes are merged in file order, so the
+    result is identical to the serial build. A doc id repeated in the
+    file raises ValueError.
+    """
+    ranges = split_file_by_lines(filepath, workers)
+    starts = [start for start, _ in ranges]
+    ends = [end for _, end in ranges]
+    seen = set()
+
+    def check_doc_ids(partial_results):
+        for doc_ids, partial_index in partial_results:
+            if not seen.isdisjoint(doc_ids):
+                raise ValueError(f'Duplicate doc id {min(seen.intersection(doc_ids))} in the dataset')
+            seen.update(doc_ids)
+            yield partial_index
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        partial_results = executor.map(build_partial_index, [filepath] * len(ranges), starts, ends,
+                                       [analyzer] * len(ranges))
+        index = merge_partial_indexes(check_doc_ids(partial_results))
+    inverted_index = InvertedIndex(index, storage_policy)
+    inverted_index.analyzer = analyzer or Analyzer()
+    return inverted_index
+
+
+# Rough CPython footprint of a posting in a list and of a new word in a block
+POSTING_MEMORY_SIZE = 36
+WORD_MEMORY_SIZE = 160
+# Block word posting every document of the block, no analyzer yields an empty token
+DOCUMENTS_WORD = ''
+
+
+def check_unique_doc_ids(doc_ids: List[int]) -> List[int]:
+    """Return sorted doc ids, an equal neighbour means a repeated doc id and raises ValueError"""
+    for previous, doc_id in zip(doc_ids, doc_ids[1:]):
+        if previous == doc_id:
+            raise ValueError(f'Duplicate doc id {doc_id} in the dataset')
+    return doc_ids
+
+
+def write_index_block(index: Dict[str, List[int]], filepath: str) -> None:
+    """Write index block as "word<TAB>doc_id,doc_id" lines sorted by word"""
+    with open(filepath, 'w', encoding='utf-8') as fio:
+        for word in sorted(index):
+            doc_ids = check_unique_doc_ids(sorted(index[word]))
+            fio.write(f'{word}\t{",".join(map(str, doc_ids))}\n')
+
+
+def iter_index_block(filepath: str) -> Iterator[Tuple[str, List[int]]]:
+    """Read index block written by write_index_block"""
+    with open(filepath, encoding='utf-8') as fio:
+        for line in fio:
+            word, doc_ids = line.rstrip('\n').split('\t')
+            yield word, [int(doc_id) for doc_id in doc_ids.split(',')]
+
+
+def merge_index_blocks(blocks: List[Iterator[Tuple[str, List[int]]]]) -> Iterator[Tuple[str, List[int]]]:
+    """K-way merge of blocks sorted by word into (word, doc ids) pairs sorted by word
+
+    A doc id found in postings of a word in two blocks raises ValueError.
+    """
+    postings, current_word = [], None
+    for word, doc_ids in heapq.merge(*blocks, key=lambda item: item[0]):
+        if postings and word != current_word:
+            yield current_word, merge_postings(postings)
+            postings = []
+        current_word = word
+        postings.append(doc_ids)
+    if postings:
+        yield current_word, merge_postings(postings)
+
+
+def merge_postings(postings: List[List[int]]) -> List[int]:
+    return postings[0] if len(postings) == 1 else check_unique_doc_ids(list(heapq.merge(*postings)))
+
+
+def build_inverted_index_out_of_core(filepath: str, output: str, memory_budget: int,
+                                     storage_policy='json', tmp_dir: str = None, analyzer: Analyzer = None) -> int:
+    """Build inverted index SPIMI-style without keeping all documents in memory
+
+    Documents are streamed from the file, postings are collected in a block
+    until its estimated size exceeds memory_budget bytes, then the block is
+    flushed sorted to a temporary file. Blocks are k-way merged into the
+    output with the given storage policy. Return the number of blocks.
+    Every document is also posted under the empty word, which no analyzer
+    produces, so a repeated doc id is found as equal neighbour doc ids
+    while sorting a block or merging blocks and raises ValueError.
+    """
+    if storage_policy not in STORAGE_POLICIES:
+        raise ValueError(f'Unknown storage policy: {storage_policy}')
+    analyzer = analyzer or Analyzer()
+    with TemporaryDirectory(dir=tmp_dir) as blocks_dir:
+        block_paths = []
+        block, block_size = {}, 0
+        for doc_id, content in iter_documents(filepath):
+            for word in dict.fromkeys(chain([DOCUMENTS_WORD], analyzer.analyze(content))):
+                doc_ids = block.get(word)
+                if doc_ids is None:
+                    block[word] = doc_ids = []
+                    block_size += WORD_MEMORY_SIZE + len(word)
+                doc_ids.append(doc_id)
+                block_size += POSTING_MEMORY_SIZE
+            if block_size >= memory_budget:
+                block_paths.append(os.path.join(blocks_dir, f'block_{len(block_paths)}.txt'))
+                write_index_block(block, block_paths[-1])
+                block, block_size = {}, 0
+        if block or not block_paths:
+            block_paths.append(os.path.join(blocks_dir, f'block_{len(block_paths)}.txt'))
+            write_index_block(block, block_paths[-1])
+
+        with ExitStack() as stack:
+            blocks = [stack.enter_context(closing(iter_index_block(path))) for path in block_paths]
+            items = ((word, doc_ids) for word, doc_ids in merge_index_blocks(blocks) if word != DOCUMENTS_WORD)
+            STORAGE_POLICIES[storage_policy].dump_items(items, output)
+    remove_stale_sidecars(output)
+    if analyzer != Analyzer():
+        analyzer.dump(sidecar_path(output, 'analyzer'))
+    return len(block_paths)
+
+
+class Stats:
+    """Opt-in wall and CPU time of command stages, counters and query latencies
+
+    Stages may be entered many times, their times are summed. Wall and
+    CPU times of a stage exclude the stages nested in it, so they add up
+    to the time of the command, total_wall includes the nested stages.
+    The report is a JSON object printed to stderr.
+    """
+    def __init__(self, command: str):
+        self.command = command
+        self.stages = {}
+        self.counters = {}
+        self.histogram = {}
+        self.latencies = []
+        self.nested_times = []
+
+    @contextmanager
+    def stage(self, name: str):
+        wall, cpu = time.perf_counter(), time.process_time()
+        self.nested_times.append([0.0, 0.0])
+        try:
+            yield
+        finally:
+            nested_wall, nested_cpu = self.nested_times.pop()
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            if self.nested_times:
+                self.nested_times[-1][0] += wall
+                self.nested_times[-1][1] += cpu
+            stage = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'total_wall': 0.0})
+            stage['wall'] += wall - nested_wall
+            stage['cpu'] += cpu - nested_cpu
+            stage['total_wall'] += wall
+
+    def timed(self, name: str, function, counter: str = None):
+        """Wrap function to add its time to the stage and the length of its result to the counter"""
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                result = function(*args, **kwargs)
+            if counter is not None:
+                self.count(counter, len(result))
+            return result
+        return wrapper
+
+    def timed_iter(self, name: str, iterable: Iterable, counter: str = None) -> Iterator:
+        """Iterate adding the time of getting every item to the stage and counting items"""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            if counter is not None:
+                self.count(counter)
+            yield item
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def describe_postings(self, index: Mapping) -> None:
+        """Vocabulary size and histogram of posting list lengths by powers of two"""
+        self.counters['vocabulary_size'] = len(index)
+        buckets = Counter(len(doc_ids).bit_length() for doc_ids in index.values())
+        self.histogram = {f'{1 << (bits - 1)}-{(1 << bits) - 1}' if bits else '0': buckets[bits]
+                          for bits in sorted(buckets)}
+        self.counters['postings'] = sum(len(doc_ids) for doc_ids in index.values())
+
+    def record_latency(self, seconds: float) -> None:
+        self.latencies.append(seconds)
+
+    def report(self) -> dict:
+        report = {'command': self.command, 'stages': self.stages, 'counters': self.counters}
+        rates = {}
+        for counter, stage in (('documents', 'build'), ('tokens', 'tokenize'), ('queries', 'query')):
+            wall = self.stages.get(stage, {}).get('total_wall')
+            if counter in self.counters and wall:
+                rates[f'{counter}_per_second'] = self.counters[counter] / wall
+        if rates:
+            report['rates'] = rates
+        if self.histogram:
+            report['postings_histogram'] = self.histogram
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            report['latency'] = {
+                f'p{percent}': latencies[max(math.ceil(percent / 100 * len(latencies)) - 1, 0)]
+                for percent in (50, 90, 99)
+            }
+            report['latency']['max'] = latencies[-1]
+        return report
+
+    def dump(self, file=None) -> None:
+        print(json.dumps(self.report()), file=file or sys.stderr)
+
+
+def path_size(filepath: str) -> int:
+    """Bytes of the index file with its sidecar files or of the index directory"""
+    filepath = str(filepath)
+    if os.path.isdir(filepath):
+        return sum(os.path.getsize(os.path.join(filepath, name)) for name in os.listdir(filepath))
+    directory, name = os.path.split(os.path.abspath(filepath))
+    return sum(os.path.getsize(os.path.join(directory, other)) for other in os.listdir(directory)
+               if other == name or other.startswith(f'{name}.'))
+
+
+def callback_build(arguments):
+    if (arguments.bm25 or arguments.positions) and (arguments.memory_budget is not None or arguments.workers > 1):
+        raise ValueError('--bm25 and --positions are supported only by the serial in-memory build')
+    stats = Stats('build') if getattr(arguments, 'stats', False) else None
+    build_from_arguments(arguments, stats or Stats('build'), stats)
+    if stats is not None:
+        if os.path.isfile(arguments.dataset):
+            stats.counters['bytes_read'] = os.path.getsize(arguments.dataset)
+        stats.counters['bytes_written'] = path_size(arguments.output)
+        stats.dump()
+
+
+def build_from_arguments(arguments, timer: Stats, stats: Stats = None) -> None:
+    """Build and save the index, stage times are collected in timer, details only in stats"""
+    stop_words = getattr(arguments, 'stop_words', None)
+    analyzer = Analyzer(stop_words=load_stop_words(stop_words) if stop_words else (),
+                        stem=getattr(arguments, 'stem', False))
+    if getattr(arguments, 'shards', None):
+        with timer.stage('read'):
+            documents = load_documents(arguments.dataset)
+        timer.count('documents', len(documents))
+        with timer.stage('build'):
+            build_sharded_index(documents, arguments.output, arguments.shards,
+                                storage_policy=arguments.strategy, fuzzy=arguments.fuzzy,
+                                with_scores=arguments.bm25, with_positions=arguments.positions, analyzer=analyzer)
+        return
+    if arguments.memory_budget is not None:
+        with timer.stage('build'):
+            build_inverted_index_out_of_core(arguments.dataset, arguments.output,
+                                             memory_budget=arguments.memory_budget * 2 ** 20,
+                                             storage_policy=arguments.strategy, tmp_dir=arguments.tmp_dir,
+                                             analyzer=analyzer)
+        if arguments.fuzzy:
+            with timer.stage('dump'):
+                vocabulary = InvertedIndex.load(arguments.output, arguments.strategy).index
+                NgramIndex(vocabulary).dump(sidecar_path(arguments.output, 'ngrams'))
+        return
+    parallel = arguments.workers > 1 and is_plain_dataset_file(arguments.dataset)
+    if arguments.workers > 1 and not parallel:
+        print('Dataset is compressed or not a file, building with one process', file=sys.stderr)
+    if parallel:
+        with timer.stage('build'):
+            inverted_index = build_inverted_index_parallel(arguments.dataset, arguments.workers,
+                                                           storage_policy=arguments.strategy, analyzer=analyzer)
+    else:
+        documents = iter_documents(arguments.dataset)
+        if stats is not None:
+            documents = stats.timed_iter('read', documents, counter='documents')
+        # read and tokenize are nested stages, the rest of build is appending postings
+        with timer.stage('build'):
+            inverted_index = build_inverted_index(documents, storage_policy=arguments.strategy,
+                                                  with_scores=arguments.bm25, with_positions=arguments.positions,
+                                                  analyzer=analyzer, stats=stats)
+    if arguments.fuzzy:
+        inverted_index.ngram_index = NgramIndex(inverted_index.index)
+    if stats is not None:
+        stats.describe_postings(inverted_index.index)
+    with timer.stage('dump'):
+        inverted_index.dump(arguments.output)
+
+
+def callback_add(arguments):
+    segmented_index = SegmentedIndex(arguments.index, storage_policy=arguments.strategy,
+                                     max_segments=arguments.max_segments)
+    segmented_index.add(load_documents(arguments.dataset))
+    # the new segment is already committed, merging only compacts the directory
+    segmented_index.start_background_merge().join()
+
+
+def callback_delete(arguments):
+    segmented_index = SegmentedIndex.load(arguments.index)
+    n_deleted = segmented_index.delete(arguments.doc_ids)
+    print(f'Deleted {n_deleted} documents', file=sys.stderr)
+
+
+def callback_merge(arguments):
+    SegmentedIndex.load(arguments.index).merge()
+
+
+def callback_pairs(arguments):
+    inverted_index = InvertedIndex.load(arguments.index, arguments.strategy)
+    pair_counts = mine_term_pairs((parse_query_line(line) for line in arguments.query_log), inverted_index.analyzer)
+    pair_cache = PairCache.build(inverted_index, pair_counts, arguments.memory_budget * 2 ** 20,
+                                 min_count=arguments.min_count)
+    pair_cache.dump(sidecar_path(arguments.index, 'pairs'), index_fingerprint(arguments.index))
+    print(f'Cached {len(pair_cache)} of {len(pair_counts)} pairs in {pair_cache.n_bytes()} bytes', file=sys.stderr)
+
+
+def callback_query(arguments):
+    engine = getattr(arguments, 'engine', 'python')
+    if engine == 'numpy' and (getattr(arguments, 'top', None) is not None or getattr(arguments, 'boolean', False)):
+        raise ValueError('--engine numpy supports only queries with all the words')
+    workers = getattr(arguments, 'workers', 1)
+    if engine == 'numpy' and workers > 1:
+        raise ValueError('--engine numpy answers queries in one process')
+    stats = Stats('query') if getattr(arguments, 'stats', False) else None
+    timer = stats or Stats('query')
+    settings = index_settings(arguments)
+    top = getattr(arguments, 'top', None)
+    boolean = getattr(arguments, 'boolean', False)
+    inverted_index = None
+    if workers > 1 and arguments.query is None and hasattr(arguments, 'query_file'):
+        with timer.stage('query'):
+            process_query_file_parallel(arguments.query_file, arguments.index, arguments.strategy, workers,
+                                        top=top, boolean=boolean, settings=settings, stats=stats)
+    else:
+        with timer.stage('load'):
+            inverted_index = load_configured_index(arguments.index, arguments.strategy, settings)
+        with timer.stage('query'):
+            if arguments.query is not None:
+                process_query_from_cli(arguments.query, inverted_index, top=top, boolean=boolean, stats=stats)
+            elif hasattr(arguments, 'query_file'):
+                process_query_from_file(arguments.query_file, inverted_index, top=top, boolean=boolean,
+                                        engine=engine, stats=stats)
+    if stats is not None:
+        stats.counters['bytes_read'] = path_size(arguments.index)
+        if hasattr(inverted_index, 'index'):
+            stats.counters['vocabulary_size'] = len(inverted_index.index)
+        stats.dump()
+
+
+def index_settings(arguments) -> tuple:
+    """(cache size, max wildcard expansions, fuzzy distance) given to query or serve"""
+    return (getattr(arguments, 'cache_size', 0), getattr(arguments, 'max_expansions', WILDCARD_MAX_EXPANSIONS),
+            getattr(arguments, 'fuzzy', 0))
+
+
+def load_configured_index(filepath: str, storage_policy: str, settings: tuple):
+    """Load the index and apply (cache size, max wildcard expansions, fuzzy distance) settings"""
+    cache_size, max_expansions, fuzzy_distance = settings
+    inverted_index = load_index(filepath, storage_policy)
+    if cache_size:
+        inverted_index.enable_cache(cache_size)
+    inverted_index.max_expansions = max_expansions
+    if fuzzy_distance:
+        inverted_index.enable_fuzzy(fuzzy_distance)
+    return inverted_index
+
+
+_query_worker_index = None
+
+
+def init_query_worker(filepath: str, storage_policy: str, settings: tuple) -> None:
+    """Load the index once per worker process, mapped indexes share the page cache"""
+    global _query_worker_index
+    _query_worker_index = load_configured_index(filepath, storage_policy, settings)
+
+
+def answer_queries(queries: List[Tuple[str, ...]], top: int = None, boolean=False) -> List[Tuple[str, float]]:
+    """Answer lines of the queries with the seconds each query took in the worker"""
+    answers = []
+    for query in queries:
+        start = time.perf_counter()
+        result = run_query(_query_worker_index, list(query), top, boolean)
+        answers.append((make_result_of_query_in_one_line(result), time.perf_counter() - start))
+    return answers
+
+
+def process_query_file_parallel(query_file, filepath: str, storage_policy: str, workers: int,
+                                top: int = None, boolean=False, settings: tuple = (0, WILDCARD_MAX_EXPANSIONS, 0),
+                                output=None, stats: Stats = None) -> None:
+    """Answer the query file in a pool of processes keeping the order of queries
+
+    The file is read in chunks of QUERY_BATCH_SIZE lines, identical queries
+    of a chunk are answered once, unique queries are split evenly between
+    the workers and the answers of a chunk are written at once. With stats
+    the latency of every unique query measured in its worker is recorded.
+    """
+    output = output or sys.stdout
+    lines = iter(query_file)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_query_worker,
+                             initargs=(str(filepath), storage_policy, settings)) as executor:
+        for chunk in iter(lambda: list(islice(lines, QUERY_BATCH_SIZE)), []):
+            queries = [tuple(parse_query_line(line, boolean)) for line in chunk]
+            unique = list(dict.fromkeys(queries))
+            size = -(-len(unique) // workers)
+            batches = [unique[start:start + size] for start in range(0, len(unique), size)]
+            answers = {}
+            futures = [executor.submit(answer_queries, batch, top, boolean) for batch in batches]
+            for batch, future in zip(batches, futures):
+                answers.update(zip(batch, future.result()))
+            output.write(''.join(f'{answers[query][0]}\n' for query in queries))
+            if stats is not None:
+                stats.count('queries', len(queries))
+                stats.count('unique_queries', len(unique))
+                for _, seconds in answers.values():
+                    stats.record_latency(seconds)
+    output.flush()
+
+
+def run_query(inverted_index, words: List[str], top: int = None, boolean=False) -> List[int]:
+    """Run the query in the requested mode
+
+    By default documents containing all the words are returned, with top
+    ids of the top documents ranked by BM25, with boolean the words are
+    joined into a boolean expression. A blank boolean query line matches
+    no documents.
+    """
+    if boolean:
+        expression = ' '.join(words)
+        if not BooleanQueryParser.token_re.search(expression):
+            return []
+        return inverted_index.query_boolean(expression)
+    if top is None:
+        return inverted_index.query(words)
+    return [doc_id for doc_id, _ in inverted_index.search(words, top)]
+
+
+def run_timed_query(inverted_index, words: List[str], top: int = None, boolean=False,
+                    stats: Stats = None) -> List[int]:
+    """Run the query recording its latency in stats"""
+    if stats is None:
+        return run_query(inverted_index, words, top, boolean)
+    start = time.perf_counter()
+    result = run_query(inverted_index, words, top, boolean)
+    stats.record_latency(time.perf_counter() - start)
+    stats.count('queries')
+    return result
+
+
+def process_query_from_cli(queries, inverted_index, top: int = None, boolean=False, stats: Stats = None):
+    for words in queries:
+        res = make_result_of_query_in_one_line(run_timed_query(inverted_index, words, top, boolean, stats))
+        print(res, file=sys.stdout)
+
+
+def parse_query_line(line: str, boolean=False) -> List[str]:
+    """Split query line into words, boolean expressions are kept whole"""
+    return [line.strip()] if boolean else Analyzer.query_token_re.findall(line)
+
+
+def process_query_from_file(query_file, inverted_index, top: int = None, boolean=False, engine='python',
+                            stats: Stats = None):
+    """Answer every query line, with stats latencies of single queries are recorded"""
+    if engine == 'numpy':
+        batch_engine = NumpyBatchEngine(inverted_index)
+        lines = iter(query_file)
+        for batch in iter(lambda: list(islice(lines, QUERY_BATCH_SIZE)), []):
+            for result in batch_engine.query_batch([parse_query_line(line) for line in batch]):
+                print(make_result_of_query_in_one_line(result), file=sys.stdout)
+            if stats is not None:
+                stats.count('queries', len(batch))
+        return
+    for query in query_file:
+        query = parse_query_line(query, boolean)
+        res = make_result_of_query_in_one_line(run_timed_query(inverted_index, query, top, boolean, stats))
+        print(res, file=sys.stdout)
+
+
+async def handle_query_connection(inverted_index, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                                  top: int = None, boolean=False) -> None:
+    """Answer every utf-8 query line of the client with a line of doc ids
+
+    Answers keep the order of queries, so a client may send a batch of
+    lines at once. Invalid queries are answered with an "ERROR" line.
+    """
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                query = parse_query_line(line.decode('utf-8'), boolean)
+                res = make_result_of_query_in_one_line(run_query(inverted_index, query, top, boolean))
+            except (ValueError, UnicodeDecodeError) as error:
+                res = f'ERROR {error}'
+            writer.write(res.encode('utf-8') + b'\n')
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_query_server(inverted_index, host: str, port: int,
+                             top: int = None, boolean=False) -> asyncio.AbstractServer:
+    """Start TCP server answering queries over the shared in-memory index"""
+    handler = partial(handle_query_connection, inverted_index, top=top, boolean=boolean)
+    return await asyncio.start_server(handler, host, port)
+
+
+async def serve_index(inverted_index, host: str, port: int, top: int = None, boolean=False) -> None:
+    server = await start_query_server(inverted_index, host, port, top=top, boolean=boolean)
+    address = server.sockets[0].getsockname()
+    print(f'Serving inverted index on {address[0]}:{address[1]}', file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+def callback_serve(arguments):
+    inverted_index = load_configured_index(arguments.index, arguments.strategy, index_settings(arguments))
+    try:
+        asyncio.run(serve_index(inverted_index, arguments.host, arguments.port,
+                                top=arguments.top, boolean=arguments.boolean))
+    except KeyboardInterrupt:
+        pass
+
+
+def make_result_of_query_in_one_line(arr: List):
+    return ','.join([str(el) for el in arr])
+
+
+def setup_parser(parser: ArgumentParser):
+    """Parsing of CLI arguments
+
+    A couple of branches to choose:
+    - build: build Inverted index
+    - query: load Inverted index and query it with words
+    - serve: load Inverted index once and answer queries over TCP
+    - add, delete, merge: update segmented Inverted index directory
+    - pairs: cache intersections of word pairs frequent in a query log
+    """
+    subparsers = parser.add_subparsers(help='Choose command')
+
+    parser_build = subparsers.add_parser('build', help='Build inverted index with documents',
+                                         formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser_build.add_argument('-d', '--dataset', required=True,
+                              help='Documents file or "-" for stdin, may be gzip, bz2 or xz compressed')
+    parser_build.add_argument('-o', '--output', required=True)
+    parser_build.add_argument('-s', '--strategy', default='struct', choices=sorted(STORAGE_POLICIES))
+    build_mode_group = parser_build.add_mutually_exclusive_group()
+    build_mode_group.add_argument('-w', '--workers', default=1, type=int,
+                                  help='Number of processes to build index with')
+    build_mode_group.add_argument('--memory-budget', type=int, metavar='MB',
+                                  help='Build index out of core keeping at most MB of postings in memory')
+    build_mode_group.add_argument('--shards', type=int, metavar='N',
+                                  help='Build N shards partitioned by doc id hash into the output directory')
+    parser_build.add_argument('--tmp-dir', help='Directory for temporary index blocks')
+    parser_build.add_argument('--bm25', action='store_true',
+                              help='Store term frequencies and document lengths for ranked queries')
+    parser_build.add_argument('--fuzzy', action='store_true',
+                              help='Store trigram index of the vocabulary for typo-tolerant queries')
+    parser_build.add_argument('--positions', action='store_true',
+                              help='Store word positions for phrase and NEAR queries')
+    parser_build.add_argument('--stop-words', metavar='FILE',
+                              help='Leave out words listed one per line in FILE, at build and query time')
+    parser_build.add_argument('--stem', action='store_true',
+                              help='Reduce English plural forms to the singular ones')
+    parser_build.add_argument('--stats', action='store_true',
+                              help='Print JSON report of stage times and index counters to stderr')
+    parser_build.set_defaults(callback=callback_build)
+
+    parser_query = subparsers.add_parser('query', help='Query inverted index with words',
+                                         formatter_class=ArgumentDefaultsHelpFormatter)
+    parser_query.add_argument('--index', required=True, help='Path to inverted index')
+    parser_query.add_argument('-s', '--strategy', default='struct', choices=sorted(STORAGE_POLICIES))
+    mode_group = parser_query.add_mutually_exclusive_group()
+    mode_group.add_argument('--top', type=int, metavar='K',
+                            help='Return K documents containing any of the words ranked by BM25')
+    mode_group.add_argument('--boolean', action='store_true',
+                            help='Treat queries as boolean expressions with AND, OR, NOT, parentheses, '
+                                 '"phrases" and NEAR/k')
+    parser_query.add_argument('--cache-size', default=0, type=int, metavar='N',
+                              help='Cache results of N most recent distinct queries')
+    parser_query.add_argument('--max-expansions', default=WILDCARD_MAX_EXPANSIONS, type=int,
+                              help='Maximum number of words a "*" wildcard is expanded to')
+    parser_query.add_argument('--fuzzy', default=0, type=int, metavar='K',
+                              help='Replace unknown words by the closest words within K edits')
+    parser_query.add_argument('--engine', default='python', choices=['python', 'numpy'],
+                              help='Engine answering a query file, numpy answers batches of queries '
+                                   'and requires NumPy')
+    parser_query.add_argument('--stats', action='store_true',
+                              help='Print JSON report of stage times and query latencies to stderr')
+    parser_query.add_argument('-w', '--workers', default=1, type=int,
+                              help='Answer a query file in batches with this number of processes')
+
+    query_group = parser_query.add_mutually_exclusive_group(required=True)
+    query_group.add_argument('--query', nargs='+', action='append', metavar='WORD',
+                             help='Query with words from CLI')
+    query_group.add_argument('--query-file-utf8', dest='query_file',
+                             type=EncodedFileType('r', encoding='utf-8'),
+                             default=TextIOWrapper(sys.stdin.buffer, encoding='utf-8'),
+                             help='Load queries from file with utf-8 encoding')
+    query_group.add_argument('--query-file-cp1251', dest='query_file',
+                             type=EncodedFileType('r', encoding='cp1251'),
+                             default=TextIOWrapper(sys.stdin.buffer, encoding='cp1251'),
+                             help='Load queries from file with cp-1251 encoding')
+
+    parser_query.set_defaults(callback=callback_query)
+
+    parser_serve = subparsers.add_parser('serve', help='Load inverted index once and answer queries over TCP',
+                                         formatter_class=ArgumentDefaultsHelpFormatter)
+    parser_serve.add_argument('--index', required=True, help='Path to inverted index')
+    parser_serve.add_argument('-s', '--strategy', default='struct', choices=sorted(STORAGE_POLICIES))
+    parser_serve.add_argument('--host', default='127.0.0.1')
+    parser_serve.add_argument('--port', default=8765, type=int)
+    parser_serve.add_argument('--cache-size', default=0, type=int, metavar='N',
+                              help='Cache results of N most recent distinct queries')
+    parser_serve.add_argument('--max-expansions', default=WILDCARD_MAX_EXPANSIONS, type=int,
+                              help='Maximum number of words a "*" wildcard is expanded to')
+    parser_serve.add_argument('--fuzzy', default=0, type=int, metavar='K',
+                              help='Replace unknown words by the closest words within K edits')
+    serve_mode_group = parser_serve.add_mutually_exclusive_group()
+    serve_mode_group.add_argument('--top', type=int, metavar='K',
+                                  help='Return K documents containing any of the words ranked by BM25')
+    serve_mode_group.add_argument('--boolean', action='store_true',
+                                  help='Treat queries as boolean expressions with AND, OR, NOT, parentheses, '
+                                       '"phrases" and NEAR/k')
+    parser_serve.set_defaults(callback=callback_serve)
+
+    parser_add = subparsers.add_parser('add', help='Add documents to segmented inverted index',
+                                       formatter_class=ArgumentDefaultsHelpFormatter)
+    parser_add.add_argument('-d', '--dataset', required=True)
+    parser_add.add_argument('--index', required=True, help='Path to segmented inverted index directory')
+    parser_add.add_argument('-s', '--strategy', default='struct', choices=sorted(STORAGE_POLICIES),
+                            help='Storage policy of a new index directory')
+    parser_add.add_argument('--max-segments', type=int,
+                            help='Merge segments once there are more of them, saved in the index directory')
+    parser_add.set_defaults(callback=callback_add)
+
+    parser_delete = subparsers.add_parser('delete', help='Delete documents from segmented inverted index',
+                                          formatter_class=ArgumentDefaultsHelpFormatter)
+    parser_delete.add_argument('--index', required=True, help='Path to segmented inverted index directory')
+    parser_delete.add_argument('--doc-ids', nargs='+', type=int, required=True, metavar='DOC_ID')
+    parser_delete.set_defaults(callback=callback_delete)
+
+    parser_merge = subparsers.add_parser('merge', help='Compact segmented inverted index into one segment',
+                                         formatter_class=ArgumentDefaultsHelpFormatter)
+    parser_merge.add_argument('--index', required=True, help='Path to segmented inverted index directory')
+    parser_merge.set_defaults(callback=callback_merge)
+
+    parser_pairs = subparsers.add_parser('pairs', help='Cache intersections of word pairs frequent in a query log',
+                                         formatter_class=ArgumentDefaultsHelpFormatter)
+    parser_pairs.add_argument('--index', required=True, help='Path to inverted index file')
+    parser_pairs.add_argument('-s', '--strategy', default='struct', choices=sorted(STORAGE_POLICIES))
+    parser_pairs.add_argument('--query-log', required=True, type=EncodedFileType('r', encoding='utf-8'),
+                              help='Queries one per line in utf-8 encoding')
+    parser_pairs.add_argument('--memory-budget', default=PAIRS_MEMORY_BUDGET, type=int, metavar='MB',
+                              help='Keep at most MB of cached doc ids')
+    parser_pairs.add_argument('--min-count', default=2, type=int,
+                              help='Cache only pairs found in at least this number of queries')
+    parser_pairs.set_defaults(callback=callback_pairs)
 
 
 def main():
@@ -1,7 +1,15 @@
 import os
+import json
+import time
+import tracemalloc
+import gzip
+import bz2
+import lzma
 import pytest
 from textwrap import dedent
 from argparse import Namespace
+from io import BufferedReader, BytesIO, StringIO, TextIOWrapper
+from random import Random
 
 import task_Ishmametyev_Nikolay_inverted_index as lib
 
@@ -12,9 +20,9 @@ DOCUMENTS_EXAMPLE = dedent("""\
     """)
 
 DOCUMENTS_DICT_EXAMPLE = {
-    1: 'this doc consists one слово',
-    2: 'this doc consists two words',
-    3: 'this doc also consists two words'
+    1: 'This doc consists one слово',
+    2: 'This doc consists two words',
+    3: 'This doc also consists two words'
 }
 
 INVERTED_INDEX_EXAMPLE = {
@@ -128,3 +136,1139 @@ def test_process_query(tmpdir, create_json_index_from_documents, capsys):
     lib.callback_query(arguments)
     captures = capsys.readouterr()
     assert expected_res in captures.out
+
+
+def test_index_dump_mmap_and_load(tmpdir, example_dataset_io):
+    """Test file operation of InvertedIndex with memory-mapped storage"""
+    filepath = tmpdir.join('inverted.index')
+    documents = lib.load_documents(example_dataset_io)
+    index = lib.build_inverted_index(documents, storage_policy='mmap')
+    index.dump(filepath)
+    loaded_index = lib.InvertedIndex.load(filepath, storage_policy='mmap')
+    assert isinstance(loaded_index.index, lib.MmapPostings)
+    assert loaded_index == index
+    assert [2, 3] == sorted(loaded_index.query(['two', 'words']))
+    assert [] == loaded_index.query(['two', 'made'])
+
+
+@pytest.mark.parametrize('numbers', [[], [0], [1, 127, 128, 300, 65536], [2 ** 32 + 1, 2 ** 63]])
+def test_varbyte_encode_decode(numbers):
+    """Test round trip of variable-byte compression"""
+    assert numbers == lib.decode_varbyte(lib.encode_varbyte(numbers))
+
+
+def test_index_dump_varbyte_and_load(tmpdir, example_dataset_io):
+    """Test file operation of InvertedIndex with variable-byte storage"""
+    filepath = tmpdir.join('inverted.index')
+    documents = lib.load_documents(example_dataset_io)
+    index = lib.build_inverted_index(documents, storage_policy='varbyte')
+    index.dump(filepath)
+    loaded_index = lib.InvertedIndex.load(filepath, storage_policy='varbyte')
+    assert loaded_index == index
+
+
+def test_index_dump_varbyte_large_doc_ids(tmpdir):
+    """Doc ids above 16 bits do not fit struct storage but fit variable-byte one"""
+    filepath = tmpdir.join('inverted.index')
+    index = lib.InvertedIndex({'big': [2 ** 40, 70000, 3], 'small': [1]}, storage_policy='varbyte')
+    index.dump(filepath)
+    loaded_index = lib.InvertedIndex.load(filepath, storage_policy='varbyte')
+    assert lib.array('Q', [3, 70000, 2 ** 40]) == loaded_index.index['big']
+    assert loaded_index == index
+
+
+@pytest.mark.parametrize('left, right, expected', [
+    ([], [1, 2, 3], []),
+    ([2, 3], [1, 2, 3], [2, 3]),
+    ([5], list(range(100)), [5]),
+    ([1, 50, 99, 200], list(range(0, 100, 7)) + [99], [99]),
+    (list(range(0, 1000, 3)), list(range(0, 1000, 5)), list(range(0, 1000, 15))),
+])
+def test_intersect_sorted(left, right, expected):
+    """Test galloping intersection of sorted posting lists"""
+    assert expected == lib.intersect_sorted(left, right)
+    assert expected == lib.intersect_sorted(right, left)
+
+
+def test_index_query_starts_from_rarest_word(create_json_index_from_documents):
+    """Query result does not depend on the order of words"""
+    index = create_json_index_from_documents
+    assert [3] == index.query(['this', 'doc', 'also'])
+    assert [3] == index.query(['also', 'this', 'this'])
+    assert [1] == index.query(['this', 'слово', 'one'])
+
+
+@pytest.fixture()
+def generated_dataset_io(tmpdir):
+    lines = [f'{doc_id}\tDoc {doc_id} word{doc_id % 7} word{doc_id % 13}, слово{doc_id % 3}\n'
+             for doc_id in range(300, 0, -1)]
+    dataset_fio = tmpdir.join('generated.txt')
+    dataset_fio.write(''.join(lines))
+    return dataset_fio
+
+
+@pytest.mark.parametrize('n_parts', [1, 2, 3, 7, 1000])
+def test_split_file_by_lines(generated_dataset_io, n_parts):
+    """Byte ranges cover the whole file and start at line beginnings"""
+    content = generated_dataset_io.read_binary()
+    ranges = lib.split_file_by_lines(generated_dataset_io, n_parts)
+    assert len(ranges) <= n_parts
+    assert content == b''.join(content[start:end] for start, end in ranges)
+    for start, _ in ranges:
+        assert start == 0 or content[start - 1:start] == b'\n'
+
+
+@pytest.mark.parametrize('workers', [2, 4])
+def test_build_inverted_index_parallel(tmpdir, generated_dataset_io, workers):
+    """Parallel build gives the same index and the same file as the serial one"""
+    documents = lib.load_documents(generated_dataset_io)
+    expected_index = lib.build_inverted_index(documents, storage_policy='struct')
+    index = lib.build_inverted_index_parallel(generated_dataset_io, workers, storage_policy='struct')
+    assert list(expected_index.index.items()) == list(index.index.items())
+
+    expected_filepath, filepath = tmpdir.join('expected.index'), tmpdir.join('inverted.index')
+    expected_index.dump(expected_filepath)
+    index.dump(filepath)
+    assert expected_filepath.read_binary() == filepath.read_binary()
+
+
+@pytest.mark.parametrize('storage_policy', sorted(lib.STORAGE_POLICIES))
+@pytest.mark.parametrize('memory_budget', [500, 10 ** 9])
+def test_build_inverted_index_out_of_core(tmpdir, generated_dataset_io, storage_policy, memory_budget):
+    """Out of core build gives the same index as the in-memory one"""
+    filepath = tmpdir.join('inverted.index')
+    documents = lib.load_documents(generated_dataset_io)
+    expected_index = lib.build_inverted_index(documents)
+    n_blocks = lib.build_inverted_index_out_of_core(generated_dataset_io, filepath, memory_budget,
+                                                   storage_policy=storage_policy, tmp_dir=tmpdir)
+    assert (n_blocks > 1) == (memory_budget < 10 ** 9)
+    loaded_index = lib.InvertedIndex.load(filepath, storage_policy=storage_policy)
+    assert expected_index == loaded_index
+    assert not tmpdir.listdir(lambda path: path.isdir())
+
+
+@pytest.mark.parametrize('memory_budget', [1, 10 ** 9])
+@pytest.mark.parametrize('lines', [
+    '1\tpython\n2\ttest\n1\tcode\n',
+    '1\t\n2\ttest\n1\t\n',
+    '2\tpython\n1\ttest\n2\tpython\n',
+])
+def test_build_inverted_index_out_of_core_rejects_repeated_doc_ids(tmpdir, lines, memory_budget):
+    """A repeated doc id is found within a block and across blocks, with or without common words"""
+    dataset_fio = tmpdir.join('dataset.txt')
+    dataset_fio.write(lines)
+    with pytest.raises(ValueError, match='Duplicate doc id'):
+        lib.build_inverted_index_out_of_core(str(dataset_fio), str(tmpdir.join('inverted.index')), memory_budget,
+                                             tmp_dir=tmpdir)
+
+
+def generate_synthetic_documents(n_docs: int) -> dict:
+    """Documents sharing frequent words, the worst case for posting deduplication"""
+    return {
+        doc_id: f'the doc {doc_id} is about topic{doc_id % 1000} and the topic{doc_id % 10}'
+        for doc_id in range(1, n_docs + 1)
+    }
+
+
+@pytest.mark.slow
+def test_build_inverted_index_scales_linearly():
+    """Build time per document stays flat from 10k to 1M documents"""
+    seconds_per_doc = {}
+    for n_docs in (10 ** 4, 10 ** 5, 10 ** 6):
+        documents = generate_synthetic_documents(n_docs)
+        start = time.perf_counter()
+        index = lib.build_inverted_index(documents)
+        seconds_per_doc[n_docs] = (time.perf_counter() - start) / n_docs
+        assert n_docs == len(index.index['the'])
+    assert seconds_per_doc[10 ** 6] < 3 * seconds_per_doc[10 ** 4]
+    assert seconds_per_doc[10 ** 5] < 3 * seconds_per_doc[10 ** 4]
+
+
+def bm25_brute_force(documents, words):
+    """Score every document with BM25 straightforwardly"""
+    tokenized = {doc_id: lib.Analyzer().analyze(content) for doc_id, content in documents.items()}
+    avg_length = sum(map(len, tokenized.values())) / len(tokenized)
+    scores = {}
+    for word in set(words):
+        n_containing = sum(word in tokens for tokens in tokenized.values())
+        if not n_containing:
+            continue
+        idf = lib.math.log(1 + (len(documents) - n_containing + 0.5) / (n_containing + 0.5))
+        for doc_id, tokens in tokenized.items():
+            term_freq = tokens.count(word)
+            if term_freq:
+                norm = lib.BM25_K1 * (1 - lib.BM25_B + lib.BM25_B * len(tokens) / avg_length)
+                weight = idf * term_freq * (lib.BM25_K1 + 1) / (term_freq + norm)
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+@pytest.mark.parametrize('words', [['two'], ['слово', 'words'], ['doc', 'word3', 'word4', 'слово1'], ['made']])
+@pytest.mark.parametrize('top', [1, 3, 10, 1000])
+def test_index_search_top_bm25(tmpdir, generated_dataset_io, words, top):
+    """WAND top-k gives the same ranking as scoring of every document"""
+    documents = lib.load_documents(generated_dataset_io)
+    documents[1] += ' two two two слово'
+    documents[2] += ' two'
+    index = lib.build_inverted_index(documents, storage_policy='mmap', with_scores=True)
+    filepath = tmpdir.join('inverted.index')
+    index.dump(filepath)
+    loaded_index = lib.InvertedIndex.load(filepath, storage_policy='mmap')
+
+    expected = bm25_brute_force(documents, words)[:top]
+    for answer in (index.search(words, top), loaded_index.search(words, top)):
+        assert [doc_id for doc_id, _ in expected] == [doc_id for doc_id, _ in answer]
+        assert [score for _, score in expected] == pytest.approx([score for _, score in answer])
+
+
+def test_index_search_without_scores(create_json_index_from_documents):
+    """Ranked query needs an index built with term frequencies"""
+    with pytest.raises(ValueError):
+        create_json_index_from_documents.search(['two'], 10)
+
+
+@pytest.mark.parametrize('left, right', [
+    ([], [1, 2]), ([1, 2, 3], []), ([1, 2, 3], [2]), (list(range(100)), list(range(0, 100, 3))),
+])
+def test_difference_and_union_sorted(left, right):
+    """Test set operations on sorted posting lists"""
+    assert sorted(set(left) - set(right)) == lib.difference_sorted(left, right)
+    assert sorted(set(left) | set(right)) == lib.union_sorted([left, right])
+
+
+@pytest.mark.parametrize('expression, expected_answer', [
+    ('two words', [2, 3]),
+    ('two AND words', [2, 3]),
+    ('one OR also', [1, 3]),
+    ('doc NOT also', [1, 2]),
+    ('doc AND NOT (also OR one)', [2]),
+    ('(one OR two) AND NOT words', [1]),
+    ('NOT NOT two doc', [2, 3]),
+    ('слово OR made', [1]),
+    ('made AND doc', []),
+    ('doc NOT this', []),
+])
+def test_index_query_boolean(create_json_index_from_documents, expression, expected_answer):
+    """Test boolean query language"""
+    index = create_json_index_from_documents
+    assert expected_answer == index.query_boolean(expression)
+
+
+@pytest.mark.parametrize('expression', ['', 'NOT two', 'two OR NOT one', '(two', 'two )', 'AND two'])
+def test_index_query_boolean_invalid(create_json_index_from_documents, expression):
+    """Invalid boolean queries are reported"""
+    index = create_json_index_from_documents
+    with pytest.raises(ValueError):
+        index.query_boolean(expression)
+
+
+@pytest.mark.parametrize('expression', ['doc AND (NOT two AND NOT one)', 'NOT two NOT one',
+                                        '(NOT two NOT one) AND (doc OR one)'])
+def test_index_query_boolean_only_negative_operands(create_json_index_from_documents, expression):
+    """AND of NOT operands only is reported by the planner"""
+    with pytest.raises(ValueError, match='NOT must be combined with a positive operand'):
+        create_json_index_from_documents.query_boolean(expression)
+
+
+def test_query_server_answers_batches(create_json_index_from_documents):
+    """Concurrent clients get answers to their batches in order"""
+    index = create_json_index_from_documents
+
+    async def ask(port, lines):
+        reader, writer = await lib.asyncio.open_connection('127.0.0.1', port)
+        writer.write(''.join(f'{line}\n' for line in lines).encode('utf-8'))
+        await writer.drain()
+        answers = [(await reader.readline()).decode('utf-8').rstrip('\n') for _ in lines]
+        writer.close()
+        return answers
+
+    async def scenario():
+        server = await lib.start_query_server(index, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return await lib.asyncio.gather(
+                ask(port, ['two words', 'слово', 'made']),
+                ask(port, ['doc', 'also two']),
+            )
+
+    first, second = lib.asyncio.run(scenario())
+    assert ['2,3', '1', ''] == first
+    assert ['1,2,3', '3'] == second
+
+
+def test_query_server_reports_invalid_queries(create_json_index_from_documents):
+    """Invalid boolean query does not break the connection"""
+    index = create_json_index_from_documents
+
+    async def scenario():
+        server = await lib.start_query_server(index, '127.0.0.1', 0, boolean=True)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await lib.asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'NOT two\none OR two\n')
+            answers = [await reader.readline(), await reader.readline()]
+            writer.close()
+            return answers
+
+    error, answer = lib.asyncio.run(scenario())
+    assert error.startswith(b'ERROR')
+    assert b'1,2,3\n' == answer
+
+
+def test_index_query_cache_normalizes_queries(create_json_index_from_documents):
+    """Queries with the same set of words share a cache entry"""
+    index = create_json_index_from_documents
+    cache = index.enable_cache(max_entries=10)
+    assert [2, 3] == index.query(['two', 'words'])
+    assert [2, 3] == index.query(['Words', 'two', 'TWO'])
+    assert [] == index.query(['made'])
+    assert {'hits': 1, 'misses': 2, 'entries': 2, 'postings': 2} == cache.info()
+
+
+def test_index_query_cache_eviction():
+    """Least recently used results are evicted by entries and postings limits"""
+    cache = lib.QueryCache(max_entries=2, max_postings=5)
+    cache.put(('a',), (1, 2))
+    cache.put(('b',), (3,))
+    assert (1, 2) == cache.get(('a',))
+    cache.put(('c',), (4,))
+    assert cache.get(('b',)) is None
+    cache.put(('d',), (5, 6, 7, 8))
+    assert [('c',), ('d',)] == list(cache.results)
+    cache.put(('e',), tuple(range(6)))
+    assert cache.get(('e',)) is None
+    assert 5 == cache.n_postings
+
+
+def test_index_query_cache_invalidated_on_index_change(create_json_index_from_documents):
+    """Replacing the postings drops cached results"""
+    index = create_json_index_from_documents
+    index.enable_cache(max_entries=10)
+    assert [2, 3] == index.query(['two'])
+    index.index = {'two': [5]}
+    assert [5] == index.query(['two'])
+
+
+@pytest.mark.parametrize('storage_policy', ['json', 'mmap'])
+def test_segmented_index_add_delete_and_merge(tmpdir, storage_policy):
+    """Updates are visible to queries before and after segments are merged"""
+    directory = tmpdir.join('segments')
+    segmented_index = lib.SegmentedIndex(directory, storage_policy=storage_policy, max_segments=2)
+    segmented_index.add(DOCUMENTS_DICT_EXAMPLE)
+    segmented_index.add({4: 'two more words', 5: 'one more doc'})
+    assert [2, 3, 4] == segmented_index.query(['two', 'words'])
+
+    segmented_index.add({2: 'replaced doc'})
+    assert 1 == segmented_index.delete([3, 100])
+    assert [4] == segmented_index.query(['two', 'words'])
+    assert [1, 2, 5] == segmented_index.query_boolean('doc NOT also')
+
+    reloaded_index = lib.SegmentedIndex.load(directory)
+    assert 3 == len(reloaded_index.segments)
+    reloaded_index.start_background_merge().join()
+    assert 1 == len(reloaded_index.segments)
+    reloaded_index.merge()
+    assert [4] == reloaded_index.query(['two', 'words'])
+    assert [1, 2, 5] == reloaded_index.query(['doc'])
+    assert {'manifest.json', 'lock'} < {path.basename for path in directory.listdir()}
+    assert 5 == len(directory.listdir())
+
+    reloaded_index = lib.load_index(directory, 'struct')
+    assert [1, 2, 5] == reloaded_index.query(['doc'])
+    assert [1, 2, 4, 5] == sorted(reloaded_index.segments[0].doc_ids)
+
+
+def test_segmented_index_merge_keeps_concurrent_deletions(tmpdir):
+    """Deletion which happens while segments are merged is not lost"""
+    segmented_index = lib.SegmentedIndex(tmpdir.join('segments'))
+    segmented_index.add({1: 'a b', 2: 'a'})
+    segmented_index.add({3: 'a c'})
+    original_write_segment = segmented_index._write_segment
+
+    def write_segment_and_delete(*args):
+        segment = original_write_segment(*args)
+        segmented_index.delete([2])
+        return segment
+
+    segmented_index._write_segment = write_segment_and_delete
+    segmented_index.merge()
+    assert 1 == len(segmented_index.segments)
+    assert [1, 3] == segmented_index.query(['a'])
+
+
+def test_segmented_index_updates_from_other_instances(tmpdir):
+    """Updates of another process are re-read instead of being overwritten"""
+    directory = tmpdir.join('segments')
+    lib.SegmentedIndex(directory).add({1: 'a b', 2: 'a'})
+    first, second = lib.SegmentedIndex.load(directory), lib.SegmentedIndex.load(directory)
+    first.add({3: 'a c'})
+    second.add({4: 'a d'})
+    assert 3 == len({segment.name for segment in second.segments})
+    assert [1, 2, 3, 4] == lib.SegmentedIndex.load(directory).query(['a'])
+
+    original_write_segment = first._write_segment
+
+    def write_segment_and_delete(*args):
+        segment = original_write_segment(*args)
+        second.delete([2, 3])
+        return segment
+
+    first._write_segment = write_segment_and_delete
+    first.merge()
+    assert [1, 4] == lib.SegmentedIndex.load(directory).query(['a'])
+    assert [1, 4] == first.query(['a'])
+
+
+def add_documents_to_segmented_index(directory: str, doc_id: int) -> None:
+    lib.SegmentedIndex(directory, max_segments=2).add({doc_id: f'common word{doc_id}'})
+
+
+def test_segmented_index_concurrent_processes(tmpdir):
+    """Documents added by concurrent processes are all kept"""
+    directory = str(tmpdir.join('segments'))
+    with lib.ProcessPoolExecutor(max_workers=4) as executor:
+        list(executor.map(add_documents_to_segmented_index, [directory] * 12, range(1, 13)))
+    segmented_index = lib.SegmentedIndex.load(directory)
+    assert list(range(1, 13)) == segmented_index.query(['common'])
+    segmented_index.merge()
+    assert list(range(1, 13)) == lib.SegmentedIndex.load(directory).query(['common'])
+
+
+def test_struct_term_dictionary_lookup(tmpdir):
+    """Every word is found through the sparse block index, missing ones are not"""
+    filepath = tmpdir.join('inverted.index')
+    index = {f'word{number}': [number, number + 70000] for number in range(100)}
+    index.update({'': [1], 'слово': [2], 'a': [3], 'zzz': [4]})
+    lib.InvertedIndex(index, storage_policy='struct').dump(filepath)
+    loaded_index = lib.InvertedIndex.load(filepath, storage_policy='struct')
+    assert isinstance(loaded_index.index, lib.StructTermDictionary)
+    assert len(index) == len(loaded_index.index)
+    assert sorted(index, key=lambda word: word.encode('utf-8')) == list(loaded_index.index)
+    for word, doc_ids in index.items():
+        assert doc_ids == list(loaded_index.index[word])
+    for word in ['word', 'word100', 'b', 'zzzz', 'Слово']:
+        assert word not in loaded_index.index
+    assert [42, 70042] == loaded_index.query(['word42'])
+
+
+def test_struct_index_checksum(tmpdir, create_struct_index_from_documents):
+    """Corrupted dictionary is detected on load"""
+    filepath = tmpdir.join('inverted.index')
+    create_struct_index_from_documents.dump(filepath)
+    content = bytearray(filepath.read_binary())
+    content[-3] ^= 0xFF
+    filepath.write_binary(bytes(content))
+    with pytest.raises(ValueError):
+        lib.InvertedIndex.load(filepath, storage_policy='struct')
+
+
+def test_struct_index_loads_legacy_layout(tmpdir):
+    """Files with JSON header written before the binary dictionary are still loaded"""
+    filepath = tmpdir.join('inverted.index')
+    header = lib.json.dumps([['two', 2], ['one', 1]]).encode('utf-8')
+    filepath.write_binary(lib.pack('>I', len(header)) + header + lib.pack('>3H', 2, 3, 1))
+    loaded_index = lib.InvertedIndex.load(filepath, storage_policy='struct')
+    assert lib.InvertedIndex({'two': [2, 3], 'one': [1]}) == loaded_index
+
+
+@pytest.mark.parametrize('storage_policy', ['json', 'struct'])
+def test_index_query_wildcard(tmpdir, storage_policy):
+    """Prefix and wildcard words are expanded through the sorted vocabulary"""
+    filepath = tmpdir.join('inverted.index')
+    index = {'python': [1, 4], 'pyth': [2], 'pytest': [3], 'pythonic': [5], 'test': [1, 3, 5], 'py': [6]}
+    lib.InvertedIndex(index, storage_policy=storage_policy).dump(filepath)
+    loaded_index = lib.InvertedIndex.load(filepath, storage_policy=storage_policy)
+    assert ['pyth', 'python', 'pythonic'] == loaded_index.expand_wildcard('pyth*')
+    assert ['python', 'pythonic'] == loaded_index.expand_wildcard('py*on*')
+    assert ['pytest', 'test'] == loaded_index.expand_wildcard('*test')
+    assert [1, 2, 4, 5] == loaded_index.query(['pyth*'])
+    assert [1, 5] == loaded_index.query(['pyth*', 'test'])
+    assert [] == loaded_index.query(['java*', 'test'])
+    assert [2, 3, 5] == loaded_index.query_boolean('py*t* NOT python')
+
+    loaded_index.max_expansions = 2
+    assert ['pyth', 'python'] == loaded_index.expand_wildcard('pyth*')
+
+
+@pytest.mark.parametrize('left, right, max_distance, expected', [
+    ('render', 'render', 1, 0),
+    ('redner', 'render', 2, 2),
+    ('redner', 'render', 1, None),
+    ('pytest', 'pytests', 1, 1),
+    ('', 'ab', 2, 2),
+    ('python', 'java', 3, None),
+    ('слово', 'слова', 1, 1),
+])
+def test_bounded_levenshtein(left, right, max_distance, expected):
+    """Test edit distance limited by max_distance"""
+    assert expected == lib.bounded_levenshtein(left, right, max_distance)
+    assert expected == lib.bounded_levenshtein(right, left, max_distance)
+
+
+def test_ngram_index_similar():
+    """Closest words are found through shared trigrams"""
+    ngram_index = lib.NgramIndex(['render', 'rendering', 'tender', 'python', 'pythons', 'test'])
+    assert ['render'] == ngram_index.similar('redner', 2)
+    assert [] == ngram_index.similar('redner', 1)
+    assert ['python'] == ngram_index.similar('pyhton', 2)
+    assert ['python', 'pythons'] == ngram_index.similar('pythonn', 1)
+    assert ['render', 'tender'] == ngram_index.similar('xender', 1)
+    assert ['abf', 'acf', 'adf'] == lib.NgramIndex(['abf', 'acf', 'adf', 'xyz']).similar('aef', 1)
+
+
+def levenshtein(left: str, right: str) -> int:
+    distances = list(range(len(right) + 1))
+    for i, left_char in enumerate(left, 1):
+        previous, distances[0] = distances[0], i
+        for j, right_char in enumerate(right, 1):
+            previous, distances[j] = distances[j], min(distances[j] + 1, distances[j - 1] + 1,
+                                                        previous + (left_char != right_char))
+    return distances[-1]
+
+
+@pytest.mark.parametrize('max_distance', [1, 2])
+def test_ngram_index_similar_matches_brute_force(max_distance):
+    """Trigram filter and length buckets find the same words as comparing with every word"""
+    random = Random(7)
+    words = {''.join(random.choice('abcd') for _ in range(random.randint(1, 7))) for _ in range(300)}
+    ngram_index = lib.NgramIndex(words)
+    for query in sorted({''.join(random.choice('abcde') for _ in range(random.randint(1, 8))) for _ in range(200)}):
+        distances = {word: levenshtein(query, word) for word in words}
+        best_distance = min(distances.values())
+        expected = sorted(word for word, distance in distances.items() if distance == best_distance)
+        assert (expected if best_distance <= max_distance else []) == ngram_index.similar(query, max_distance)
+
+
+def test_index_query_fuzzy(tmpdir, create_json_index_from_documents):
+    """Misspelled words are replaced by the closest indexed words"""
+    filepath = tmpdir.join('inverted.index')
+    index = create_json_index_from_documents
+    index.ngram_index = lib.NgramIndex(index.index)
+    index.dump(filepath)
+    loaded_index = lib.InvertedIndex.load(filepath, storage_policy='json')
+    assert isinstance(loaded_index.ngram_index, lib.NgramIndex)
+    assert [] == loaded_index.query(['two', 'wrods'])
+    loaded_index.enable_fuzzy(2)
+    assert [2, 3] == loaded_index.query(['two', 'wrods'])
+    assert [1] == loaded_index.query(['слов', 'doc'])
+    assert [] == loaded_index.query(['made'])
+
+
+@pytest.mark.parametrize('expression, expected_answer', [
+    ('"consists two words"', [2, 3]),
+    ('"doc consists"', [1, 2]),
+    ('"two consists"', []),
+    ('"this doc" NOT "also consists"', [1, 2]),
+    ('"one слово" OR "also consists"', [1, 3]),
+    ('doc NEAR/1 consists', [1, 2]),
+    ('doc NEAR/2 consists', [1, 2, 3]),
+    ('words NEAR/2 consists', [2, 3]),
+    ('words NEAR/1 consists', []),
+    ('"doc"', [1, 2, 3]),
+])
+@pytest.mark.parametrize('storage_policy', ['json', 'struct'])
+def test_index_query_phrase(tmpdir, example_dataset_io, storage_policy, expression, expected_answer):
+    """Phrase and NEAR queries are verified against stored word positions"""
+    filepath = tmpdir.join('inverted.index')
+    documents = lib.load_documents(example_dataset_io)
+    index = lib.build_inverted_index(documents, storage_policy=storage_policy, with_positions=True)
+    assert expected_answer == index.query_boolean(expression)
+    index.dump(filepath)
+    loaded_index = lib.InvertedIndex.load(filepath, storage_policy=storage_policy)
+    assert isinstance(loaded_index.positions, lib.PositionsFile)
+    assert expected_answer == loaded_index.query_boolean(expression)
+
+
+@pytest.mark.parametrize('expression', ['""', 'doc NEAR/1', 'NEAR/1 doc', '"two words" NEAR/1 doc',
+                                        'doc NEAR/1 two NEAR/1 words', '"two wor*"', 'wor* NEAR/2 consists',
+                                        'consists NEAR/1 *'])
+def test_index_query_phrase_invalid(example_dataset_io, expression):
+    """Invalid phrase and NEAR queries are reported"""
+    documents = lib.load_documents(example_dataset_io)
+    index = lib.build_inverted_index(documents, with_positions=True)
+    with pytest.raises(ValueError):
+        index.query_boolean(expression)
+
+
+def test_positions_file_decodes_single_documents(tmpdir, monkeypatch):
+    """Positions of one document are found through the skip table"""
+    filepath = tmpdir.join('inverted.index.positions')
+    positions = {
+        'common': [[rank, rank + 200] for rank in range(300)],
+        'rare': [[5], [1, 2, 130]],
+        'empty': [],
+    }
+    monkeypatch.setattr(lib.PositionsFile, 'skip_interval', 8)
+    lib.PositionsFile.dump(positions, filepath)
+    positions_file = lib.PositionsFile.load(filepath)
+    assert positions == {word: positions_file[word] for word in positions_file}
+    for word, doc_positions in positions.items():
+        assert doc_positions == [positions_file.document_positions(word, rank) for rank in range(len(doc_positions))]
+
+
+def test_index_query_phrase_decodes_candidates_only(tmpdir, monkeypatch):
+    """Positions of a frequent word are decoded only for the candidate documents"""
+    filepath = tmpdir.join('inverted.index')
+    documents = {doc_id: 'the common text' for doc_id in range(1, 500)}
+    documents[500] = 'the rare word'
+    index = lib.build_inverted_index(documents, storage_policy='struct', with_positions=True)
+    index.dump(filepath)
+    loaded_index = lib.InvertedIndex.load(filepath, storage_policy='struct')
+    decoded_words = []
+    getitem = lib.PositionsFile.__getitem__
+    monkeypatch.setattr(lib.PositionsFile, '__getitem__',
+                        lambda self, word: decoded_words.append(word) or getitem(self, word))
+    assert [500] == loaded_index.query_boolean('"the rare"')
+    assert [] == loaded_index.query_boolean('rare NEAR/0 the')
+    assert 'the' not in decoded_words
+
+
+@pytest.mark.parametrize('expression, expected_answer', [
+    ('"two wrds"', [2, 3]),
+    ('"consist two"', [2, 3]),
+    ('"two consist"', []),
+    ('wrds NEAR/2 consist', [2, 3]),
+    ('"doc consist" NOT "alsoo"', [1, 2]),
+])
+def test_index_query_phrase_fuzzy(tmpdir, example_dataset_io, expression, expected_answer):
+    """Unknown words of phrases are matched at the positions of the closest words"""
+    filepath = tmpdir.join('inverted.index')
+    index = lib.build_inverted_index(lib.load_documents(example_dataset_io), storage_policy='struct',
+                                     with_positions=True)
+    index.dump(filepath)
+    loaded_index = lib.InvertedIndex.load(filepath, storage_policy='struct')
+    assert [] == loaded_index.query_boolean(expression)
+    loaded_index.enable_fuzzy(1)
+    assert expected_answer == loaded_index.query_boolean(expression)
+
+
+def test_index_query_phrase_without_positions(create_json_index_from_documents):
+    """Phrase queries need an index built with positions"""
+    with pytest.raises(ValueError, match='--positions'):
+        create_json_index_from_documents.query_boolean('"two words"')
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_sharded_index_matches_single_index(tmpdir, generated_dataset_io, workers):
+    """Scatter-gather over shards answers like one index over all documents"""
+    documents = lib.load_documents(generated_dataset_io)
+    index = lib.build_inverted_index(documents, storage_policy='struct', with_scores=True)
+    directory = str(tmpdir.join('sharded'))
+    lib.build_sharded_index(documents, directory, 4, storage_policy='struct', with_scores=True)
+    sharded_index = lib.load_index(directory, 'json')
+    sharded_index.workers = workers
+    assert isinstance(sharded_index, lib.ShardedIndex)
+    assert 4 == len(sharded_index.shards)
+    try:
+        for words in (['word3'], ['word3', 'word5'], ['doc', 'слово1'], ['word1*'], ['made']):
+            assert index.query(words) == sharded_index.query(words)
+        assert index.query_boolean('word3 NOT word5') == sharded_index.query_boolean('word3 NOT word5')
+        for words in (['word3', 'word5'], ['doc', 'word1'], ['made', 'слово2']):
+            expected = index.search(words, 5)
+            top = sharded_index.search(words, 5)
+            assert 5 == len(top)
+            assert [doc_id for doc_id, _ in expected] == [doc_id for doc_id, _ in top]
+            assert [score for _, score in expected] == pytest.approx([score for _, score in top])
+    finally:
+        sharded_index.close()
+
+
+def test_shard_of_is_stable():
+    """Documents are partitioned by a hash which does not depend on the process"""
+    assert [3, 1, 3, 0, 2, 0, 2, 3] == [lib.shard_of(doc_id, 4) for doc_id in range(1, 9)]
+    assert [0, 2] == [lib.shard_of(doc_id, 3) for doc_id in (10, 2 ** 40)]
+
+
+def test_callback_query_sharded_index(tmpdir, example_dataset_io, capsys):
+    """Sharded index directory is built and queried from CLI"""
+    directory = str(tmpdir.join('sharded'))
+    lib.callback_build(Namespace(dataset=example_dataset_io, output=directory, strategy='json', shards=2,
+                                 workers=1, memory_budget=None, bm25=False, fuzzy=False, positions=False))
+    lib.callback_query(Namespace(index=directory, query=[['two', 'words']], strategy='struct'))
+    assert '2,3' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('doc_ids, typecode', [([1, 2, 70000], 'I'), ([1, 2 ** 32], 'Q'), ([], 'I')])
+def test_compact_postings(doc_ids, typecode):
+    """Doc ids are stored unboxed in the narrowest array they fit"""
+    postings = lib.compact_postings(doc_ids)
+    assert typecode == postings.typecode
+    assert doc_ids == list(postings)
+
+
+@pytest.mark.parametrize('storage_policy', sorted(lib.STORAGE_POLICIES))
+def test_loaded_postings_are_arrays(tmpdir, create_json_index_from_documents, storage_policy):
+    """Every storage policy loads posting lists as arrays"""
+    filepath = tmpdir.join('inverted.index')
+    index = create_json_index_from_documents
+    index.storage_policy = storage_policy
+    index.dump(filepath)
+    loaded_index = lib.InvertedIndex.load(filepath, storage_policy=storage_policy)
+    assert lib.array('I', [2, 3]) == loaded_index.index['two']
+    assert [2, 3] == loaded_index.query(['two', 'words'])
+    assert index == loaded_index
+
+
+def measure_allocated_memory(build) -> int:
+    """Bytes kept allocated by the object built by build"""
+    tracemalloc.start()
+    try:
+        result = build()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+@pytest.mark.slow
+def test_compact_postings_memory():
+    """Array postings take much less memory than lists of ints, even with many one-document words"""
+    index = lib.build_inverted_index(generate_synthetic_documents(10 ** 5)).index
+    list_size = measure_allocated_memory(lambda: {word: list(doc_ids) for word, doc_ids in index.items()})
+    array_size = measure_allocated_memory(
+        lambda: {word: lib.compact_postings(list(doc_ids)) for word, doc_ids in index.items()})
+    assert array_size * 2 < list_size
+
+
+def test_numpy_batch_engine_matches_query(generated_dataset_io):
+    """Batch of queries is answered like one query at a time"""
+    pytest.importorskip('numpy')
+    documents = lib.load_documents(generated_dataset_io)
+    index = lib.build_inverted_index(documents)
+    queries = [['word3'], ['word3', 'word5'], ['Doc', 'слово1', 'word2'], ['word1*', 'word4'],
+               ['made'], [''], ['word3', 'word5']]
+    engine = lib.NumpyBatchEngine(index)
+    assert [index.query(words) for words in queries] == engine.query_batch(queries)
+
+
+def test_process_query_from_file_numpy(create_json_index_from_documents, capsys):
+    """Query file is answered in batches by the numpy engine"""
+    pytest.importorskip('numpy')
+    lib.process_query_from_file(['two words\n', 'doc\n', 'made\n'], create_json_index_from_documents,
+                                engine='numpy')
+    assert '2,3\n1,2,3\n\n' == capsys.readouterr().out
+
+
+def test_numpy_batch_engine_requires_numpy(monkeypatch, create_json_index_from_documents):
+    """Missing optional dependency is reported"""
+    monkeypatch.setattr(lib, 'np', None)
+    with pytest.raises(ImportError):
+        lib.NumpyBatchEngine(create_json_index_from_documents)
+
+
+def test_bitmap_postings_operations():
+    """Bitmaps are combined bitwise and with sorted lists"""
+    left = lib.BitmapPostings.from_doc_ids([1, 3, 8, 9, 20])
+    right = lib.BitmapPostings.from_doc_ids([3, 9, 10])
+    assert 5 == len(left)
+    assert 9 in left and 10 not in left and 1000 not in left
+    assert [3, 9] == list(left & right)
+    assert [1, 3, 8, 9, 10, 20] == list(left | right)
+    assert [1, 8, 20] == list(left - right)
+    assert [3, 20] == lib.intersect_sorted([2, 3, 20, 21], left)
+    assert [2, 21] == lib.difference_sorted([2, 3, 20, 21], left)
+    assert [1, 8] == list(lib.difference_sorted(left, [3, 9, 20]))
+    assert [1, 2, 3, 8, 9, 20] == lib.union_sorted([left, [2, 3]])
+    assert [] == list(lib.BitmapPostings.from_int(0))
+
+
+def test_index_dump_hybrid_containers(tmpdir, generated_dataset_io):
+    """Dense words are saved as bitmaps, sparse ones as arrays, queries are unchanged"""
+    filepath = tmpdir.join('inverted.index')
+    documents = lib.load_documents(generated_dataset_io)
+    index = lib.build_inverted_index(documents, storage_policy='hybrid')
+    index.dump(filepath)
+    loaded_index = lib.InvertedIndex.load(filepath, storage_policy='hybrid')
+    assert isinstance(loaded_index.index, lib.HybridPostings)
+    assert isinstance(loaded_index.index['doc'], lib.BitmapPostings)
+    assert isinstance(loaded_index.index['297'], lib.array)
+    assert index == loaded_index
+    for words in (['doc', 'word3'], ['слово1', 'word3', 'word5'], ['17', 'doc'], ['word1*', 'doc']):
+        assert index.query(words) == loaded_index.query(words)
+    for expression in ('doc NOT word3', 'word3 OR word5 NOT слово1', '(word1 OR 297) AND doc'):
+        assert index.query_boolean(expression) == loaded_index.query_boolean(expression)
+
+
+@pytest.mark.parametrize('text, expected_terms', [
+    ('This doc, consists: of words!', ['doc', 'consist', 'word']),
+    ('  ...  ', []),
+    ('Stories of the cats', ['story', 'cat']),
+    ('Слово и слова', ['слово', 'и', 'слова']),
+])
+def test_analyzer_terms(text, expected_terms):
+    """Text is lowercased, split without empty words, stop words dropped and plurals stemmed"""
+    analyzer = lib.Analyzer(stop_words=['THIS', 'of', 'the'], stem=True)
+    assert expected_terms == analyzer.analyze(text)
+
+
+def test_analyzer_keeps_positions_of_stop_words():
+    """Positions count the dropped stop words"""
+    analyzer = lib.Analyzer(stop_words=['the'])
+    assert [(0, 'doc'), (2, 'words')] == analyzer.analyze_positions('doc the words')
+    assert ['word*', 'two'] == analyzer.analyze_query(['Word*', 'the', 'TWO'])
+
+
+def test_index_analyzer_is_saved(tmpdir, example_dataset_io):
+    """Queries are analyzed like the documents of the loaded index"""
+    filepath = tmpdir.join('inverted.index')
+    stop_words_fio = tmpdir.join('stop_words.txt')
+    stop_words_fio.write('this\ntwo\n\n')
+    lib.callback_build(Namespace(dataset=example_dataset_io, output=filepath, strategy='struct', workers=1,
+                                 memory_budget=None, bm25=False, fuzzy=False, positions=True,
+                                 stop_words=stop_words_fio, stem=True))
+    loaded_index = lib.InvertedIndex.load(filepath, storage_policy='struct')
+    assert lib.Analyzer(stop_words=['this', 'two'], stem=True) == loaded_index.analyzer
+    assert 'this' not in loaded_index.index and 'word' in loaded_index.index
+    assert [2, 3] == loaded_index.query(['This', 'WORDS'])
+    assert [] == loaded_index.query(['this', 'two'])
+    assert [1, 2] == loaded_index.query_boolean('Doc AND consists NOT also')
+    assert [2, 3] == loaded_index.query_boolean('"consists two words"')
+    assert [] == loaded_index.query_boolean('"consists words"')
+    assert [] == loaded_index.query_boolean('this OR two')
+
+
+def test_stats_report_percentiles():
+    """Latency percentiles and rates are derived from recorded values"""
+    stats = lib.Stats('query')
+    for milliseconds in range(1, 101):
+        stats.record_latency(milliseconds / 1000)
+    stats.count('queries', 100)
+    with stats.stage('query'):
+        pass
+    stats.describe_postings({'a': [1], 'b': [1, 2, 3], 'c': [], 'd': [1, 2, 3, 4]})
+    report = stats.report()
+    assert {'p50': 0.05, 'p90': 0.09, 'p99': 0.099, 'max': 0.1} == report['latency']
+    assert {'0': 1, '1-1': 1, '2-3': 1, '4-7': 1} == report['postings_histogram']
+    assert 4 == report['counters']['vocabulary_size'] and 8 == report['counters']['postings']
+    assert report['rates']['queries_per_second'] > 0
+
+
+def test_stats_nested_stages_are_exclusive(monkeypatch):
+    """Time of a nested stage is not counted in the enclosing one"""
+    clock = iter([0.0, 1.0, 4.0, 6.0])
+    monkeypatch.setattr(lib.time, 'perf_counter', lambda: next(clock))
+    monkeypatch.setattr(lib.time, 'process_time', lambda: 0.0)
+    stats = lib.Stats('build')
+    with stats.stage('build'):
+        with stats.stage('read'):
+            pass
+    assert {'wall': 3.0, 'cpu': 0.0, 'total_wall': 3.0} == stats.stages['read']
+    assert {'wall': 3.0, 'cpu': 0.0, 'total_wall': 6.0} == stats.stages['build']
+    stats.count('documents', 12)
+    assert 2.0 == stats.report()['rates']['documents_per_second']
+
+
+def test_callback_build_and_query_stats(tmpdir, example_dataset_io, capsys):
+    """With --stats build and query print a JSON report to stderr"""
+    filepath = tmpdir.join('inverted.index')
+    lib.callback_build(Namespace(dataset=example_dataset_io, output=filepath, strategy='struct', workers=1,
+                                 memory_budget=None, bm25=False, fuzzy=False, positions=False, stats=True))
+    report = json.loads(capsys.readouterr().err)
+    assert 'build' == report['command']
+    assert {'read', 'tokenize', 'build', 'dump'} == set(report['stages'])
+    assert 3 == report['counters']['documents'] and 16 == report['counters']['tokens']
+    assert 8 == report['counters']['vocabulary_size']
+    assert os.path.getsize(filepath) == report['counters']['bytes_written']
+    assert report['rates']['documents_per_second'] > 0
+    build_stage = report['stages']['build']
+    nested_wall = report['stages']['read']['wall'] + report['stages']['tokenize']['wall']
+    assert build_stage['total_wall'] == pytest.approx(build_stage['wall'] + nested_wall)
+
+    lib.callback_query(Namespace(index=filepath, query=[['two', 'words'], ['doc']], strategy='struct', stats=True))
+    captures = capsys.readouterr()
+    assert '2,3\n1,2,3\n' == captures.out
+    report = json.loads(captures.err)
+    assert {'load', 'query'} == set(report['stages'])
+    assert 2 == report['counters']['queries']
+    assert set(report['latency']) == {'p50', 'p90', 'p99', 'max'}
+
+
+@pytest.mark.parametrize('compress', [gzip.compress, bz2.compress, lzma.compress, lambda data: data])
+def test_iter_documents_compressed(tmpdir, compress):
+    """Compressed datasets are detected by magic bytes and read as a stream"""
+    dataset_fio = tmpdir.join('dataset.bin')
+    dataset_fio.write_binary(compress(DOCUMENTS_EXAMPLE.encode('utf-8')))
+    documents = lib.iter_documents(dataset_fio, encoding='utf-8')
+    assert not isinstance(documents, dict)
+    assert DOCUMENTS_DICT_EXAMPLE == dict(documents)
+    assert lib.is_plain_dataset_file(dataset_fio) == (compress(b'x') == b'x')
+
+
+def test_callback_build_from_stdin(tmpdir, monkeypatch):
+    """Documents piped to stdin are indexed"""
+    filepath = tmpdir.join('inverted.index')
+    stdin_bytes = gzip.compress(DOCUMENTS_EXAMPLE.encode(lib.locale.getpreferredencoding(False)))
+    monkeypatch.setattr(lib.sys, 'stdin', TextIOWrapper(BufferedReader(BytesIO(stdin_bytes))))
+    lib.callback_build(Namespace(dataset='-', output=filepath, strategy='struct', workers=2,
+                                 memory_budget=None, bm25=False, fuzzy=False, positions=False))
+    expected_index = lib.InvertedIndex(INVERTED_INDEX_EXAMPLE)
+    assert expected_index == lib.InvertedIndex.load(filepath, storage_policy='struct')
+
+
+def test_build_out_of_core_compressed(tmpdir):
+    """Out of core build streams a compressed dataset"""
+    dataset_fio, filepath = tmpdir.join('dataset.txt.xz'), tmpdir.join('inverted.index')
+    dataset_fio.write_binary(lzma.compress(DOCUMENTS_EXAMPLE.encode(lib.locale.getpreferredencoding(False))))
+    lib.build_inverted_index_out_of_core(dataset_fio, filepath, 10 ** 6, storage_policy='json', tmp_dir=tmpdir)
+    assert lib.InvertedIndex(INVERTED_INDEX_EXAMPLE) == lib.InvertedIndex.load(filepath, storage_policy='json')
+
+
+@pytest.mark.parametrize('boolean', [False, True])
+def test_process_query_file_parallel_keeps_order(tmpdir, monkeypatch, generated_dataset_io, boolean):
+    """Batches answered by worker processes are written in the order of queries"""
+    filepath = tmpdir.join('inverted.index')
+    index = lib.build_inverted_index(lib.load_documents(generated_dataset_io), storage_policy='struct')
+    index.dump(filepath)
+    lines = [f'word{number % 3} word{number % 2}\n' for number in range(40)] + ['made\n', 'doc слово2\n']
+    monkeypatch.setattr(lib, 'QUERY_BATCH_SIZE', 16)
+    output = StringIO()
+    stats = lib.Stats('query')
+    lib.process_query_file_parallel(lines, filepath, 'struct', 3, boolean=boolean, output=output, stats=stats)
+    expected = ''.join(
+        lib.make_result_of_query_in_one_line(lib.run_query(index, lib.parse_query_line(line, boolean),
+                                                           boolean=boolean)) + '\n'
+        for line in lines)
+    assert expected == output.getvalue()
+    assert 42 == stats.counters['queries']
+    assert stats.counters['unique_queries'] < 42
+    assert stats.counters['unique_queries'] == len(stats.latencies)
+    assert 'latency' in stats.report()
+
+
+def test_callback_query_workers(tmpdir, create_struct_index_from_documents, capsys):
+    """Query file is answered by a pool of processes from CLI"""
+    filepath = tmpdir.join('inverted.index')
+    create_struct_index_from_documents.dump(filepath)
+    lib.callback_query(Namespace(index=filepath, query=None, query_file=['two words\n', 'doc\n', 'two words\n'],
+                                 strategy='struct', workers=2))
+    assert '2,3\n1,2,3\n2,3\n' == capsys.readouterr().out
+
+
+def test_mine_term_pairs_counts_queries_with_both_words():
+    """Every pair of distinct analyzed words is counted once per query"""
+    queries = [['Python', 'test'], ['test', 'python', 'python'], ['python', 'render', 'test'], ['pyth*', 'test']]
+    pair_counts = lib.mine_term_pairs(queries)
+    assert 3 == pair_counts['python', 'test']
+    assert 1 == pair_counts['python', 'render']
+    assert not any('*' in word for pair in pair_counts for word in pair)
+
+
+def test_pair_cache_respects_memory_budget(create_struct_index_from_documents):
+    """Frequent pairs are cached while their doc ids fit into the budget"""
+    index = create_struct_index_from_documents
+    pair_counts = lib.Counter({('doc', 'two'): 5, ('doc', 'this'): 3, ('doc', 'слово'): 2, ('doc', 'unknown'): 9,
+                               ('consists', 'words'): 1})
+    pair_cache = lib.PairCache.build(index, pair_counts, memory_budget=12)
+    assert ('doc', 'two') in pair_cache and ('doc', 'this') not in pair_cache
+    assert ('doc', 'слово') in pair_cache and len(pair_cache) == 2
+    assert [2, 3] == list(pair_cache.get(('doc', 'two')))
+    assert pair_cache.n_bytes() <= 12
+
+
+def test_query_starts_from_cached_pair(tmpdir, generated_dataset_io):
+    """Results are the same with cached pairs, which survive dump and load"""
+    filepath = tmpdir.join('inverted.index')
+    index = lib.build_inverted_index(lib.load_documents(generated_dataset_io), storage_policy='struct')
+    queries = [['word1', 'word2'], ['word2', 'word1', 'word3'], ['word0', 'word4'], ['word1', 'missing']]
+    expected = [index.query(words) for words in queries]
+    index.pair_cache = lib.PairCache.build(index, lib.mine_term_pairs(queries * 2), 2 ** 20)
+    assert ('word1', 'word2') in index.pair_cache
+    assert expected == [index.query(words) for words in queries]
+    index.dump(filepath)
+    loaded_index = lib.InvertedIndex.load(filepath, 'struct')
+    assert index.pair_cache.pairs == loaded_index.pair_cache.pairs
+    assert expected == [loaded_index.query(words) for words in queries]
+
+
+def test_callback_pairs_writes_sidecar(tmpdir, create_struct_index_from_documents, capsys):
+    """Pairs mined from a query log are stored next to the index"""
+    filepath = tmpdir.join('inverted.index')
+    create_struct_index_from_documents.dump(filepath)
+    lib.callback_pairs(Namespace(index=str(filepath), strategy='struct', query_log=['two doc\n', 'doc two words\n'],
+                                 memory_budget=1, min_count=2))
+    assert 'Cached 1 of 3 pairs' in capsys.readouterr().err
+    loaded_index = lib.InvertedIndex.load(filepath, 'struct')
+    assert [('doc', 'two')] == list(loaded_index.pair_cache.pairs)
+    assert [2, 3] == loaded_index.query(['two', 'doc'])
+
+
+def build_namespace(dataset, output, **options) -> Namespace:
+    arguments = dict(dataset=dataset, output=output, strategy='struct', workers=1, memory_budget=None, bm25=False,
+                     fuzzy=False, positions=False, stop_words=None, stem=False, tmp_dir=None)
+    arguments.update(options)
+    return Namespace(**arguments)
+
+
+def test_rebuilt_index_ignores_previous_pairs(tmpdir, capsys):
+    """Pairs of a previous index are neither loaded nor used after a rebuild"""
+    filepath = tmpdir.join('inverted.index')
+    first_dataset, second_dataset = tmpdir.join('first.txt'), tmpdir.join('second.txt')
+    first_dataset.write('1\tpython test\n2\tpython\n')
+    second_dataset.write('1\tpython\n2\tpython test\n')
+    lib.callback_build(build_namespace(str(first_dataset), str(filepath)))
+    lib.callback_pairs(Namespace(index=str(filepath), strategy='struct', query_log=['python test\n'] * 2,
+                                 memory_budget=1, min_count=2))
+    assert [1] == lib.InvertedIndex.load(filepath, 'struct').query(['python', 'test'])
+
+    lib.callback_build(build_namespace(str(second_dataset), str(filepath)))
+    assert not os.path.exists(lib.sidecar_path(filepath, 'pairs'))
+    lib.callback_query(Namespace(index=filepath, query=[['python', 'test']], strategy='struct'))
+    assert '2\n' == capsys.readouterr().out
+
+
+def test_pairs_of_another_index_file_are_ignored(tmpdir, create_struct_index_from_documents):
+    """Index file rewritten without its pairs does not match their fingerprint"""
+    filepath = tmpdir.join('inverted.index')
+    index = create_struct_index_from_documents
+    index.pair_cache = lib.PairCache.build(index, lib.Counter({('doc', 'two'): 2}), 2 ** 20)
+    index.dump(filepath)
+    assert ('doc', 'two') in lib.InvertedIndex.load(filepath, 'struct').pair_cache
+    lib.StructStoragePolicy.dump({'doc': [1], 'two': [1]}, filepath)
+    loaded_index = lib.InvertedIndex.load(filepath, 'struct')
+    assert loaded_index.pair_cache is None
+    assert [1] == loaded_index.query(['two', 'doc'])
+
+
+def test_rebuilt_index_without_fuzzy_drops_trigrams(tmpdir, capsys):
+    """Words of a previous index are not suggested after a rebuild"""
+    filepath = tmpdir.join('inverted.index')
+    first_dataset, second_dataset = tmpdir.join('first.txt'), tmpdir.join('second.txt')
+    first_dataset.write('1\tpython apple\n')
+    second_dataset.write('1\tpython banana\n')
+    lib.callback_build(build_namespace(str(first_dataset), str(filepath), fuzzy=True))
+    lib.callback_build(build_namespace(str(second_dataset), str(filepath)))
+    assert not os.path.exists(lib.sidecar_path(filepath, 'ngrams'))
+    lib.callback_query(Namespace(index=filepath, query=[['appel'], ['banan']], strategy='struct', fuzzy=1))
+    assert '\n1\n' == capsys.readouterr().out
+
+
+def test_fuzzy_ignores_words_missing_from_index(create_struct_index_from_documents):
+    """Trigram index words which are not indexed are not used"""
+    index = create_struct_index_from_documents
+    index.ngram_index = lib.NgramIndex(list(index.index) + ['apple'])
+    index.enable_fuzzy(1)
+    assert [] == index.query(['appel'])
+    assert [2, 3] == index.query(['twoo'])
+
+
+@pytest.mark.parametrize('memory_budget', [None, 1])
+def test_rebuilt_index_without_stop_words_uses_default_analyzer(tmpdir, capsys, memory_budget):
+    """Stop words of a previous build are not dropped from queries after a rebuild"""
+    filepath = tmpdir.join('inverted.index')
+    dataset, stop_words_fio = tmpdir.join('dataset.txt'), tmpdir.join('stop_words.txt')
+    dataset.write('1\tthe python\n2\tthe test\n3\tpython\n')
+    stop_words_fio.write('the\n')
+    lib.callback_build(build_namespace(str(dataset), str(filepath), stop_words=str(stop_words_fio),
+                                       memory_budget=memory_budget))
+    assert os.path.exists(lib.sidecar_path(filepath, 'analyzer'))
+    lib.callback_build(build_namespace(str(dataset), str(filepath), memory_budget=memory_budget))
+    assert not os.path.exists(lib.sidecar_path(filepath, 'analyzer'))
+    lib.callback_query(Namespace(index=filepath, query=[['the']], strategy='struct'))
+    assert '1,2\n' == capsys.readouterr().out
+
+
+def test_scores_are_loaded_on_first_search(tmpdir, example_dataset_io):
+    """Plain queries do not read term frequencies, ranked ones and dump do"""
+    filepath, copy_filepath = tmpdir.join('inverted.index'), tmpdir.join('copy.index')
+    index = lib.build_inverted_index(lib.load_documents(example_dataset_io), storage_policy='struct',
+                                     with_scores=True)
+    index.dump(filepath)
+    loaded_index = lib.InvertedIndex.load(filepath, 'struct')
+    assert loaded_index.term_freqs is None
+    assert [2, 3] == loaded_index.query(['two', 'words'])
+    assert loaded_index.term_freqs is None
+    loaded_index.dump(copy_filepath)
+    assert os.path.exists(lib.sidecar_path(copy_filepath, 'scores'))
+    assert index.search(['two', 'words'], 2) == lib.InvertedIndex.load(filepath, 'struct').search(['two', 'words'], 2)
+
+
+def test_rebuilt_index_without_bm25_drops_scores(tmpdir, example_dataset_io):
+    """Term frequencies of a previous build are not used after a rebuild"""
+    filepath = tmpdir.join('inverted.index')
+    lib.callback_build(build_namespace(str(example_dataset_io), str(filepath), bm25=True))
+    lib.callback_build(build_namespace(str(example_dataset_io), str(filepath)))
+    assert not os.path.exists(lib.sidecar_path(filepath, 'scores'))
+    with pytest.raises(ValueError, match='--bm25'):
+        lib.callback_query(Namespace(index=filepath, query=[['two']], strategy='struct', top=2))
+
+
+@pytest.mark.parametrize('build_options', [
+    dict(),
+    dict(positions=True),
+    dict(workers=2),
+    dict(memory_budget=1),
+    dict(shards=2),
+])
+def test_build_rejects_repeated_doc_ids(tmpdir, build_options):
+    """A doc id found twice in the dataset is reported instead of duplicating postings"""
+    dataset_fio, filepath = tmpdir.join('dataset.txt'), tmpdir.join('inverted.index')
+    dataset_fio.write('1\tpython test\n2\tpython\n1\tpython test\n')
+    with pytest.raises(ValueError, match='Duplicate doc id 1'):
+        lib.callback_build(build_namespace(str(dataset_fio), str(filepath), **build_options))
+    with pytest.raises(ValueError, match='Duplicate doc id 1'):
+        lib.build_inverted_index(lib.iter_documents(str(dataset_fio)))
+
+
+def test_add_rejects_repeated_doc_ids(tmpdir):
+    """Documents added to a segmented index follow the same doc id rule as a build"""
+    dataset_fio, directory = tmpdir.join('dataset.txt'), str(tmpdir.join('segments'))
+    dataset_fio.write('1\tpython test\n1\tpython\n')
+    with pytest.raises(ValueError, match='Duplicate doc id 1'):
+        lib.callback_add(Namespace(index=directory, dataset=str(dataset_fio), strategy='struct', max_segments=4))
+
+
+def test_callback_serve_configures_index(tmpdir, create_struct_index_from_documents, monkeypatch):
+    """Server applies the same index settings as the query command"""
+    filepath = tmpdir.join('inverted.index')
+    create_struct_index_from_documents.dump(filepath)
+    served = []
+
+    def serve_index(inverted_index, host, port, top=None, boolean=False):
+        served.append(inverted_index)
+
+    monkeypatch.setattr(lib, 'serve_index', serve_index)
+    monkeypatch.setattr(lib.asyncio, 'run', lambda coroutine: None)
+    lib.callback_serve(Namespace(index=filepath, strategy='struct', host='127.0.0.1', port=0, cache_size=10,
+                                 max_expansions=3, fuzzy=1, top=None, boolean=False))
+    inverted_index, = served
+    assert 10 == inverted_index.cache.max_entries and 3 == inverted_index.max_expansions
+    assert [2, 3] == inverted_index.query(['twoo'])
+
+
+def test_callback_query_fuzzy_segmented_index(tmpdir, capsys):
+    """Typo-tolerant queries are answered by every segment, merged ones too"""
+    directory = tmpdir.join('segments')
+    segmented_index = lib.SegmentedIndex(directory)
+    segmented_index.add({1: 'python test', 2: 'python'})
+    segmented_index.add({3: 'python tests'})
+    lib.callback_query(Namespace(index=directory, query=[['pythn'], ['pythn', 'tesq']], strategy='struct',
+                                 fuzzy=1))
+    assert '1,2,3\n1\n' == capsys.readouterr().out
+    segmented_index.enable_fuzzy(1)
+    segmented_index.merge()
+    assert [1, 2, 3] == segmented_index.query(['pythn'])
+    assert [1] == segmented_index.query(['pythn', 'tesq'])
+
+
+def test_callback_query_max_expansions_segmented_index(tmpdir, capsys):
+    """Wildcard expansion limit is applied by every segment"""
+    directory = tmpdir.join('segments')
+    segmented_index = lib.SegmentedIndex(directory)
+    segmented_index.add({1: 'word1', 2: 'word2'})
+    segmented_index.add({3: 'word3'})
+    lib.callback_query(Namespace(index=directory, query=[['word*']], strategy='struct', max_expansions=1))
+    assert '1,3\n' == capsys.readouterr().out
+    segmented_index.max_expansions = 1
+    segmented_index.add({4: 'word0'})
+    assert [1, 3, 4] == segmented_index.query(['word*'])
+
+
+def test_process_query_from_file_boolean_blank_lines(create_json_index_from_documents, capsys):
+    """Blank and punctuation-only boolean query lines are answered with empty lines"""
+    lib.process_query_from_file(['two\n', '\n', ' ?! \n', 'doc NOT two\n'], create_json_index_from_documents,
+                                boolean=True)
+    lib.process_query_from_cli([['']], create_json_index_from_documents, boolean=True)
+    assert '2,3\n\n\n1\n\n' == capsys.readouterr().out
+    with pytest.raises(ValueError, match='Empty boolean query'):
+        create_json_index_from_documents.query_boolean('')
@@ -0,0 +1,55 @@
+import json
+import pytest
+from argparse import Namespace
+
+import benchmark_inverted_index as bench
+
+
+def test_run_benchmark_records_every_policy(tmpdir):
+    """Every stage is measured for every storage policy"""
+    queries_fio = tmpdir.join('queries.txt')
+    queries_fio.write('python test\nsemantic\n')
+    results = bench.run_benchmark([200], ['json', 'struct'], str(queries_fio), str(tmpdir.join('missing.txt')),
+                                  repeat=1)
+    metrics = results['results']
+    assert {'synthetic_200/load_documents', 'synthetic_200/build_inverted_index'} < set(metrics)
+    for policy in ('json', 'struct'):
+        for stage in ('dump', 'file_size', 'load', 'queries_per_second'):
+            assert metrics[f'synthetic_200/{policy}/{stage}']['value'] > 0
+    assert 'higher' == metrics['synthetic_200/json/queries_per_second']['better']
+
+
+def test_generate_corpus_is_reproducible(tmpdir):
+    """The same seed gives the same corpus containing the query words"""
+    first, second = tmpdir.join('first.txt'), tmpdir.join('second.txt')
+    bench.generate_corpus(first, 50, ['python'], seed=1)
+    bench.generate_corpus(second, 50, ['python'], seed=1)
+    assert first.read() == second.read()
+    assert 50 == len(first.readlines())
+    assert 'python' in first.read()
+
+
+def test_compare_flags_regressions(tmpdir, capsys):
+    """Slower timings and lower throughput beyond the threshold are regressions"""
+    baseline = {'results': {
+        'a/load': {'value': 1.0, 'unit': 's', 'better': 'lower'},
+        'a/queries_per_second': {'value': 100.0, 'unit': '1/s', 'better': 'higher'},
+        'a/dump': {'value': 1.0, 'unit': 's', 'better': 'lower'},
+    }}
+    current = {'results': {
+        'a/load': {'value': 1.5, 'unit': 's', 'better': 'lower'},
+        'a/queries_per_second': {'value': 50.0, 'unit': '1/s', 'better': 'higher'},
+        'a/dump': {'value': 1.05, 'unit': 's', 'better': 'lower'},
+        'b/load': {'value': 9.0, 'unit': 's', 'better': 'lower'},
+    }}
+    regressions = bench.compare_results(baseline, current, threshold=0.1)
+    assert ['a/load', 'a/queries_per_second'] == [regression['metric'] for regression in regressions]
+
+    baseline_fio, current_fio = tmpdir.join('baseline.json'), tmpdir.join('current.json')
+    baseline_fio.write(json.dumps(baseline))
+    current_fio.write(json.dumps(current))
+    with pytest.raises(SystemExit):
+        bench.callback_compare(Namespace(baseline=baseline_fio, current=current_fio, threshold=0.1))
+    assert 'REGRESSION a/load' in capsys.readouterr().out
+    bench.callback_compare(Namespace(baseline=baseline_fio, current=baseline_fio, threshold=0.1))
+    assert 'No regressions' in capsys.readouterr().out